@@ -0,0 +1,175 @@
+"""Async client for the OpenAI chat completions API.
+
+One httpx.AsyncClient (and its connection pool) is shared by all requests.
+Transient failures (connection errors, 429, 5xx) are retried with
+exponential backoff. Responses are cached by (model, messages, temperature)
+in an in-memory LRU and, if HOMEBUH_LLM_CACHE_DIR is set, on disk.
+
+OPENAI_BASE_URL points the client at a compatible server, e.g. a local stub
+in tests or development.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Optional
+
+import aiofiles
+import httpx
+
+from .metrics import span
+
+DEFAULT_MODEL = "gpt-4o-mini"
+BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+CACHE_DIR = os.getenv("HOMEBUH_LLM_CACHE_DIR")
+CACHE_SIZE = int(os.getenv("HOMEBUH_LLM_CACHE_SIZE", "256"))
+MAX_RETRIES = int(os.getenv("HOMEBUH_LLM_RETRIES", "3"))
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class LLMError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def cache_key(model: str, messages: List[dict], temperature: float) -> str:
+    blob = json.dumps({"model": model, "messages": messages, "temperature": temperature}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+class ResponseCache:
+    """LRU of completion texts with an optional on-disk second level."""
+
+    def __init__(self, max_entries: int = CACHE_SIZE, directory: Optional[str] = CACHE_DIR):
+        self.max_entries = max_entries
+        self.directory = Path(directory) if directory else None
+        self._lru: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        if key in self._lru:
+            self._lru.move_to_end(key)
+            self.hits += 1
+            return self._lru[key]
+        if self.directory is not None:
+            p = self.directory / f"{key}.json"
+            try:
+                async with aiofiles.open(p, "r", encoding="utf-8") as f:
+                    value = json.loads(await f.read())["content"]
+            except (FileNotFoundError, ValueError, KeyError):
+                value = None
+            if value is not None:
+                self._remember(key, value)
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, value: str):
+        self._remember(key, value)
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp = self.directory / f".{key}.tmp"
+            async with aiofiles.open(tmp, "w", encoding="utf-8") as f:
+                await f.write(json.dumps({"content": value}, ensure_ascii=False))
+            os.replace(tmp, self.directory / f"{key}.json")
+
+    def _remember(self, key: str, value: str):
+        self._lru[key] = value
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+
+class LLMClient:
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        base_url: str = BASE_URL,
+        timeout: float = 30.0,
+        max_retries: int = MAX_RETRIES,
+        backoff: float = 0.5,
+        cache: Optional[ResponseCache] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = httpx.Timeout(timeout, connect=5.0)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.cache = cache if cache is not None else ResponseCache()
+        self._transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+                transport=self._transport,
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def chat(
+        self,
+        messages: List[dict],
+        model: str = DEFAULT_MODEL,
+        temperature: float = 0.2,
+        max_tokens: int = 800,
+        use_cache: bool = True,
+    ) -> str:
+        """Return the assistant message content for `messages`."""
+        key = cache_key(model, messages, temperature)
+        if use_cache:
+            cached = await self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        api_key = self.api_key or os.getenv("OPENAI_API_KEY")
+        payload = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+        headers = {"Authorization": f"Bearer {api_key}"}
+        last_error: Optional[LLMError] = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(self._delay(attempt, last_error))
+            try:
+                with span("llm"):
+                    resp = await self._http().post("/chat/completions", json=payload, headers=headers)
+            except httpx.TransportError as e:
+                last_error = LLMError(f"connection error: {e}")
+                continue
+            if resp.status_code in RETRY_STATUS:
+                last_error = LLMError(f"OpenAI error: {resp.status_code}", resp.status_code)
+                last_error.retry_after = resp.headers.get("retry-after")
+                continue
+            if resp.status_code != 200:
+                raise LLMError(f"OpenAI error: {resp.status_code}", resp.status_code)
+            try:
+                content = resp.json()["choices"][0]["message"]["content"] or ""
+            except (ValueError, KeyError, IndexError, TypeError):
+                raise LLMError("malformed response from OpenAI", resp.status_code)
+            if use_cache:
+                await self.cache.put(key, content)
+            return content
+        raise last_error
+
+    def _delay(self, attempt: int, error: Optional[LLMError]) -> float:
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after:
+            try:
+                return min(float(retry_after), 30.0)
+            except ValueError:
+                pass
+        return self.backoff * (2 ** (attempt - 1)) * (1 + random.random() * 0.25)
@@ -0,0 +1,355 @@
+"""Vectorized time-series analytics over transaction columns.
+
+`load` streams the matching transactions out of the database in chunks
+into contiguous NumPy arrays (day, amount, category, account), and the
+report functions work on whole arrays instead of looping over rows in
+Python:
+
+- `resample`: totals and counts per day, ISO week or month, empty periods
+  included, via `np.bincount`;
+- `rolling`: trailing moving average over a resampled series (cumulative
+  sums, so the cost does not depend on the window);
+- `percentiles`: per-period percentiles of single transaction amounts, from
+  one sort of packed (period, amount) keys instead of sorting each period
+  separately;
+- `year_over_year`: per-category totals for a year and the same span of
+  the year before.
+
+Amounts are in money.COMMON_EXPONENT units of one currency: the one the
+query narrows to, else the reporting currency, each currency converted per
+month at the month-end rate like the SQL aggregates (see fx.py).
+
+    python -m backend.analytics bench [--rows 1000000]
+"""
+import argparse
+import calendar
+import sys
+import time
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+from fastapi import HTTPException
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from .aggregates import KINDS, period_expr
+from .fx import Converter, period_end, reporting_currency
+from .models import Transaction
+from .money import COMMON_EXPONENT, common_units, exponent
+
+CHUNK = 50_000
+FREQS = ("day", "week", "month")
+NONE_ID = -1  # category_id / account_id of rows without one
+
+_MONDAY = 4  # 1970-01-05, day 4 of the epoch, was a Monday
+
+
+class Columns(NamedTuple):
+    day: np.ndarray  # datetime64[D]
+    amount: np.ndarray  # int64, COMMON_EXPONENT units, positive for expenses with kind="expenses"
+    category_id: np.ndarray  # int64, NONE_ID if uncategorized
+    account_id: np.ndarray  # int64, NONE_ID if none
+
+
+class Series(NamedTuple):
+    periods: np.ndarray  # datetime64 start of each period, contiguous
+    totals: np.ndarray  # float64, major units
+    counts: np.ndarray  # int64
+
+
+def _empty() -> Columns:
+    return Columns(np.empty(0, "datetime64[D]"), np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int64))
+
+
+def load(
+    s: Session,
+    kind: str = "expenses",
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    account_id: Optional[int] = None,
+    category_id: Optional[int] = None,
+    currency: Optional[str] = None,
+    convert_to: Optional[str] = None,
+    chunk: int = CHUNK,
+) -> Columns:
+    """Matching transactions as column arrays; `kind` as in aggregates (expenses are made positive).
+
+    Amounts are in `currency` when it is given (other currencies are left
+    out), else converted into the reporting currency (fx.reporting_currency)
+    at each month's end rate. Raises MissingRate.
+    """
+    if kind not in KINDS:
+        raise HTTPException(status_code=400, detail=f"unsupported kind: {kind}")
+    t = Transaction
+    where = []
+    if kind == "expenses":
+        where.append(t.amount < 0)
+    elif kind == "income":
+        where.append(t.amount > 0)
+    if date_from is not None:
+        where.append(t.timestamp >= date_from)
+    if date_to is not None:
+        where.append(t.timestamp < date_to)
+    if account_id is not None:
+        where.append(t.account_id == account_id)
+    if category_id is not None:
+        where.append(t.category_id == category_id)
+    target = (currency or reporting_currency(convert_to)).upper()
+    currencies = [target] if currency else sorted(s.exec(select(t.currency).where(*where).distinct()).all())
+
+    convert = Converter(s)
+    parts = []
+    for cur in currencies:
+        stmt = select(
+            period_expr(s, "day"), t.amount, func.coalesce(t.category_id, NONE_ID), func.coalesce(t.account_id, NONE_ID),
+        ).where(t.currency == cur, *where)
+        cols = _read(s, stmt, chunk)
+        parts.append(cols._replace(amount=_to_common(cols, cur, target, convert)))
+    cols = Columns(*(np.concatenate(a) for a in zip(*parts))) if parts else _empty()
+    if kind == "expenses":
+        np.negative(cols.amount, out=cols.amount)
+    return cols
+
+
+def _read(s: Session, stmt, chunk: int) -> Columns:
+    cols = _empty()
+    size = 0
+    # Read the DBAPI cursor directly: building a Row object per transaction
+    # costs more than the query and the array conversion together.
+    result = s.connection().execute(stmt)
+    while True:
+        part = result.cursor.fetchmany(chunk)
+        if not part:
+            break
+        n = len(part)
+        if size + n > len(cols.day):
+            capacity = max(2 * len(cols.day), size + n)
+            cols = Columns(*(np.resize(a, capacity) for a in cols))
+        days, amounts, categories, accounts = zip(*part)
+        cols.day[size:size + n] = np.array(days, dtype="datetime64[D]")
+        cols.amount[size:size + n] = np.fromiter(amounts, np.int64, n)
+        cols.category_id[size:size + n] = np.fromiter(categories, np.int64, n)
+        cols.account_id[size:size + n] = np.fromiter(accounts, np.int64, n)
+        size += n
+    result.close()
+    return Columns(*(a[:size] for a in cols))
+
+
+def _to_common(cols: Columns, currency: str, target: str, convert: Converter) -> np.ndarray:
+    """Minor units of `currency` -> COMMON_EXPONENT units of `target`, one rate per (currency, month)."""
+    scale = 10 ** (COMMON_EXPONENT - exponent(currency))
+    if currency.upper() == target or not len(cols.amount):
+        return cols.amount * scale
+    months, idx = np.unique(cols.day.astype("datetime64[M]"), return_inverse=True)
+    factors = np.array([
+        float(convert.rate(currency, target, period_end(str(m)))) * scale for m in months
+    ])
+    return np.rint(cols.amount * factors[idx]).astype(np.int64)
+
+
+def _bins(day: np.ndarray, freq: str):
+    """(period start of every row, step between consecutive periods, unit)."""
+    if freq == "month":
+        return day.astype("datetime64[M]"), 1, "M"
+    if freq == "week":
+        return day - (day.astype(np.int64) - _MONDAY) % 7, 7, "D"
+    return day, 1, "D"
+
+
+def _period_index(cols: Columns, freq: str):
+    if freq not in FREQS:
+        raise HTTPException(status_code=400, detail=f"unsupported freq: {freq}")
+    bins, step, unit = _bins(cols.day, freq)
+    if not len(bins):
+        return np.empty(0, f"datetime64[{unit}]"), np.empty(0, np.int64)
+    first, last = bins.min(), bins.max()
+    periods = np.arange(first, last + step, step)
+    return periods, (bins - first).astype(np.int64) // step
+
+
+def resample(cols: Columns, freq: str = "day") -> Series:
+    """Totals and transaction counts per period, from the first to the last period with data."""
+    periods, idx = _period_index(cols, freq)
+    n = len(periods)
+    totals = np.bincount(idx, weights=cols.amount, minlength=n) / 10 ** COMMON_EXPONENT
+    return Series(periods, totals, np.bincount(idx, minlength=n))
+
+
+def rolling(values: np.ndarray, window: int) -> np.ndarray:
+    """Trailing mean over `window` periods; the first periods average what there is."""
+    csum = np.concatenate(([0.0], np.cumsum(values, dtype=np.float64)))
+    end = np.arange(1, len(values) + 1)
+    start = np.maximum(end - window, 0)
+    return (csum[end] - csum[start]) / (end - start)
+
+
+def _sorted_within(group: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """`values` ordered by (group, value)."""
+    if not len(values):
+        return values
+    low = values.min()
+    span = int(values.max()) - int(low)
+    if span < 1 << 40 and int(group.max()) < 1 << 22:
+        # One int64 sort of packed (group, value) keys is several times
+        # faster than lexsort over two arrays.
+        packed = np.sort((group << 40) | (values - low))
+        return (packed & ((1 << 40) - 1)) + low
+    return values[np.lexsort((values, group))]
+
+
+def percentiles(cols: Columns, freq: str = "month", qs: Sequence[float] = (50, 90)) -> Dict[float, np.ndarray]:
+    """Per-period percentiles of single transaction amounts (linear interpolation, NaN for empty periods)."""
+    periods, idx = _period_index(cols, freq)
+    n = len(periods)
+    amounts = _sorted_within(idx, cols.amount) / 10 ** COMMON_EXPONENT
+    counts = np.bincount(idx, minlength=n)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1])) if n else np.empty(0, np.int64)
+    has = counts > 0
+    result = {}
+    for q in qs:
+        out = np.full(n, np.nan)
+        pos = starts[has] + (counts[has] - 1) * (q / 100)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, starts[has] + counts[has] - 1)
+        out[has] = amounts[lo] + (amounts[hi] - amounts[lo]) * (pos - lo)
+        result[q] = out
+    return result
+
+
+def default_through(year: int, today: date) -> date:
+    """`today` for its own year, else the last day of `year`."""
+    return today if year == today.year else date(year, 12, 31)
+
+
+def _same_day(year: int, through: date) -> date:
+    """`through`'s month and day in `year`; Feb 29 becomes Feb 28 in a common year."""
+    return date(year, through.month, min(through.day, calendar.monthrange(year, through.month)[1]))
+
+
+def year_over_year(cols: Columns, year: int, through: date) -> List[dict]:
+    """Per-category totals of `year` and of the same span of `year - 1`, biggest current total first.
+
+    Both years are cut at `through`'s month and day (see `default_through`),
+    so a year in progress is compared with the same part of the previous one.
+    """
+    years = cols.day.astype("datetime64[Y]").astype(np.int64) + 1970
+    mask = (
+        ((years == year) & (cols.day <= np.datetime64(_same_day(year, through), "D")))
+        | ((years == year - 1) & (cols.day <= np.datetime64(_same_day(year - 1, through), "D")))
+    )
+    slot = (cols.category_id[mask] - NONE_ID) * 2 + (years[mask] == year)
+    size = int(slot.max()) + 1 if len(slot) else 0
+    sums = np.bincount(slot, weights=cols.amount[mask], minlength=size) / 10 ** COMMON_EXPONENT
+    present = np.bincount(slot, minlength=size).reshape(-1, 2).any(axis=1)
+    items = []
+    for k in np.flatnonzero(present).tolist():
+        previous, current = sums[2 * k], sums[2 * k + 1]
+        cat = k + NONE_ID
+        items.append({
+            "category_id": None if cat == NONE_ID else cat,
+            "current": current,
+            "previous": previous,
+            "change_pct": round((current - previous) / abs(previous) * 100, 1) if previous else None,
+        })
+    return sorted(items, key=lambda i: -i["current"])
+
+
+def labels(periods: np.ndarray) -> List[str]:
+    """ISO dates (YYYY-MM for months) of period starts."""
+    return [str(p) for p in np.datetime_as_string(periods)]
+
+
+def _row_loop(rows, window: int):
+    """The same reports computed row by row in plain Python, as a baseline for `bench`."""
+    daily = defaultdict(int)
+    monthly = defaultdict(list)
+    by_year = defaultdict(int)
+    for day, amount, category_id, _ in rows:
+        amount = -amount
+        daily[day] += amount
+        monthly[day[:7]].append(amount)
+        by_year[(day[:4], category_id)] += amount
+    days = []
+    d = date.fromisoformat(min(daily))
+    last = date.fromisoformat(max(daily))
+    while d <= last:
+        days.append(daily.get(d.isoformat(), 0) / 10 ** COMMON_EXPONENT)
+        d = date.fromordinal(d.toordinal() + 1)
+    moving = []
+    total = 0.0
+    for i, v in enumerate(days):
+        total += v
+        if i >= window:
+            total -= days[i - window]
+        moving.append(total / min(i + 1, window))
+    medians = {}
+    for month, amounts in monthly.items():
+        amounts.sort()
+        pos = (len(amounts) - 1) * 0.5
+        lo = int(pos)
+        hi = min(lo + 1, len(amounts) - 1)
+        medians[month] = (amounts[lo] + (amounts[hi] - amounts[lo]) * (pos - lo)) / 10 ** COMMON_EXPONENT
+    return days, moving, medians, by_year
+
+
+def bench(rows: int = 1_000_000, window: int = 30):
+    """Vectorized reports vs the row loop on a synthetic ledger; also checks they agree."""
+    from sqlalchemy import text
+    from sqlmodel import SQLModel, create_engine
+    from sqlmodel.pool import StaticPool
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as s:
+        s.execute(text(
+            "WITH RECURSIVE seq(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM seq WHERE i < :last) "
+            'INSERT INTO "transaction" (amount, currency, timestamp, account_id, category_id) '
+            "SELECT -((i * 7919) % 90000) - 100, 'USD', datetime('2021-01-01', '+' || (i * 35040 / :last) || ' hours') || '.000000', "
+            "i % 5 + 1, i % 12 + 1 FROM seq"
+        ), {"last": rows - 1})
+        s.commit()
+
+        started = time.perf_counter()
+        cols = load(s)
+        load_s = time.perf_counter() - started
+        started = time.perf_counter()
+        series = resample(cols, "day")
+        moving = rolling(series.totals, window)
+        monthly = percentiles(cols, "month", (50,))
+        weekly = resample(cols, "week")
+        yoy = year_over_year(cols, 2024, date(2024, 12, 31))
+        numpy_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        raw = s.exec(select(
+            period_expr(s, "day"), common_units(Transaction.amount, Transaction.currency),
+            Transaction.category_id, Transaction.account_id,
+        ).where(Transaction.amount < 0)).all()
+        fetch_s = time.perf_counter() - started
+        started = time.perf_counter()
+        days, loop_moving, medians, by_year = _row_loop(raw, window)
+        loop_s = time.perf_counter() - started
+
+        assert np.allclose(series.totals, days) and np.allclose(moving, loop_moving)
+        assert np.allclose(monthly[50], [medians[m] for m in labels(_period_index(cols, "month")[0])])
+        assert all(abs(i["previous"] * 10 ** COMMON_EXPONENT - by_year[("2023", i["category_id"])]) < 1 for i in yoy)
+    print(f"{len(cols.day)} transactions, {len(series.periods)} days, {len(weekly.periods)} weeks")
+    print(f"load into arrays ({CHUNK}-row chunks): {load_s * 1000:.0f} ms; fetch as row tuples: {fetch_s * 1000:.0f} ms")
+    print(f"daily + weekly resample, {window}-day rolling mean, monthly median, year over year:")
+    print(f"  numpy {numpy_s * 1000:.1f} ms, row loop {loop_s * 1000:.1f} ms ({loop_s / numpy_s:.0f}x)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m backend.analytics")
+    sub = parser.add_subparsers(dest="command", required=True)
+    b = sub.add_parser("bench", help="vectorized reports vs a Python row loop on synthetic transactions")
+    b.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args(argv)
+    bench(args.rows)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""Managed store for generated report files (charts) under backend/reports.
+
+Artifacts are addressed by name (charts use their content hash, see
+utils.chart_key). The store tracks size and last access per file and
+evicts expired entries first, then least-recently-used ones, whenever the
+total exceeds its byte budget. Each process keeps its own index, built from
+a directory scan at start; files written by another worker are adopted on
+first lookup.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+DEFAULT_MAX_BYTES = int(os.getenv("HOMEBUH_REPORTS_MAX_BYTES", str(200 * 1024 * 1024)))
+DEFAULT_TTL_SECONDS = float(os.getenv("HOMEBUH_REPORTS_TTL", str(7 * 24 * 3600)))
+
+
+class ArtifactStore:
+    def __init__(self, root: Path, max_bytes: int = DEFAULT_MAX_BYTES, ttl_seconds: Optional[float] = DEFAULT_TTL_SECONDS):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # name -> (size, last_access); ordered from least to most recently used
+        self._index: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self._scan()
+
+    def _scan(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for p in self.root.iterdir():
+            if p.is_file() and not p.name.startswith("."):
+                st = p.stat()
+                entries.append((st.st_mtime, p.name, st.st_size))
+        with self._lock:
+            for mtime, name, size in sorted(entries):
+                self._index[name] = (size, mtime)
+                self._bytes += size
+            self._evict_locked(keep=None)
+
+    def path(self, name: str) -> Path:
+        return self.root / name
+
+    def get(self, name: str) -> Optional[Path]:
+        """Return the artifact's path and mark it used, or None (a miss)."""
+        now = time.time()
+        with self._lock:
+            entry = self._index.get(name)
+            if entry is not None and self._expired(entry, now):
+                self._remove_locked(name)
+                entry = None
+            if entry is None:
+                entry = self._adopt_locked(name, now)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._index[name] = (entry[0], now)
+            self._index.move_to_end(name)
+            self.hits += 1
+            return self.root / name
+
+    def add(self, name: str) -> Optional[Path]:
+        """Register a file just written under root, then enforce the budget."""
+        p = self.root / name
+        try:
+            size = p.stat().st_size
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            old = self._index.pop(name, None)
+            if old is not None:
+                self._bytes -= old[0]
+            self._index[name] = (size, time.time())
+            self._bytes += size
+            self._evict_locked(keep=name)
+        return p
+
+    def evict(self):
+        with self._lock:
+            self._evict_locked(keep=None)
+
+    def metrics(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "artifacts": len(self._index),
+                "bytes_stored": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+            }
+
+    def _expired(self, entry, now) -> bool:
+        return self.ttl_seconds is not None and now - entry[1] > self.ttl_seconds
+
+    def _adopt_locked(self, name: str, now: float):
+        p = self.root / name
+        if "/" in name or name.startswith(".") or not p.is_file():
+            return None
+        entry = (p.stat().st_size, now)
+        self._index[name] = entry
+        self._bytes += entry[0]
+        return entry
+
+    def _remove_locked(self, name: str):
+        size, _ = self._index.pop(name)
+        self._bytes -= size
+        self.evictions += 1
+        self.evicted_bytes += size
+        try:
+            (self.root / name).unlink()
+        except FileNotFoundError:
+            pass
+
+    def _evict_locked(self, keep: Optional[str]):
+        now = time.time()
+        for name, entry in list(self._index.items()):
+            if name != keep and self._expired(entry, now):
+                self._remove_locked(name)
+        for name in list(self._index):
+            if self._bytes <= self.max_bytes:
+                break
+            if name != keep:
+                self._remove_locked(name)
@@ -0,0 +1,272 @@
+"""Account balances derived from the ledger.
+
+An account's balance is its `opening_balance` plus the sum of its
+transactions in the account's currency. `Account.balance` caches that sum:
+every ledger write (`create_transaction`, bulk import, transfers) moves it
+with an atomic `balance = balance + :delta` in the same DB transaction, the
+way rollup.py maintains MonthlyRollup.
+
+`BalanceSnapshot` stores the balance at the start of each month, so
+"balance as of X" is the latest snapshot before X plus an indexed scan of
+the transactions since then. A write dated before a snapshot deletes the
+account's later snapshots; `snapshot` recreates them incrementally.
+
+`verify` compares the cached balances with the ledger: by default from the
+pre-summed MonthlyRollup rows (cost grows with months, not transactions),
+with `full` from Transaction itself.
+
+    python -m backend.balances snapshot
+    python -m backend.balances verify [--full] [--repair]
+    python -m backend.balances bench [--rows 1000000]
+"""
+import argparse
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import and_, delete, func, insert, update
+from sqlmodel import Session, select
+
+from .aggregates import period_expr
+from .forecast import add_months
+from .models import Account, BalanceSnapshot, MonthlyRollup, Transaction
+from .money import to_major
+
+
+def invalidate_snapshots(s: Session, earliest: Dict[int, datetime]):
+    """Drop snapshots that a write dated `earliest[account_id]` makes stale. Does not commit."""
+    for account_id, ts in earliest.items():
+        s.exec(
+            delete(BalanceSnapshot)
+            .where(BalanceSnapshot.account_id == account_id, BalanceSnapshot.as_of > ts)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def apply_mappings(s: Session, rows: Iterable[dict]):
+    """Move the cached balances by new ledger rows (column dicts). Does not commit.
+
+    Rows in a currency other than their account's do not change its balance.
+    """
+    deltas: Dict[tuple, int] = defaultdict(int)
+    earliest: Dict[int, datetime] = {}
+    for r in rows:
+        account_id = r.get("account_id")
+        if account_id is None:
+            continue
+        deltas[(account_id, r.get("currency") or "USD")] += r["amount"]
+        ts = r["timestamp"]
+        earliest[account_id] = min(earliest.get(account_id, ts), ts)
+    a = Account
+    for (account_id, currency), delta in deltas.items():
+        if delta:
+            s.exec(
+                update(a)
+                .where(a.id == account_id, a.currency == currency)
+                .values(balance=a.balance + delta)
+                .execution_options(synchronize_session=False)
+            )
+    invalidate_snapshots(s, earliest)
+
+
+def apply_many(s: Session, txs: Iterable[Transaction]):
+    apply_mappings(s, (
+        {"account_id": t.account_id, "currency": t.currency, "amount": t.amount, "timestamp": t.timestamp} for t in txs
+    ))
+
+
+def apply(s: Session, tx: Transaction):
+    apply_many(s, [tx])
+
+
+def _in_account_currency():
+    return and_(Transaction.account_id == Account.id, Transaction.currency == Account.currency)
+
+
+def balance_as_of(s: Session, account_id: int, at: datetime) -> dict:
+    """Balance including every transaction dated before `at`, in minor units."""
+    acc = s.get(Account, account_id)
+    if acc is None:
+        raise HTTPException(status_code=404, detail="account not found")
+    snap = s.exec(
+        select(BalanceSnapshot)
+        .where(BalanceSnapshot.account_id == account_id, BalanceSnapshot.as_of <= at)
+        .order_by(BalanceSnapshot.as_of.desc())
+        .limit(1)
+    ).first()
+    t = Transaction
+    stmt = select(func.coalesce(func.sum(t.amount), 0), func.count(t.id)).where(
+        t.account_id == account_id, t.currency == acc.currency, t.timestamp < at
+    )
+    if snap is not None:
+        stmt = stmt.where(t.timestamp >= snap.as_of)
+    delta, scanned = s.exec(stmt).one()
+    return {
+        "account_id": account_id,
+        "currency": acc.currency,
+        "as_of": at,
+        "balance": (snap.balance if snap else acc.opening_balance) + delta,
+        "snapshot": snap.as_of if snap else None,
+        "scanned": scanned,
+    }
+
+
+def _month_start(d: datetime) -> datetime:
+    return datetime(d.year, d.month, 1)
+
+
+def snapshot(s: Session, upto: Optional[datetime] = None) -> int:
+    """Add month-start snapshots up to `upto` (default: this month) and commit. Returns rows added.
+
+    Incremental: each account continues from its latest snapshot, so a
+    periodic run only sums the transactions of the months since.
+    """
+    upto = _month_start(upto or datetime.utcnow())
+    t, bs = Transaction, BalanceSnapshot
+    month = period_expr(s, "month", t.timestamp)
+    latest = dict(s.exec(select(bs.account_id, func.max(bs.as_of)).group_by(bs.account_id)).all())
+    new = []
+    for acc in s.exec(select(Account)).all():
+        last = latest.get(acc.id)
+        if last is not None and last >= upto:
+            continue
+        stmt = select(month, func.sum(t.amount)).where(t.account_id == acc.id, t.currency == acc.currency, t.timestamp < upto)
+        if last is not None:
+            stmt = stmt.where(t.timestamp >= last)
+        sums = dict(s.exec(stmt.group_by(month)).all())
+        if last is not None:
+            running = s.get(bs, (acc.id, last)).balance
+            cursor = last
+        else:
+            running = acc.opening_balance
+            cursor = datetime.strptime(min(sums), "%Y-%m") if sums else upto
+            if not sums:
+                new.append({"account_id": acc.id, "as_of": upto, "balance": running})
+        while cursor < upto:
+            running += sums.get(cursor.strftime("%Y-%m"), 0)
+            cursor = add_months(cursor, 1)
+            new.append({"account_id": acc.id, "as_of": cursor, "balance": running})
+    if new:
+        s.execute(insert(bs.__table__), new)
+    s.commit()
+    return len(new)
+
+
+def verify(s: Session, full: bool = False) -> List[dict]:
+    """Accounts whose cached balance differs from the ledger."""
+    if full:
+        ledger = (
+            select(func.sum(Transaction.amount)).where(_in_account_currency()).correlate(Account).scalar_subquery()
+        )
+    else:
+        r = MonthlyRollup
+        ledger = (
+            select(func.sum(r.total))
+            .where(r.account_id == Account.id, r.currency == Account.currency)
+            .correlate(Account)
+            .scalar_subquery()
+        )
+    expected = (Account.opening_balance + func.coalesce(ledger, 0)).label("expected")
+    rows = s.exec(
+        select(Account.id, Account.name, Account.currency, Account.balance, expected)
+        .where(Account.balance != expected)
+        .order_by(Account.id)
+    ).all()
+    return [
+        {
+            "account_id": acc_id, "name": name, "currency": currency,
+            "stored": to_major(stored, currency), "ledger": to_major(exp, currency),
+            "drift": to_major(stored - exp, currency),
+        }
+        for acc_id, name, currency, stored, exp in rows
+    ]
+
+
+def repair(s: Session) -> int:
+    """Reset every cached balance to its ledger value and commit. Returns accounts changed."""
+    ledger = select(func.sum(Transaction.amount)).where(_in_account_currency()).correlate(Account).scalar_subquery()
+    expected = Account.opening_balance + func.coalesce(ledger, 0)
+    changed = s.exec(
+        update(Account).where(Account.balance != expected).values(balance=expected).execution_options(synchronize_session=False)
+    ).rowcount
+    s.commit()
+    return changed
+
+
+def bench(rows: int = 1_000_000, accounts: int = 10):
+    """Time drift checks and as-of lookups on a synthetic ledger, with and without helpers."""
+    from sqlalchemy import text
+    from sqlmodel import SQLModel, create_engine
+    from sqlmodel.pool import StaticPool
+
+    from . import rollup
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as s:
+        s.execute(insert(Account.__table__), [{"name": f"bench-{i}", "balance": 0, "opening_balance": 0, "currency": "USD"} for i in range(accounts)])
+        s.execute(text(
+            "WITH RECURSIVE seq(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM seq WHERE i < :last) "
+            'INSERT INTO "transaction" (amount, currency, timestamp, account_id) '
+            "SELECT (i * 7919) % 350001 - 250000, 'USD', datetime('2015-01-01', '+' || (i * 60 / :n) || ' hours') || '.000000', i % :accounts + 1 FROM seq"
+        ), {"last": rows - 1, "n": max(1, rows // 1000), "accounts": accounts})
+        s.commit()
+        rollup.rebuild(s)
+        repair(s)
+
+        def timed(fn):
+            started = time.perf_counter()
+            result = fn()
+            return result, (time.perf_counter() - started) * 1000
+
+        _, full_ms = timed(lambda: verify(s, full=True))
+        _, quick_ms = timed(lambda: verify(s))
+        at = s.exec(select(func.max(Transaction.timestamp))).one()
+        plain, plain_ms = timed(lambda: balance_as_of(s, 1, at))
+        added, snap_ms = timed(lambda: snapshot(s, upto=at))
+        snapped, snapped_ms = timed(lambda: balance_as_of(s, 1, at))
+        assert plain["balance"] == snapped["balance"]
+    print(f"{rows} transactions, {accounts} accounts")
+    print(f"verify: full scan {full_ms:.1f} ms, from MonthlyRollup {quick_ms:.1f} ms")
+    print(
+        f"balance as of {at:%Y-%m-%d}: full history {plain_ms:.1f} ms ({plain['scanned']} rows), "
+        f"snapshot + delta {snapped_ms:.1f} ms ({snapped['scanned']} rows); {added} snapshots built in {snap_ms:.1f} ms"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m backend.balances")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("snapshot", help="add month-start balance snapshots up to the current month")
+    v = sub.add_parser("verify", help="compare cached balances with the ledger")
+    v.add_argument("--full", action="store_true", help="sum Transaction instead of MonthlyRollup")
+    v.add_argument("--repair", action="store_true", help="reset drifted balances to the ledger value")
+    b = sub.add_parser("bench", help="drift check and as-of lookup timings on a synthetic ledger")
+    b.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args(argv)
+
+    if args.command == "bench":
+        bench(args.rows)
+        return 0
+    from .db import engine, init_db
+
+    init_db()
+    with Session(engine) as s:
+        if args.command == "snapshot":
+            print(f"added {snapshot(s)} balance snapshots")
+            return 0
+        drifted = verify(s, full=args.full)
+        for d in drifted:
+            print(f"account {d['account_id']} ({d['name']}): stored {d['stored']} {d['currency']}, ledger {d['ledger']}, drift {d['drift']}")
+        if drifted and args.repair:
+            print(f"repaired {repair(s)} accounts")
+            return 0
+        print("no drift" if not drifted else f"{len(drifted)} accounts drifted")
+        return 1 if drifted else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""Budget vs actual spending.
+
+Actual spending comes from MonthlyRollup summed over each budgeted
+category's subtree (via CategoryClosure), so a month's status costs two
+queries (budgets, then spending grouped by budget) whose size depends on the
+number of categories, not on how many transactions have ever been recorded. A budget without a category is an
+overall limit and is compared with all spending of the month. Amounts are
+summed per currency as integers and converted into one currency (fx.py).
+"""
+import calendar
+from collections import defaultdict
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Optional
+
+from sqlalchemy import func, select
+from sqlmodel import Session
+
+from .aggregates import UNCATEGORIZED, month_bounds
+from .fx import Converter, period_end, reporting_currency, round_to
+from .models import Budget, Category, CategoryClosure, MonthlyRollup
+from .money import to_major
+
+TOTAL_LABEL = "Total"
+
+
+def _days(year_month: str, today: date):
+    """(days in month, days elapsed as of `today`)."""
+    start, _ = month_bounds(year_month)
+    days = calendar.monthrange(start.year, start.month)[1]
+    if (today.year, today.month) < (start.year, start.month):
+        return days, 0
+    if (today.year, today.month) > (start.year, start.month):
+        return days, days
+    return days, today.day
+
+
+def budget_status(
+    s: Session, year_month: str, currency: Optional[str] = None, today: Optional[date] = None,
+    convert_to: Optional[str] = None,
+) -> dict:
+    """Budget, actual, remaining and burn rate per budgeted category for one month.
+
+    Amounts are in `currency` when it is given (spending in other currencies
+    is left out), else in the reporting currency (fx.reporting_currency).
+    Budgets and spending in another currency are converted at the rate in
+    effect at the month's end. Raises MissingRate.
+    """
+    today = today or datetime.utcnow().date()
+    days, elapsed = _days(year_month, today)
+    target = (currency or reporting_currency(convert_to)).upper()
+    on = period_end(year_month)
+    convert = Converter(s)
+    r, cc = MonthlyRollup, CategoryClosure
+
+    def total(rows) -> Decimal:
+        return round_to(sum((to_major(v, cur) * convert.rate(cur, target, on) for cur, v in rows), Decimal(0)), target)
+
+    budgeted = defaultdict(list)
+    names = {}
+    for category_id, name, cur, amount in s.exec(
+        select(Budget.category_id, Category.name, Budget.currency, func.sum(Budget.amount))
+        .outerjoin(Category, Category.id == Budget.category_id)
+        .where(Budget.year_month == year_month)
+        .group_by(Budget.category_id, Category.name, Budget.currency)
+    ):
+        budgeted[category_id].append((cur, amount))
+        names[category_id] = name
+    if not budgeted:
+        return {"year_month": year_month, "days_in_month": days, "days_elapsed": elapsed, "currency": target, "items": []}
+
+    month = r.year_month == year_month
+    if currency:
+        month = month & (r.currency == currency)
+    # Minor units per (budgeted category, currency) in one pass: every rollup
+    # row of the month is paired with each budgeted category and kept when the
+    # closure says it lies in that category's subtree; the None budget (an
+    # overall limit) keeps them all.
+    b = select(Budget.category_id).where(Budget.year_month == year_month).distinct().subquery()
+    spent = defaultdict(list)
+    for category_id, cur, v in s.exec(
+        select(b.c.category_id, r.currency, func.sum(r.expense_total))
+        .select_from(b)
+        .join(r, month)
+        .outerjoin(cc, (cc.ancestor_id == b.c.category_id) & (cc.descendant_id == r.category_id))
+        .where(b.c.category_id.is_(None) | cc.ancestor_id.is_not(None))
+        .group_by(b.c.category_id, r.currency)
+    ):
+        spent[category_id].append((cur, v))
+
+    items = []
+    cent = Decimal("0.01")
+    order = sorted(budgeted, key=lambda c: (c is None, names[c] or ""))
+    for category_id in order:
+        amount, actual = total(budgeted[category_id]), total(spent[category_id])
+        burn = actual / elapsed if elapsed else Decimal(0)
+        projected = actual + burn * (days - elapsed)
+        items.append({
+            "category_id": category_id,
+            "category": (names[category_id] or UNCATEGORIZED) if category_id is not None else TOTAL_LABEL,
+            "budget": amount,
+            "actual": actual,
+            "remaining": amount - actual,
+            "percent_used": round(float(actual / amount * 100), 2) if amount else None,
+            "daily_burn": burn.quantize(cent),
+            "projected": projected.quantize(cent),
+            "over_budget": actual > amount,
+        })
+    return {"year_month": year_month, "days_in_month": days, "days_elapsed": elapsed, "currency": target, "items": items}
@@ -0,0 +1,299 @@
+"""Category tree index and subtree totals.
+
+Category keeps its adjacency list (`parent_id`); `CategoryClosure` adds one
+row per (ancestor, descendant) pair, self pairs included, so "everything
+under Food" is a single join instead of a recursive walk with lazy loads.
+`add`, `move` and `delete` keep the closure in step with the tree inside
+the caller's session. `rebuild` recomputes it with a recursive CTE for
+databases created before it existed:
+
+    python -m backend.categories rebuild
+    python -m backend.categories bench [--depth 200] [--width 2000] [--months 12]
+"""
+import argparse
+import random
+import sys
+import time
+from decimal import Decimal
+from typing import List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import case, delete, func, insert, literal, select, true, update
+from sqlalchemy.orm import aliased
+from sqlmodel import Session
+
+from . import rollup
+from .aggregates import month_bounds
+from .fx import Converter, period_end, reporting_currency, round_to
+from .models import Budget, Category, CategoryClosure, CategoryRule, MonthlyRollup, PlannedItem, Transaction
+from .money import common_units, from_common, to_major
+
+CLOSURE_COLUMNS = ["ancestor_id", "descendant_id", "depth"]
+
+
+def add(s: Session, c: Category):
+    """Index a flushed category (it must have an id) under its parent. Does not commit."""
+    cc = CategoryClosure
+    s.exec(insert(cc).values(ancestor_id=c.id, descendant_id=c.id, depth=0))
+    if c.parent_id is not None:
+        s.exec(insert(cc).from_select(
+            CLOSURE_COLUMNS,
+            select(cc.ancestor_id, literal(c.id), cc.depth + 1).where(cc.descendant_id == c.parent_id),
+        ))
+
+
+def subtree_ids(s: Session, category_id: int) -> List[int]:
+    cc = CategoryClosure
+    return list(s.exec(select(cc.descendant_id).where(cc.ancestor_id == category_id)).scalars())
+
+
+def move(s: Session, c: Category, parent_id: Optional[int]):
+    """Re-parent `c` with its whole subtree. Does not commit."""
+    if parent_id == c.parent_id:
+        return
+    cc = CategoryClosure
+    subtree = select(cc.descendant_id).where(cc.ancestor_id == c.id).scalar_subquery()
+    if parent_id is not None:
+        if s.get(Category, parent_id) is None:
+            raise HTTPException(status_code=404, detail="parent category not found")
+        if s.exec(select(cc.depth).where(cc.ancestor_id == c.id, cc.descendant_id == parent_id)).first() is not None:
+            raise HTTPException(status_code=400, detail="cannot move a category under itself or its descendant")
+
+    # Detach: drop every path that enters the subtree from outside.
+    s.exec(
+        delete(cc)
+        .where(cc.descendant_id.in_(subtree), cc.ancestor_id.notin_(subtree))
+        .execution_options(synchronize_session=False)
+    )
+    # Attach: each ancestor of the new parent (itself included) reaches each node of the subtree.
+    if parent_id is not None:
+        up, down = aliased(cc), aliased(cc)
+        s.exec(insert(cc).from_select(
+            CLOSURE_COLUMNS,
+            select(up.ancestor_id, down.descendant_id, up.depth + down.depth + 1)
+            .join_from(up, down, true())
+            .where(up.descendant_id == parent_id, down.ancestor_id == c.id),
+        ))
+    c.parent_id = parent_id
+    s.add(c)
+
+
+def delete_subtree(s: Session, c: Category) -> int:
+    """Delete `c` and all its descendants. Does not commit; returns the number of categories removed.
+
+    Transactions and planned items that pointed into the subtree become
+    uncategorized (their rollup rows are folded into the uncategorized
+    bucket); budgets and categorization rules for the removed categories
+    are dropped.
+    """
+    ids = subtree_ids(s, c.id) or [c.id]
+    opts = {"synchronize_session": False}
+    s.exec(update(Transaction).where(Transaction.category_id.in_(ids)).values(category_id=None).execution_options(**opts))
+    s.exec(update(PlannedItem).where(PlannedItem.category_id.in_(ids)).values(category_id=None).execution_options(**opts))
+    s.exec(delete(Budget).where(Budget.category_id.in_(ids)).execution_options(**opts))
+    s.exec(delete(CategoryRule).where(CategoryRule.category_id.in_(ids)).execution_options(**opts))
+    rollup.reassign_categories(s, ids, None)
+    s.exec(delete(CategoryClosure).where(CategoryClosure.descendant_id.in_(ids)).execution_options(**opts))
+    s.exec(delete(Category).where(Category.id.in_(ids)).execution_options(**opts))
+    s.expunge(c)
+    return len(ids)
+
+
+def rebuild(s: Session) -> int:
+    """Recompute the closure table from Category.parent_id and commit. Returns the row count."""
+    walk = (
+        select(Category.id.label("ancestor_id"), Category.id.label("descendant_id"), literal(0).label("depth"))
+        .cte("walk", recursive=True)
+    )
+    child = aliased(Category)
+    walk = walk.union_all(
+        select(walk.c.ancestor_id, child.id, walk.c.depth + 1).where(child.parent_id == walk.c.descendant_id)
+    )
+    s.exec(delete(CategoryClosure))
+    s.exec(insert(CategoryClosure).from_select(CLOSURE_COLUMNS, select(walk.c.ancestor_id, walk.c.descendant_id, walk.c.depth)))
+    s.commit()
+    return s.exec(select(func.count()).select_from(CategoryClosure)).scalar_one()
+
+
+def ensure_built(s: Session):
+    """Backfill the closure once for databases created before it existed."""
+    has_closure = s.exec(select(CategoryClosure.ancestor_id).limit(1)).first() is not None
+    has_categories = s.exec(select(Category.id).limit(1)).first() is not None
+    if has_categories and not has_closure:
+        rebuild(s)
+
+
+def _kind_columns(kind: str):
+    r = MonthlyRollup
+    if kind == "expenses":
+        return r.expense_total, r.expense_count
+    if kind == "income":
+        return r.income_total, r.income_count
+    return r.total, r.count
+
+
+def tree(
+    s: Session,
+    kind: str = "expenses",
+    month_from: Optional[str] = None,
+    month_to: Optional[str] = None,
+    currency: Optional[str] = None,
+    convert_to: Optional[str] = None,
+) -> List[dict]:
+    """Full category tree with own and subtree totals for months [month_from, month_to].
+
+    Per-category sums come from MonthlyRollup and are fanned out to every
+    ancestor through the closure table, both grouped by currency and, for
+    currencies other than the target, by month. Totals are in `currency`
+    when it is given (amounts in other currencies are left out), else in
+    the reporting currency; each month is converted at its month-end rate
+    (fx.py). The nesting is assembled in Python in a single pass. Raises
+    MissingRate.
+    """
+    r, cc = MonthlyRollup, CategoryClosure
+    for ym in (month_from, month_to):
+        if ym:
+            month_bounds(ym)  # validate format
+    target = (currency or reporting_currency(convert_to)).upper()
+    value, count = _kind_columns(kind)
+    # Months of the target currency need no rate, so they collapse into one group.
+    period = case((r.currency == target, None), else_=r.year_month)
+    own = select(
+        r.category_id.label("category_id"),
+        r.currency.label("currency"),
+        period.label("period"),
+        func.sum(value).label("total"),
+        func.sum(count).label("count"),
+    ).where(r.category_id.isnot(None))
+    if month_from:
+        own = own.where(r.year_month >= month_from)
+    if month_to:
+        own = own.where(r.year_month <= month_to)
+    if currency:
+        own = own.where(r.currency == currency)
+    own = own.group_by(r.category_id, r.currency, period).subquery("own")
+    sub = (
+        select(
+            cc.ancestor_id, own.c.currency, own.c.period,
+            func.sum(own.c.total), func.sum(own.c.count),
+        )
+        .join(own, own.c.category_id == cc.descendant_id)
+        .group_by(cc.ancestor_id, own.c.currency, own.c.period)
+    )
+
+    nodes = {}
+    for cid, name, parent_id in s.exec(select(Category.id, Category.name, Category.parent_id).order_by(Category.name, Category.id)):
+        nodes[cid] = {
+            "id": cid, "name": name, "parent_id": parent_id,
+            "total": Decimal(0), "count": 0,
+            "subtree_total": Decimal(0), "subtree_count": 0,
+            "currency": target, "children": [],
+        }
+    convert = Converter(s)
+    for prefix, stmt in (("", select(own.c.category_id, own.c.currency, own.c.period, own.c.total, own.c.count)), ("subtree_", sub)):
+        for cid, cur, ym, total, n in s.exec(stmt):
+            node = nodes.get(cid)
+            if node is None:
+                continue
+            rate = convert.rate(cur, target, period_end(ym)) if ym else Decimal(1)
+            node[prefix + "total"] += to_major(total, cur) * rate
+            node[prefix + "count"] += int(n)
+    roots = []
+    for node in nodes.values():
+        node["total"], node["subtree_total"] = round_to(node["total"], target), round_to(node["subtree_total"], target)
+        parent = nodes.get(node["parent_id"])
+        (parent["children"] if parent is not None else roots).append(node)
+    return roots
+
+
+def _naive_subtree_totals(s: Session, kind: str) -> dict:
+    # The pre-closure approach: walk relationships recursively, one query per node.
+    value, _ = _kind_columns(kind)
+    out = {}
+
+    def walk(c: Category) -> float:
+        own = s.exec(
+            select(func.coalesce(func.sum(common_units(value, MonthlyRollup.currency)), 0)).where(MonthlyRollup.category_id == c.id)
+        ).scalar_one()
+        total = own + sum(walk(child) for child in c.children)
+        out[c.id] = total
+        return total
+
+    for root in s.exec(select(Category).where(Category.parent_id.is_(None))).scalars():
+        walk(root)
+    return out
+
+
+def bench(depth: int = 200, width: int = 2000, months: int = 12, seed: int = 1):
+    """Compare `tree` with a recursive ORM walk on a deep chain and a wide fan-out."""
+    from sqlmodel import SQLModel, create_engine
+    from sqlmodel.pool import StaticPool
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), depth * 4 + 1000))
+    rnd = random.Random(seed)
+    for shape, size in (("deep", depth), ("wide", width)):
+        engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(engine)
+        with Session(engine) as s:
+            root = Category(name="root")
+            s.add(root)
+            s.flush()
+            add(s, root)
+            parent = root
+            for i in range(size):
+                c = Category(name=f"{shape}-{i}", parent_id=parent.id)
+                s.add(c)
+                s.flush()
+                add(s, c)
+                if shape == "deep":
+                    parent = c
+                for m in range(months):
+                    s.exec(insert(MonthlyRollup).values(
+                        year_month=f"2024-{m % 12 + 1:02d}", category_id=c.id, currency="USD",
+                        total=-1000, count=1, min_amount=-1000, max_amount=-1000,
+                        expense_total=rnd.randint(100, 10000), expense_count=1,
+                    ))
+            s.commit()
+            root_id = root.id
+
+            started = time.perf_counter()
+            roots = tree(s)
+            tree_ms = (time.perf_counter() - started) * 1000
+            s.expunge_all()
+            started = time.perf_counter()
+            naive = _naive_subtree_totals(s, "expenses")
+            naive_ms = (time.perf_counter() - started) * 1000
+            assert roots[0]["subtree_total"] == from_common(naive[root_id])
+            started = time.perf_counter()
+            rows = rebuild(s)
+            rebuild_ms = (time.perf_counter() - started) * 1000
+        print(
+            f"{shape:>4}: {size + 1} categories, {rows} closure rows | "
+            f"tree {tree_ms:.1f} ms, recursive walk {naive_ms:.1f} ms, rebuild {rebuild_ms:.1f} ms"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m backend.categories")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("rebuild", help="recompute the category closure table")
+    b = sub.add_parser("bench", help="benchmark subtree totals on synthetic deep and wide trees")
+    b.add_argument("--depth", type=int, default=200)
+    b.add_argument("--width", type=int, default=2000)
+    b.add_argument("--months", type=int, default=12)
+    args = parser.parse_args(argv)
+
+    if args.command == "bench":
+        bench(args.depth, args.width, args.months)
+        return 0
+    from .db import engine, init_db
+
+    init_db()
+    with Session(engine) as s:
+        rows = rebuild(s)
+    print(f"category closure rebuilt: {rows} rows")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
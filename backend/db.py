@@ -1,12 +1,206 @@
-from sqlmodel import SQLModel, create_engine, Session
+import logging
+import os
 from pathlib import Path
 
+from sqlalchemy import BigInteger, Integer, MetaData, cast, column, event, func, inspect, select, table as sql_table, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+from sqlmodel import SQLModel, create_engine, Session
+
+log = logging.getLogger("homebuh.db")
+
 DB_FILE = Path(__file__).resolve().parent / "data.db"
-engine = create_engine(f"sqlite:///{DB_FILE}", echo=False, connect_args={"check_same_thread": False})
+DATABASE_URL = os.getenv("DATABASE_URL", f"sqlite:///{DB_FILE}")
+ECHO = os.getenv("HOMEBUH_DB_ECHO", "") == "1"
+READ_POOL_SIZE = int(os.getenv("HOMEBUH_DB_READERS", "4"))
+SQLITE_MMAP_SIZE = int(os.getenv("HOMEBUH_SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE = int(os.getenv("HOMEBUH_SQLITE_CACHE_SIZE", "-64000"))  # negative = KiB
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("HOMEBUH_SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+IS_SQLITE = make_url(DATABASE_URL).get_backend_name() == "sqlite"
+
+
+def _sqlite_pragmas(dbapi_conn, _record):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cur.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.close()
+
+
+def _make_engines():
+    if not IS_SQLITE:
+        # Postgres and friends handle concurrent writers themselves: one pooled engine.
+        eng = create_engine(DATABASE_URL, echo=ECHO, pool_pre_ping=True, pool_size=READ_POOL_SIZE + 1)
+        return eng, eng
+
+    args = {"check_same_thread": False}
+    # SQLite allows one writer at a time. A single pooled writer connection
+    # queues writers in-process instead of failing with "database is locked";
+    # WAL lets the reader pool proceed while a write is in flight.
+    writer = create_engine(
+        DATABASE_URL, echo=ECHO, connect_args=args,
+        poolclass=QueuePool, pool_size=1, max_overflow=0, pool_timeout=30,
+    )
+    reader = create_engine(
+        DATABASE_URL, echo=ECHO, connect_args=args,
+        poolclass=QueuePool, pool_size=READ_POOL_SIZE, max_overflow=0, pool_timeout=30,
+    )
+    for eng in (writer, reader):
+        event.listen(eng, "connect", _sqlite_pragmas)
+    return writer, reader
+
+
+engine, read_engine = _make_engines()
+
 
 def init_db():
-    from .models import *  # noqa: F401
+    from . import models, search, sync  # noqa: F401
+    with engine.connect() as conn:
+        insp = inspect(conn)
+        legacy_accounts = insp.has_table("account") and "opening_balance" not in {c["name"] for c in insp.get_columns("account")}
     SQLModel.metadata.create_all(engine)
+    _upgrade_schema()
+    _migrate_money_columns()
+    if legacy_accounts:
+        _backfill_opening_balances()
+    with engine.begin() as conn:
+        search.ensure_index(conn)  # table rebuilds above drop triggers
+        sync.ensure_log(conn)
+
+
+def _upgrade_schema():
+    """Bring tables created by older versions up to date.
+
+    create_all only creates missing tables; this adds missing nullable
+    columns and missing indexes to existing ones.
+    """
+    with engine.begin() as conn:
+        insp = inspect(conn)
+        for table in SQLModel.metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                continue
+            existing = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in existing:
+                    continue
+                if not col.nullable and col.server_default is None:
+                    log.warning("cannot add NOT NULL column %s.%s automatically", table.name, col.name)
+                    continue
+                col_type = col.type.compile(dialect=engine.dialect)
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{col.name}" {col_type}'
+                if col.server_default is not None:
+                    default = str(col.server_default.arg).replace("'", "''")
+                    ddl += f" DEFAULT '{default}'" + ("" if col.nullable else " NOT NULL")
+                conn.execute(text(ddl))
+                log.info("added column %s.%s", table.name, col.name)
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def _migrate_money_columns():
+    """Convert REAL major-unit money columns to BIGINT minor units, once.
+
+    SQLite cannot change a column's type, so affected tables are copied
+    into a new table and swapped in. MonthlyRollup is derived data: it is
+    dropped and recreated empty, and rollup.ensure_built refills it.
+    """
+    from .models import MonthlyRollup
+    from .money import MONEY_FIELDS, minor_factor
+
+    with engine.begin() as conn:
+        insp = inspect(conn)
+        rollup_table = MonthlyRollup.__table__
+        if insp.has_table(rollup_table.name) and any(
+            c["name"] == "total" and not isinstance(c["type"], Integer) for c in insp.get_columns(rollup_table.name)
+        ):
+            rollup_table.drop(conn)
+            rollup_table.create(conn)
+            log.info("recreated %s with integer amounts; it will be rebuilt", rollup_table.name)
+
+        for name, money_cols in MONEY_FIELDS.items():
+            table = SQLModel.metadata.tables[name]
+            columns = {c["name"]: c for c in insp.get_columns(name)}
+            stale = [c for c in money_cols if c in columns and not isinstance(columns[c]["type"], Integer)]
+            if not stale:
+                continue
+            def to_minor(col, currency):
+                return cast(func.round(col * minor_factor(currency)), BigInteger)
+
+            if IS_SQLITE:
+                old = sql_table(name, *[column(c) for c in columns])
+                names = [c.name for c in table.columns if c.name in columns]
+                exprs = [to_minor(old.c[c], old.c.currency) if c in stale else old.c[c] for c in names]
+                scratch = MetaData()
+                for t in SQLModel.metadata.sorted_tables:
+                    t.to_metadata(scratch)  # so the copy's foreign keys resolve
+                tmp = table.to_metadata(scratch, name=f"_{name}_migrating")
+                tmp.indexes.clear()
+                tmp.create(conn)
+                conn.execute(tmp.insert().from_select(names, select(*exprs)))
+                conn.execute(text(f'DROP TABLE "{name}"'))
+                conn.execute(text(f'ALTER TABLE "{tmp.name}" RENAME TO "{name}"'))
+                for index in table.indexes:
+                    index.create(conn)
+            else:
+                for c in stale:
+                    using = to_minor(column(c), column("currency")).compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+                    conn.execute(text(f'ALTER TABLE "{name}" ALTER COLUMN "{c}" TYPE BIGINT USING {using}'))
+            log.info("migrated %s.%s to integer minor units", name, ", ".join(stale))
+
+
+def _backfill_opening_balances():
+    """Derive opening balances for accounts created before they were recorded.
+
+    The stored balance is kept as it is (what users saw until now) and the
+    opening balance becomes whatever makes it equal to the ledger.
+    """
+    with engine.begin() as conn:
+        conn.execute(text(
+            'UPDATE account SET opening_balance = balance - COALESCE((SELECT SUM(t.amount) FROM "transaction" t '
+            "WHERE t.account_id = account.id AND t.currency = account.currency), 0)"
+        ))
+    log.info("derived opening balances for existing accounts")
+
 
 def get_session():
-    return Session(engine)
+    """FastAPI dependency: one read-write session per request, closed after the response is sent."""
+    with Session(engine) as session:
+        yield session
+
+
+def get_read_session():
+    """FastAPI dependency for handlers that only read; uses the reader pool."""
+    with Session(read_engine) as session:
+        yield session
+
+
+def effective_settings() -> dict:
+    """Settings as the database actually applied them (queried, not configured)."""
+    url = make_url(DATABASE_URL)
+    settings = {
+        "url": url.render_as_string(hide_password=True),
+        "dialect": url.get_backend_name(),
+        "writer_pool_size": engine.pool.size(),
+        "reader_pool_size": read_engine.pool.size() if read_engine is not engine else "shared",
+    }
+    if IS_SQLITE:
+        with engine.connect() as conn:
+            for pragma in ("journal_mode", "synchronous", "mmap_size", "cache_size", "busy_timeout"):
+                settings[pragma] = conn.execute(text(f"PRAGMA {pragma}")).scalar()
+    elif settings["dialect"] == "postgresql":
+        with engine.connect() as conn:
+            settings["server_version"] = conn.execute(text("SHOW server_version")).scalar()
+    return settings
+
+
+def log_settings():
+    """Startup self-check: log the effective engine configuration."""
+    settings = effective_settings()
+    log.info("database settings: %s", ", ".join(f"{k}={v}" for k, v in settings.items()))
+    if IS_SQLITE and str(settings.get("journal_mode")).lower() != "wal":
+        log.warning("SQLite WAL mode is not active (journal_mode=%s)", settings.get("journal_mode"))
+    return settings
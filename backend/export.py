@@ -0,0 +1,275 @@
+"""Streaming export of transactions as CSV or Parquet.
+
+Transactions, with their category and account names joined in, are read in
+id order from a server-side cursor EXPORT_CHUNK rows at a time and each
+chunk is encoded and handed on before the next is fetched, so memory stays
+flat however large the ledger is. Parquet needs the optional pyarrow
+package; every chunk becomes one row group. The CSV columns are the ones
+the importer reads back.
+
+An export covers the ids in (since, upper], where `upper` is the largest id
+when it starts, so rows committed meanwhile wait for the next run. A named
+watermark stores `upper` once the whole export has been written; the next
+export with that name starts after it ("since last export"). Ids only grow,
+so this picks up new transactions; edited or deleted ones are not exported
+again, take a full export (since=0) for that.
+
+    python -m backend.export dump out.csv [--format csv|parquet] [--since ID] [--watermark NAME]
+    python -m backend.export bench [--rows 1000000]
+"""
+import argparse
+import csv
+import io
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from .models import Account, Category, ExportWatermark, Transaction
+from .money import COMMON_EXPONENT, common_units, to_major
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional, only needed for format=parquet
+    pa = pq = None
+
+EXPORT_CHUNK = 10_000
+FORMATS = ("csv", "parquet")
+MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "parquet": "application/vnd.apache.parquet"}
+COLUMNS = (
+    "id", "timestamp", "amount", "currency", "description",
+    "category_id", "category", "account_id", "account",
+)
+
+
+def check_format(fmt: str):
+    if fmt not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"unsupported format: {fmt}")
+    if fmt == "parquet" and pa is None:
+        raise HTTPException(
+            status_code=415, detail="format=parquet is not available: install pyarrow (backend/requirements-optional.txt)",
+        )
+
+
+def bounds(s: Session, since: Optional[int] = None, watermark: Optional[str] = None) -> Tuple[int, int]:
+    """(since, upper): the id range (since, upper] the export covers.
+
+    `since` defaults to the stored `watermark` (0 for a new or no name).
+    """
+    if since is None:
+        stored = s.get(ExportWatermark, watermark) if watermark else None
+        since = stored.last_id if stored else 0
+    upper = s.exec(select(func.max(Transaction.id))).one() or 0
+    return since, max(since, upper)
+
+
+def chunks(s: Session, since: int, upper: int, chunk: Optional[int] = None) -> Iterator[list]:
+    """Rows of COLUMNS with id in (since, upper], in id order, `chunk` (EXPORT_CHUNK) at a time."""
+    chunk = chunk or EXPORT_CHUNK
+    t = Transaction
+    stmt = (
+        select(
+            t.id, t.timestamp, t.amount, t.currency, t.description,
+            t.category_id, Category.name, t.account_id, Account.name,
+            common_units(t.amount, t.currency).label("common"),
+        )
+        .outerjoin(Category, Category.id == t.category_id)
+        .outerjoin(Account, Account.id == t.account_id)
+        .where(t.id > since, t.id <= upper)
+        .order_by(t.id)
+    )
+    # Core rows: the ORM layer would add a per-row loading step for nothing.
+    result = s.connection().execute(stmt.execution_options(stream_results=True))
+    yield from result.partitions(chunk)
+
+
+def iter_csv(parts: Iterable[list]) -> Iterator[bytes]:
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(COLUMNS)
+    for rows in parts:
+        writer.writerows(
+            (r[0], r[1].isoformat(), to_major(r[2], r[3]), *r[3:9])
+            for r in rows
+        )
+        yield buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode()
+
+
+class _Drain:
+    """Write-only file object for ParquetWriter; `take()` hands out what was written since the last call."""
+
+    closed = False
+
+    def __init__(self):
+        self.parts: List[bytes] = []
+        self.pos = 0
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.pos
+
+    def writable(self) -> bool:
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        out = b"".join(self.parts)
+        self.parts.clear()
+        return out
+
+
+def _parquet_schema():
+    return pa.schema([
+        ("id", pa.int64()),
+        ("timestamp", pa.timestamp("us")),
+        # Every currency fits COMMON_EXPONENT decimals exactly.
+        ("amount", pa.decimal128(18, COMMON_EXPONENT)),
+        ("currency", pa.string()),
+        ("description", pa.string()),
+        ("category_id", pa.int64()),
+        ("category", pa.string()),
+        ("account_id", pa.int64()),
+        ("account", pa.string()),
+    ])
+
+
+def iter_parquet(parts: Iterable[list]) -> Iterator[bytes]:
+    schema = _parquet_schema()
+    sink = _Drain()
+    with pq.ParquetWriter(sink, schema, compression="zstd") as writer:
+        for rows in parts:
+            cols = list(zip(*rows))
+            cols[2] = [Decimal(v).scaleb(-COMMON_EXPONENT) for v in cols[9]]
+            writer.write_table(pa.table(
+                [pa.array(c, type=f.type) for c, f in zip(cols, schema)], schema=schema,
+            ))
+            yield sink.take()
+    yield sink.take()
+
+
+ENCODERS = {"csv": iter_csv, "parquet": iter_parquet}
+
+
+def advance(s: Session, name: str, upper: int):
+    """Move watermark `name` forward to `upper` (never back) and commit."""
+    # Ends the read transaction the export ran in; on SQLite a write on top
+    # of an old read snapshot fails if anyone else has committed since.
+    s.commit()
+    mark = s.get(ExportWatermark, name)
+    if mark is None:
+        s.add(ExportWatermark(name=name, last_id=upper))
+    elif mark.last_id < upper:
+        mark.last_id = upper
+        mark.exported_at = datetime.utcnow()
+    s.commit()
+
+
+def stream(
+    s: Session, fmt: str, since: int, upper: int, watermark: Optional[str] = None, writer: Optional[Session] = None,
+) -> Iterator[bytes]:
+    """Encoded export of (since, upper]; `watermark` advances only once the last byte has been produced.
+
+    Rows are read through `s`, the watermark is saved through `writer`
+    (default `s`). The API reads on a reader session so a slow download
+    does not hold the single SQLite writer connection.
+    """
+    for data in ENCODERS[fmt](chunks(s, since, upper)):
+        if data:
+            yield data
+    if watermark:
+        advance(writer or s, watermark, upper)
+
+
+def bench(rows: int = 1_000_000):
+    """Export throughput and peak Python memory, CSV and (if installed) Parquet."""
+    import tracemalloc
+
+    from sqlalchemy import text
+    from sqlmodel import SQLModel, create_engine
+    from sqlmodel.pool import StaticPool
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as s:
+        s.add_all([Category(name=f"Category {i}") for i in range(12)] + [Account(name=f"Account {i}") for i in range(5)])
+        s.commit()
+        s.execute(text(
+            "WITH RECURSIVE seq(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM seq WHERE i < :last) "
+            'INSERT INTO "transaction" (amount, currency, timestamp, description, account_id, category_id) '
+            "SELECT -((i * 7919) % 90000) - 100, 'USD', datetime('2021-01-01', '+' || i || ' minutes') || '.000000', "
+            "'Card payment #' || i, i % 5 + 1, i % 12 + 1 FROM seq"
+        ), {"last": rows - 1})
+        s.commit()
+
+        print(f"{rows} transactions, {EXPORT_CHUNK}-row chunks")
+        for fmt in FORMATS:
+            if fmt == "parquet" and pa is None:
+                print("parquet: skipped, pyarrow is not installed")
+                continue
+            since, upper = bounds(s, 0)
+            started = time.perf_counter()
+            size = sum(len(data) for data in stream(s, fmt, since, upper))
+            seconds = time.perf_counter() - started
+            # Separate pass: tracing allocations slows everything down.
+            tracemalloc.start()
+            for _ in stream(s, fmt, since, upper):
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{fmt}: {size / 2**20:.1f} MiB in {seconds:.2f} s ({rows / seconds:,.0f} rows/s), "
+                  f"peak Python memory {peak / 2**20:.1f} MiB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m backend.export")
+    sub = parser.add_subparsers(dest="command", required=True)
+    d = sub.add_parser("dump", help="write transactions to a CSV or Parquet file")
+    d.add_argument("path")
+    d.add_argument("--format", choices=FORMATS)
+    d.add_argument("--since", type=int, help="export ids after this one (default: the watermark, or all)")
+    d.add_argument("--watermark", help="name of the stored position to start from and advance")
+    b = sub.add_parser("bench", help="export throughput and peak memory on synthetic transactions")
+    b.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args(argv)
+
+    if args.command == "bench":
+        bench(args.rows)
+        return 0
+    fmt = args.format or ("parquet" if args.path.endswith(".parquet") else "csv")
+    try:
+        check_format(fmt)
+    except HTTPException as e:
+        parser.error(e.detail)
+
+    from .db import engine, init_db
+
+    init_db()
+    with Session(engine) as s, open(args.path, "wb") as f:
+        since, upper = bounds(s, args.since, args.watermark)
+        for data in stream(s, fmt, since, upper, args.watermark):
+            f.write(data)
+    print(f"exported ids {since + 1}..{upper} to {args.path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
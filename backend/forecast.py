@@ -0,0 +1,220 @@
+"""Projected daily balances from Account.balance and PlannedItem.
+
+A planned item lands on its `due_date` once, or repeats weekly, monthly or
+yearly (`recurrence`) until `recurrence_end`. Items without an account only
+affect the combined total. Amounts in another currency than their account
+are converted at today's rate, and the total is given in the reporting
+currency (fx.reporting_currency).
+
+`ForecastCache` keeps the per-day net change of planned items and the
+starting balances. Writers invalidate just what they touch: a one-off item
+its own day, a recurring item the days from its first occurrence on,
+a transaction or transfer only the starting balances. A dashboard read then
+re-queries only the invalidated days and sums the timeline. The cache is
+per process; writes made by other processes are picked up after a restart
+or an explicit `clear()`.
+"""
+import calendar
+import threading
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Callable, Dict, Iterator, List, Optional
+
+from sqlalchemy import or_
+from sqlmodel import Session, select
+
+from .fx import Converter, reporting_currency
+from .models import Account, PlannedItem
+from .money import to_major
+
+RECURRENCES = ("weekly", "monthly", "yearly")
+DEFAULT_MONTHS = 3
+MAX_MONTHS = 24
+
+ONE_DAY = timedelta(days=1)
+
+
+def add_months(d: date, months: int) -> date:
+    """Shift by whole months, clamping the day to the target month's length."""
+    y, m = divmod(d.month - 1 + months, 12)
+    year, month = d.year + y, m + 1
+    return d.replace(year=year, month=month, day=min(d.day, calendar.monthrange(year, month)[1]))
+
+
+def occurrences(due: date, recurrence: Optional[str], until: Optional[date], lo: date, hi: date) -> Iterator[date]:
+    """Dates in [lo, hi) on which an item due on `due` falls."""
+    if until is not None:
+        hi = min(hi, until + ONE_DAY)
+    if recurrence is None:
+        if lo <= due < hi:
+            yield due
+        return
+    if recurrence == "weekly":
+        skip = max(0, -(-(lo - due).days // 7))
+        d = due + timedelta(weeks=skip)
+        while d < hi:
+            yield d
+            d += timedelta(weeks=1)
+        return
+    step = 12 if recurrence == "yearly" else 1
+    # Always count from the original due date so clamped days (Jan 31 -> Feb 28) don't drift.
+    k = max(0, ((lo.year - due.year) * 12 + lo.month - due.month) // step - 1)
+    d = add_months(due, k * step)
+    while d < hi:
+        if d >= lo:
+            yield d
+        k += 1
+        d = add_months(due, k * step)
+
+
+def signed_amount(item: PlannedItem) -> Decimal:
+    amount = to_major(abs(item.amount), item.currency)
+    return amount if item.type == "income" else -amount
+
+
+def affected_range(item: PlannedItem):
+    """[start, end) of days whose forecast `item` changes; end None means open-ended."""
+    if item.due_date is None:
+        return None
+    due = item.due_date.date()
+    if item.recurrence is None:
+        return due, due + ONE_DAY
+    return due, (item.recurrence_end.date() + ONE_DAY if item.recurrence_end else None)
+
+
+class ForecastCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # day -> {(account_id, currency): net planned change}; a present key means the day is up to date
+        self._deltas: Dict[date, Dict[tuple, Decimal]] = {}
+        self._accounts: Optional[List[tuple]] = None
+        # Bumped by every invalidation so a load racing with a write is not stored.
+        self._generation = 0
+        self.recomputed_days = 0
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._deltas.clear()
+            self._accounts = None
+
+    def invalidate_range(self, start: Optional[date] = None, end: Optional[date] = None):
+        """Forget planned-item changes for days in [start, end); None bounds are open."""
+        with self._lock:
+            self._generation += 1
+            for d in [d for d in self._deltas if (start is None or d >= start) and (end is None or d < end)]:
+                del self._deltas[d]
+
+    def invalidate_item(self, item: PlannedItem):
+        rng = affected_range(item)
+        if rng is not None:
+            self.invalidate_range(*rng)
+
+    def invalidate_balances(self):
+        with self._lock:
+            self._generation += 1
+            self._accounts = None
+
+    def _load_days(self, s: Session, lo: date, hi: date) -> Dict[date, Dict[tuple, Decimal]]:
+        p = PlannedItem
+        lo_dt, hi_dt = datetime.combine(lo, datetime.min.time()), datetime.combine(hi, datetime.min.time())
+        items = s.exec(
+            select(p)
+            .where(p.due_date.isnot(None), p.due_date < hi_dt)
+            .where(or_(p.recurrence.isnot(None), p.due_date >= lo_dt))
+            .where(or_(p.recurrence_end.is_(None), p.recurrence_end >= lo_dt))
+        ).all()
+        days = {lo + timedelta(days=i): defaultdict(Decimal) for i in range((hi - lo).days)}
+        for item in items:
+            until = item.recurrence_end.date() if item.recurrence_end else None
+            for d in occurrences(item.due_date.date(), item.recurrence, until, lo, hi):
+                days[d][(item.account_id, item.currency)] += signed_amount(item)
+        return {d: dict(v) for d, v in days.items()}
+
+    def get(
+        self, s: Session, today: Optional[date] = None, months: int = DEFAULT_MONTHS, account_id: Optional[int] = None,
+        currency: Optional[str] = None,
+    ) -> dict:
+        """Timelines per account and in total (in `currency`, default the reporting currency). Raises MissingRate."""
+        today = today or datetime.utcnow().date()
+        end = add_months(today, months)
+        horizon = [today + timedelta(days=i) for i in range((end - today).days)]
+
+        with self._lock:
+            generation = self._generation
+            deltas = {d: self._deltas.get(d) for d in horizon}
+            accounts = self._accounts
+        missing = [d for d, v in deltas.items() if v is None]
+        if missing:
+            # One query for the span of missing days; cached days in between are refreshed too.
+            loaded = self._load_days(s, missing[0], missing[-1] + ONE_DAY)
+            deltas.update(loaded)
+            self.recomputed_days += len(loaded)
+        if accounts is None:
+            accounts = [
+                (acc_id, name, currency, to_major(balance, currency))
+                for acc_id, name, currency, balance in s.exec(select(Account.id, Account.name, Account.currency, Account.balance))
+            ]
+        with self._lock:
+            if generation == self._generation:
+                for d in [d for d in self._deltas if d < today]:
+                    del self._deltas[d]
+                if missing:
+                    self._deltas.update(loaded)
+                self._accounts = accounts
+        convert = Converter(s).convert
+        return _timelines(
+            horizon, [deltas[d] for d in horizon], accounts, account_id,
+            lambda amount, base, quote: convert(amount, base, quote, today), reporting_currency(currency),
+        )
+
+
+def _timelines(
+    horizon: List[date], deltas: List[dict], accounts: List[tuple], account_id: Optional[int],
+    convert: Callable[[Decimal, str, str], Decimal], total_currency: str,
+) -> dict:
+    """`convert(amount, base, quote)` brings planned amounts into their account's currency and everything into the total's."""
+    series = []
+    for acc_id, name, currency, balance in accounts:
+        if account_id is not None and acc_id != account_id:
+            continue
+        changes = [
+            sum((convert(v, cur, currency) for (acc, cur), v in dd.items() if acc == acc_id), Decimal(0))
+            for dd in deltas
+        ]
+        series.append(_series(horizon, changes, acc_id, name, currency, balance))
+    total = None
+    if account_id is None:
+        start = sum((convert(balance, currency, total_currency) for _, _, currency, balance in accounts), Decimal(0))
+        changes = [sum((convert(v, cur, total_currency) for (_, cur), v in dd.items()), Decimal(0)) for dd in deltas]
+        total = _series(horizon, changes, None, "Total", total_currency, start)
+    return {
+        "start": horizon[0].isoformat() if horizon else None,
+        "end": horizon[-1].isoformat() if horizon else None,
+        "accounts": series,
+        "total": total,
+    }
+
+
+def _series(horizon, changes, acc_id, name, currency, start) -> dict:
+    points = []
+    balance = start
+    low, low_date = start, horizon[0] if horizon else None
+    for d, change in zip(horizon, changes):
+        balance += change
+        points.append({"date": d.isoformat(), "balance": balance})
+        if balance < low:
+            low, low_date = balance, d
+    return {
+        "account_id": acc_id,
+        "name": name,
+        "currency": currency,
+        "start_balance": start,
+        "min_balance": low,
+        "min_date": low_date.isoformat() if low_date else None,
+        "points": points,
+    }
+
+
+forecast_cache = ForecastCache()
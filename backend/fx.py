@@ -0,0 +1,217 @@
+"""Exchange rates and conversion into a reporting currency.
+
+Rates live in the FxRate table (1 `base` = `rate` `quote`, effective from
+`day` until the pair's next row) and are loaded from CSV files, no live
+service involved:
+
+    python -m backend.fx load rates.csv      # columns: date,base,quote,rate
+
+`RateCache` keeps every pair in memory as parallel sorted lists of days and
+rates; a lookup is a bisect for the latest rate on or before the requested
+day. Missing pairs are derived from the inverse pair or through the pivot
+currency (HOMEBUH_FX_PIVOT, USD by default). The cache reloads itself when
+the table changes.
+"""
+import argparse
+import calendar
+import csv
+import os
+import sys
+import threading
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import date, datetime
+from decimal import ROUND_HALF_EVEN, Decimal
+from typing import IO, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, insert, tuple_, update
+from sqlmodel import Session, select
+
+from .models import FxRate
+from .money import DEFAULT_CURRENCY, exponent
+
+PIVOT = os.getenv("HOMEBUH_FX_PIVOT", "USD").upper()
+REPORTING_CURRENCY = (os.getenv("HOMEBUH_REPORTING_CURRENCY") or "").upper() or None
+
+Pair = Tuple[str, str]
+
+
+class MissingRate(LookupError):
+    def __init__(self, base: str, quote: str, on: date):
+        super().__init__(f"no exchange rate {base}->{quote} on or before {on.isoformat()}")
+        self.base, self.quote, self.on = base, quote, on
+
+
+class RateCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pairs: Dict[Pair, Tuple[List[date], List[Decimal]]] = {}
+        self._version = None
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+    def refresh(self, s: Session):
+        """Reload the pairs if FxRate changed since the last load."""
+        version = tuple(s.exec(select(func.count(FxRate.id), func.max(FxRate.id))).one())
+        with self._lock:
+            if version == self._version:
+                return
+        pairs: Dict[Pair, Tuple[List[date], List[Decimal]]] = defaultdict(lambda: ([], []))
+        rows = s.exec(select(FxRate.base, FxRate.quote, FxRate.day, FxRate.rate).order_by(FxRate.base, FxRate.quote, FxRate.day))
+        for base, quote, day, rate in rows:
+            days, rates = pairs[(base, quote)]
+            days.append(day)
+            rates.append(Decimal(str(rate)))
+        with self._lock:
+            self._pairs = dict(pairs)
+            self._version = version
+
+    def _direct(self, base: str, quote: str, on: date) -> Optional[Decimal]:
+        series = self._pairs.get((base, quote))
+        if series is not None:
+            i = bisect_right(series[0], on)
+            if i:
+                return series[1][i - 1]
+        series = self._pairs.get((quote, base))
+        if series is not None:
+            i = bisect_right(series[0], on)
+            if i:
+                return 1 / series[1][i - 1]
+        return None
+
+    def rate(self, s: Session, base: str, quote: str, on: date) -> Decimal:
+        """Units of `quote` per unit of `base` effective on `on`. Raises MissingRate."""
+        if base.upper() != quote.upper():
+            self.refresh(s)
+        return self.lookup(base, quote, on)
+
+    def lookup(self, base: str, quote: str, on: date) -> Decimal:
+        """Like `rate` but against the pairs as last loaded, without touching the database."""
+        base, quote = base.upper(), quote.upper()
+        if base == quote:
+            return Decimal(1)
+        with self._lock:
+            r = self._direct(base, quote, on)
+            if r is None and PIVOT not in (base, quote):
+                to_pivot, from_pivot = self._direct(base, PIVOT, on), self._direct(PIVOT, quote, on)
+                if to_pivot is not None and from_pivot is not None:
+                    r = to_pivot * from_pivot
+        if r is None:
+            raise MissingRate(base, quote, on)
+        return r
+
+    def convert(self, s: Session, amount: Decimal, base: str, quote: str, on: date) -> Decimal:
+        """`amount` of `base` in `quote`, rounded to the quote currency's minor unit."""
+        converted = amount * self.rate(s, base, quote, on)
+        return converted.quantize(Decimal(1).scaleb(-exponent(quote)), rounding=ROUND_HALF_EVEN)
+
+
+rates = RateCache()
+
+
+def reporting_currency(requested: Optional[str] = None) -> str:
+    """Currency for totals over several currencies: `requested`, else HOMEBUH_REPORTING_CURRENCY, else USD."""
+    return (requested or REPORTING_CURRENCY or DEFAULT_CURRENCY).upper()
+
+
+def period_end(period: str) -> date:
+    """Last day of a 'YYYY-MM' period (capped at today), or the day of a 'YYYY-MM-DD' one."""
+    if len(period) > 7:
+        return date.fromisoformat(period)
+    y, m = int(period[:4]), int(period[5:7])
+    return min(date(y, m, calendar.monthrange(y, m)[1]), datetime.utcnow().date())
+
+
+class Converter:
+    """Rates for one report: each (base, quote, day) is looked up once, the table is read at most once.
+
+    Same-currency amounts never touch the rates, so single-currency data
+    needs no rates at all. Raises MissingRate.
+    """
+
+    def __init__(self, s: Session):
+        self._s = s
+        self._refreshed = False
+        self._rates: Dict[tuple, Decimal] = {}
+
+    def rate(self, base: str, quote: str, on: date) -> Decimal:
+        key = (base.upper(), quote.upper(), on)
+        r = self._rates.get(key)
+        if r is None:
+            if key[0] != key[1] and not self._refreshed:
+                rates.refresh(self._s)
+                self._refreshed = True
+            r = self._rates[key] = rates.lookup(base, quote, on)
+        return r
+
+    def convert(self, amount: Decimal, base: str, quote: str, on: date) -> Decimal:
+        """`amount` of `base` in `quote`, rounded to the quote currency's minor unit."""
+        return round_to(amount * self.rate(base, quote, on), quote)
+
+
+def round_to(amount: Decimal, currency: str) -> Decimal:
+    return amount.quantize(Decimal(1).scaleb(-exponent(currency)), rounding=ROUND_HALF_EVEN)
+
+
+def _parse_day(value: str) -> date:
+    return datetime.strptime(value.strip()[:10], "%Y-%m-%d").date()
+
+
+def load_csv(s: Session, stream: IO[str]) -> int:
+    """Insert or update rates from CSV (date,base,quote,rate) and commit. Returns rows loaded."""
+    parsed: Dict[tuple, float] = {}
+    for lineno, row in enumerate(csv.DictReader(stream), start=2):
+        row = {(k or "").strip().lower(): (v or "").strip() for k, v in row.items()}
+        try:
+            key = (_parse_day(row["date"]), row["base"].upper(), row["quote"].upper())
+            rate = float(Decimal(row["rate"]))
+        except (KeyError, ValueError, ArithmeticError):
+            raise ValueError(f"line {lineno}: expected date,base,quote,rate")
+        if rate <= 0 or len(key[1]) != 3 or len(key[2]) != 3:
+            raise ValueError(f"line {lineno}: invalid rate or currency code")
+        parsed[key] = rate
+    if not parsed:
+        return 0
+
+    pairs = {(b, q) for _, b, q in parsed}
+    existing = {
+        (day, b, q): rid
+        for rid, day, b, q in s.exec(
+            select(FxRate.id, FxRate.day, FxRate.base, FxRate.quote).where(tuple_(FxRate.base, FxRate.quote).in_(pairs))
+        )
+    }
+    new = [{"day": d, "base": b, "quote": q, "rate": r} for (d, b, q), r in parsed.items() if (d, b, q) not in existing]
+    changed = [{"rid": existing[k], "rate": r} for k, r in parsed.items() if k in existing]
+    if new:
+        s.execute(insert(FxRate.__table__), new)
+    for row in changed:
+        s.exec(update(FxRate).where(FxRate.id == row["rid"]).values(rate=row["rate"]))
+    s.commit()
+    rates.invalidate()
+    return len(parsed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m backend.fx")
+    sub = parser.add_subparsers(dest="command", required=True)
+    load = sub.add_parser("load", help="load exchange rates from a CSV file (date,base,quote,rate)")
+    load.add_argument("path")
+    args = parser.parse_args(argv)
+
+    from .db import engine, init_db
+
+    init_db()
+    with Session(engine) as s, open(args.path, encoding="utf-8-sig", newline="") as f:
+        try:
+            n = load_csv(s, f)
+        except ValueError as e:
+            print(f"error: {e}", file=sys.stderr)
+            return 1
+    print(f"loaded {n} rates")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+"""Conditional GETs for the list endpoints: data versions, ETags and a response cache.
+
+Every write in main.py calls `data_versions.bump(...)` with the tables it
+changed, after it commits. A `@cached(...)` endpoint names the tables its
+response is built from; its ETag is derived from their versions and the
+request URL, so a matching `If-None-Match` is answered with 304 from
+memory, before any database connection is taken. Last-Modified is sent for
+information only: with one-second resolution it cannot tell two writes in
+the same second apart, so If-Modified-Since is not used. Full responses are kept in `response_cache` under the
+ETag they were built for: a write changes the ETag, so stale entries are
+never served and age out of the LRU.
+
+Versions live in the process. Writes made by other processes (the CLI
+tools, or more than one server worker) are not seen until a restart, which
+also starts a new ETag generation.
+"""
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate
+from typing import Callable, Dict, NamedTuple, Optional, Sequence
+
+from fastapi import Request, Response
+
+from .fastjson import negotiate
+
+CACHE_BYTES = int(os.getenv("HOMEBUH_RESPONSE_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+# Headers of a stored response that are rebuilt rather than replayed.
+_SKIP_HEADERS = {"content-length", "etag", "last-modified", "cache-control"}
+
+
+class DataVersions:
+    """Per-table write counters and the time of each table's last write."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clock = 0
+        self._versions: Dict[str, int] = {}
+        self._modified: Dict[str, float] = {}
+        self.started = time.time()
+        self.generation = hashlib.sha1(f"{os.getpid()}-{time.time_ns()}".encode()).hexdigest()[:8]
+
+    def bump(self, *tables: str):
+        with self._lock:
+            self._clock += 1
+            now = time.time()
+            for table in tables:
+                self._versions[table] = self._clock
+                self._modified[table] = now
+
+    def get(self, table: str) -> int:
+        return self._versions.get(table, 0)
+
+    def etag(self, tables: Sequence[str], url: str) -> str:
+        # Weak: the same data may go out brotli-, gzip- or not compressed.
+        state = ",".join(f"{t}:{self.get(t)}" for t in tables)
+        digest = hashlib.sha1(f"{url}|{state}".encode()).hexdigest()[:16]
+        return f'W/"{self.generation}-{digest}"'
+
+    def last_modified(self, tables: Sequence[str]) -> float:
+        return max((self._modified.get(t, self.started) for t in tables), default=self.started)
+
+    def clear(self):
+        with self._lock:
+            self._versions.clear()
+            self._modified.clear()
+
+
+class Cached(NamedTuple):
+    etag: str
+    body: bytes
+    status_code: int
+    headers: Dict[str, str]
+
+
+class ResponseCache:
+    """LRU of response bodies keyed by URL and content encoding, bounded in bytes."""
+
+    def __init__(self, max_bytes: int = CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[tuple, Cached]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def get(self, key: tuple, etag: str) -> Optional[Cached]:
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is None or entry.etag != etag:
+                self.misses += 1
+                return None
+            self._lru.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: tuple, entry: Cached):
+        if len(entry.body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._lru.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old.body)
+            self._lru[key] = entry
+            self.bytes += len(entry.body)
+            while self.bytes > self.max_bytes:
+                _, evicted = self._lru.popitem(last=False)
+                self.bytes -= len(evicted.body)
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+            self.bytes = self.hits = self.misses = self.not_modified = 0
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._lru), "bytes": self.bytes, "hits": self.hits, "misses": self.misses,
+            "not_modified": self.not_modified, "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+data_versions = DataVersions()
+response_cache = ResponseCache()
+
+
+def _matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as RFC 9110 asks for If-None-Match.
+    opaque = etag[2:]
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+def conditional(request: Request, tables: Sequence[str], build: Callable[[], Response]) -> Response:
+    """Answer a GET from its validators or the response cache, else `build()` it and remember the result."""
+    url = request.url.path + ("?" + request.url.query if request.url.query else "")
+    # Computed before building, so a write that lands meanwhile can only
+    # make the stored entry unreachable, never stale.
+    etag = data_versions.etag(tables, url)
+    modified = data_versions.last_modified(tables)
+    validators = {
+        "ETag": etag,
+        "Last-Modified": formatdate(modified, usegmt=True),
+        "Cache-Control": "no-cache",  # revalidate every time, which costs a 304
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and _matches(if_none_match, etag):
+        response_cache.not_modified += 1
+        return Response(status_code=304, headers=dict(validators, Vary="Accept-Encoding"))
+
+    key = (url, negotiate(request.headers.get("accept-encoding", "")))
+    hit = response_cache.get(key, etag)
+    if hit is not None:
+        return Response(hit.body, status_code=hit.status_code, headers=dict(hit.headers, **validators))
+    response = build()
+    if response.status_code != 200 or not hasattr(response, "body"):
+        return response  # errors and streamed bodies are not cached
+    headers = {k: v for k, v in response.headers.items() if k not in _SKIP_HEADERS}
+    response_cache.put(key, Cached(etag, response.body, response.status_code, headers))
+    response.headers.update(validators)
+    return response
+
+
+def cached(*tables: str):
+    """Decorator for GET handlers that take `request: Request` and return a Response built from `tables`."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            return conditional(kwargs["request"], tables, lambda: handler(*args, **kwargs))
+        return wrapper
+    return decorate
@@ -0,0 +1,48 @@
+"""Idempotency-Key support for POST endpoints.
+
+The first request with a key stores its response in IdempotencyKey inside
+the same DB transaction as its effects, so either both are committed or
+neither is. A retry with the same key and body gets the stored response
+without running again; reusing a key with a different body is a 422. If
+two requests with one key race, the primary key lets only one commit and
+the loser replays the winner's response. Keys expire after
+HOMEBUH_IDEMPOTENCY_TTL_HOURS (24).
+"""
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete
+from sqlmodel import Session
+
+from .models import IdempotencyKey
+
+TTL = timedelta(hours=float(os.getenv("HOMEBUH_IDEMPOTENCY_TTL_HOURS", "24")))
+MAX_KEY_LENGTH = 255
+
+
+def fingerprint(payload: dict) -> str:
+    return hashlib.sha256(json.dumps(jsonable_encoder(payload), sort_keys=True).encode()).hexdigest()
+
+
+def lookup(s: Session, scope: str, key: str, request_hash: str) -> Optional[dict]:
+    """The stored response for `key`, or None if the request has not been processed."""
+    row = s.get(IdempotencyKey, (scope, key))
+    if row is None:
+        return None
+    if row.created_at < datetime.utcnow() - TTL:
+        s.expunge(row)
+        s.exec(delete(IdempotencyKey).where(IdempotencyKey.scope == scope, IdempotencyKey.key == key))
+        return None
+    if row.request_hash != request_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+    return json.loads(row.response)
+
+
+def record(s: Session, scope: str, key: str, request_hash: str, body: dict):
+    """Store `body` as the response for `key`. Does not commit."""
+    s.add(IdempotencyKey(scope=scope, key=key, request_hash=request_hash, response=json.dumps(jsonable_encoder(body))))
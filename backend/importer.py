@@ -0,0 +1,217 @@
+"""Bulk transaction import from CSV, NDJSON and OFX statements.
+
+Input is parsed as a stream, each row is validated with TransactionCreate,
+and valid rows are written with executemany in batches inside a single
+database transaction. Invalid rows are reported and skipped.
+
+CLI:
+
+    python -m backend.importer statement.csv [--format csv] [--batch-size 1000] [--account-id 1]
+"""
+import argparse
+import codecs
+import csv
+import json
+import re
+import sys
+import time
+from datetime import datetime
+from decimal import InvalidOperation
+from typing import IO, Iterator, Optional, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import insert
+from sqlmodel import Session
+
+from . import balances, rollup
+from .rules import rule_cache
+from .models import Transaction
+from .money import to_minor
+from .schemas import TransactionCreate
+
+FORMATS = ("csv", "ndjson", "ofx")
+DEFAULT_BATCH_SIZE = 1000
+
+# Accepted aliases for common bank-export column names.
+CSV_ALIASES = {"date": "timestamp", "memo": "description", "name": "description"}
+
+Row = Tuple[int, dict]
+
+
+def detect_format(filename: Optional[str]) -> Optional[str]:
+    suffix = (filename or "").rsplit(".", 1)[-1].lower()
+    if suffix in ("jsonl", "ndjson"):
+        return "ndjson"
+    if suffix in ("csv", "ofx"):
+        return suffix
+    return None
+
+
+_DATE_ONLY = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def iter_csv(stream: IO[str]) -> Iterator[Row]:
+    reader = csv.DictReader(stream)
+    for row in reader:
+        clean = {}
+        for k, v in row.items():
+            if k is None:
+                continue
+            k = k.strip().lower()
+            clean[CSV_ALIASES.get(k, k)] = v.strip() if v and v.strip() else None
+        ts = clean.get("timestamp")
+        if ts and _DATE_ONLY.match(ts):
+            # statements usually carry plain dates; pydantic wants a datetime
+            clean["timestamp"] = ts + "T00:00:00"
+        yield reader.line_num, clean
+
+
+def iter_ndjson(stream: IO[str]) -> Iterator[Row]:
+    for lineno, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            row = e
+        yield lineno, row
+
+
+_OFX_TAG = re.compile(r"<(/?)([A-Z0-9.]+)>([^<\r\n]*)")
+
+
+def _ofx_date(value: str) -> datetime:
+    # OFX dates look like 20251203 or 20251203120000[.XXX][-5:EST]
+    digits = re.match(r"\d+", value).group(0)
+    return datetime.strptime(digits[:14].ljust(14, "0"), "%Y%m%d%H%M%S")
+
+
+def iter_ofx(stream: IO[str]) -> Iterator[Row]:
+    """Yield STMTTRN records from an OFX 1.x (SGML) or 2.x (XML) statement."""
+    currency = None
+    current = None
+    start_line = 0
+    for lineno, line in enumerate(stream, start=1):
+        for closing, tag, value in _OFX_TAG.findall(line):
+            value = value.strip()
+            if tag == "CURDEF" and value:
+                currency = value
+            elif tag == "STMTTRN":
+                if closing:
+                    if current is not None:
+                        yield start_line, current
+                    current = None
+                else:
+                    current, start_line = {"currency": currency}, lineno
+            elif current is not None and not closing and value:
+                if tag == "TRNAMT":
+                    current["amount"] = value.replace(",", ".")
+                elif tag == "DTPOSTED":
+                    try:
+                        current["timestamp"] = _ofx_date(value)
+                    except (AttributeError, ValueError):
+                        current["timestamp"] = value
+                elif tag in ("NAME", "MEMO"):
+                    prev = current.get("description")
+                    current["description"] = f"{prev} {value}" if prev else value
+
+
+PARSERS = {"csv": iter_csv, "ndjson": iter_ndjson, "ofx": iter_ofx}
+
+
+def import_stream(
+    s: Session,
+    stream: IO[str],
+    fmt: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    account_id: Optional[int] = None,
+    max_errors: int = 100,
+) -> dict:
+    """Parse, validate and insert all rows from `stream`, then commit once.
+
+    `account_id` fills rows that do not name an account, and rows without a
+    category are categorized by the rules (see rules.py). Returns counts,
+    the first `max_errors` row errors and throughput.
+    """
+    if fmt not in PARSERS:
+        raise ValueError(f"unsupported format: {fmt}")
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    inserted = categorized = 0
+    matcher = rule_cache.get(s)
+    errors = []
+    batch = []
+
+    def flush():
+        nonlocal inserted
+        if not batch:
+            return
+        s.execute(insert(Transaction.__table__), batch)
+        rollup.apply_mappings(s, batch)
+        balances.apply_mappings(s, batch)
+        inserted += len(batch)
+        batch.clear()
+
+    for lineno, raw in PARSERS[fmt](stream):
+        try:
+            if isinstance(raw, Exception):
+                raise raw
+            row = TransactionCreate.parse_obj(raw).dict()
+            row["currency"] = row["currency"] or "USD"
+            row["amount"] = to_minor(row["amount"], row["currency"])
+        except (ValidationError, ValueError, TypeError, InvalidOperation, OverflowError) as e:
+            if len(errors) < max_errors:
+                errors.append({"line": lineno, "error": str(e).replace("\n", " ")})
+            continue
+        row["timestamp"] = row["timestamp"] or now
+        if row["account_id"] is None:
+            row["account_id"] = account_id
+        if row["category_id"] is None:
+            row["category_id"] = matcher.match(row["description"], row["amount"], row["currency"])
+            categorized += row["category_id"] is not None
+        batch.append(row)
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    s.commit()
+
+    seconds = time.perf_counter() - started
+    return {
+        "inserted": inserted,
+        "categorized": categorized,
+        "errors": errors,
+        "seconds": round(seconds, 4),
+        "rows_per_second": round(inserted / seconds, 1) if seconds > 0 else 0.0,
+    }
+
+
+def text_stream(binary: IO[bytes]) -> IO[str]:
+    """Decode an uploaded binary file lazily, tolerating a UTF-8 BOM."""
+    return codecs.getreader("utf-8-sig")(binary)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m backend.importer", description="Bulk-import transactions")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=FORMATS)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--account-id", type=int)
+    args = parser.parse_args(argv)
+
+    fmt = args.format or detect_format(args.path)
+    if not fmt:
+        parser.error("cannot detect format from file name, pass --format")
+
+    from .db import engine, init_db
+
+    init_db()
+    with Session(engine) as s, open(args.path, encoding="utf-8-sig", newline="") as f:
+        report = import_stream(s, f, fmt, batch_size=args.batch_size, account_id=args.account_id)
+    for err in report["errors"]:
+        print(f"line {err['line']}: {err['error']}", file=sys.stderr)
+    print(f"inserted {report['inserted']} rows ({report['categorized']} categorized by rules) in {report['seconds']}s ({report['rows_per_second']} rows/s)")
+    return 0 if not report["errors"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
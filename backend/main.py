@@ -1,25 +1,51 @@
 import os
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends
+from fastapi import FastAPI, UploadFile, File, Form, Header, HTTPException, Depends, Query, Request, Response
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Optional
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from pathlib import Path
 from typing import List
-from sqlmodel import select
-from .db import init_db, get_session
-from .models import Category, Account, Transaction, Budget, PlannedItem, Attachment
-from .utils import generate_bar_chart, generate_line_chart, generate_pie_chart
+from sqlmodel import Session, select
+from sqlalchemy import tuple_
+from sqlalchemy.exc import IntegrityError
+from .db import engine, init_db, get_session, get_read_session, log_settings
+from .models import Category, CategoryRule, Account, Transaction, Budget, PlannedItem, Attachment
+from . import (
+    analytics, balances, budgets, categories, export, fastjson, fx, idempotency, importer, metrics, rollup, rules, search, sync,
+    transfers,
+)
+from .money import api_view, common_units, from_api, to_common, to_major
+from .ai_client import LLMClient, LLMError
+from .aggregates import aggregate, parse_report_type
+from .artifacts import ArtifactStore
+from .forecast import MAX_MONTHS, forecast_cache
+from .httpcache import cached, data_versions, response_cache
+from .fx import REPORTING_CURRENCY, MissingRate, rates
+from .storage import range_response, save_upload
+from .summary import digest_cache, estimate_tokens
+from .utils import render_charts, shutdown_pool
 from datetime import datetime
+from decimal import Decimal
+import base64
 import json
+import logging
+import mimetypes
+import orjson
 import re
+import time
 import os
 from .schemas import (
-    CategoryCreate, CategoryResponse,
-    AccountCreate, AccountResponse,
-    TransactionCreate, TransactionResponse,
-    BudgetCreate, BudgetResponse,
-    PlannedItemCreate, PlannedItemResponse,
+    CategoryCreate, CategoryResponse, CategoryUpdate, CategoryTreeNode,
+    CategoryRuleCreate, CategoryRuleResponse, CategorizeResponse,
+    AccountCreate, AccountResponse, BalanceResponse,
+    TransactionCreate, TransactionResponse, TransactionSearchHit, BulkImportResponse,
+    BudgetCreate, BudgetResponse, BudgetStatusResponse,
+    PlannedItemCreate, PlannedItemResponse, ForecastResponse,
+    TrendResponse, YoYResponse,
+    FxLoadResponse, FxRateResponse, SyncResponse,
+    AttachmentResponse,
     TransferRequest, TransferResponse,
     AIReportRequest, AIReportResponse, ChartInfo,
     HealthResponse
@@ -27,6 +53,11 @@ from .schemas import (
 
 UPLOAD_DIR = Path(__file__).resolve().parent / "uploads"
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+REPORTS_DIR = Path(__file__).resolve().parent / "reports"
+reports_store = ArtifactStore(REPORTS_DIR)
+llm = LLMClient()
+
+log = logging.getLogger("homebuh.api")
 
 app = FastAPI(title="HomeBuh API")
 
@@ -37,11 +68,30 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
+
+metrics.gauges.update({
+    "homebuh_response_cache_bytes": ("Bytes held by the list response cache.", lambda: response_cache.bytes),
+    "homebuh_response_cache_hit_ratio": ("Share of list responses served from the cache.", lambda: response_cache.metrics()["hit_rate"]),
+    "homebuh_reports_bytes": ("Bytes of stored report artifacts.", lambda: reports_store.metrics()["bytes_stored"]),
+    "homebuh_reports_hit_ratio": ("Share of chart renders served from stored artifacts.", lambda: reports_store.metrics()["hit_rate"]),
+})
 
 
 @app.on_event("startup")
 def on_startup():
     init_db()
+    log_settings()
+    with Session(engine) as s:
+        rollup.ensure_built(s)
+        categories.ensure_built(s)
+        balances.snapshot(s)
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    shutdown_pool()
+    await llm.aclose()
 
 
 @app.get("/api/health", response_model=HealthResponse)
@@ -49,173 +99,715 @@ def health():
     return {"status": "ok"}
 
 
-@app.post("/api/upload")
-async def upload_file(file: UploadFile = File(...)):
-    dest = UPLOAD_DIR / f"{int(datetime.utcnow().timestamp())}_{file.filename}"
+@app.post("/api/upload", response_model=AttachmentResponse)
+async def upload_file(
+    file: UploadFile = File(...),
+    transaction_id: Optional[int] = Form(None),
+    planned_id: Optional[int] = Form(None),
+    r: Session = Depends(get_read_session),
+    s: Session = Depends(get_session),
+):
+    """Stream an upload to disk, deduplicated by SHA-256, and record an Attachment.
+
+    The attachment is linked to `transaction_id` and/or `planned_id` when given.
+    No connection is held while the file streams: the links are checked on
+    a reader that is released right away, and the writer is only taken for
+    the insert.
+    """
+    def check_links():
+        try:
+            if transaction_id is not None and not r.get(Transaction, transaction_id):
+                raise HTTPException(status_code=404, detail="transaction not found")
+            if planned_id is not None and not r.get(PlannedItem, planned_id):
+                raise HTTPException(status_code=404, detail="planned item not found")
+        finally:
+            r.close()
+
+    await run_in_threadpool(check_links)
     try:
-        with open(dest, "wb") as f:
-            content = await file.read()
-            f.write(content)
+        name, digest, size, dedup = await save_upload(file, UPLOAD_DIR)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    return {"filename": file.filename, "path": str(dest)}
+
+    def record():
+        a = Attachment(
+            filename=file.filename or name, path=str(UPLOAD_DIR / name), sha256=digest, size=size,
+            content_type=file.content_type, transaction_id=transaction_id, planned_id=planned_id,
+        )
+        s.add(a)
+        s.commit()
+        s.refresh(a)
+        return a
+
+    a = await run_in_threadpool(record)
+    return {**a.dict(exclude={"path"}), "name": name, "url": f"/api/uploads/{name}", "deduplicated": dedup}
 
 
 @app.get("/api/uploads/{name}")
-def serve_upload(name: str):
+def serve_upload(name: str, request: Request):
     p = UPLOAD_DIR / name
-    if not p.exists():
+    if name.startswith(".") or not p.is_file():
         raise HTTPException(status_code=404, detail="file not found")
-    return FileResponse(p)
+    media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    headers = {"Accept-Ranges": "bytes"}
+    range_header = request.headers.get("range")
+    if range_header:
+        partial = range_response(p, range_header, media_type, headers)
+        if partial is not None:
+            return partial
+    return FileResponse(p, media_type=media_type, headers=headers)
 
 
 @app.post("/api/categories", response_model=CategoryResponse)
-def create_category(cat: CategoryCreate):
+def create_category(cat: CategoryCreate, s: Session = Depends(get_session)):
+    if cat.parent_id is not None and not s.get(Category, cat.parent_id):
+        raise HTTPException(status_code=404, detail="parent category not found")
     c = Category(**cat.dict())
-    with get_session() as s:
-        s.add(c)
-        s.commit()
-        s.refresh(c)
+    s.add(c)
+    s.flush()
+    categories.add(s, c)
+    s.commit()
+    data_versions.bump("category")
+    s.refresh(c)
     return c
 
 
 @app.get("/api/categories", response_model=List[CategoryResponse])
-def list_categories():
-    with get_session() as s:
-        cats = s.exec(select(Category)).all()
-    return cats
+@cached("category")
+def list_categories(request: Request, s: Session = Depends(get_read_session)):
+    result = s.exec(select(*fastjson.columns(Category, CategoryResponse)))
+    return fastjson.rows_response(request, result.keys(), result, "category")
+
+
+@app.get("/api/categories/tree", response_model=List[CategoryTreeNode])
+def category_tree(
+    kind: str = Query("expenses", pattern="^(expenses|income|totals)$"),
+    month_from: Optional[str] = None,
+    month_to: Optional[str] = None,
+    currency: Optional[str] = None,
+    reporting_currency: Optional[str] = None,
+    s: Session = Depends(get_read_session),
+):
+    """All categories as a nested tree with totals for months `month_from`..`month_to` (YYYY-MM, inclusive).
+
+    `total` covers the category itself, `subtree_total` adds all its descendants.
+    Totals are in `currency` (only amounts in it count), else in
+    `reporting_currency` (default HOMEBUH_REPORTING_CURRENCY or USD),
+    each month converted at its month-end rate; a missing rate is a 422.
+    """
+    try:
+        return categories.tree(
+            s, kind=kind, month_from=month_from, month_to=month_to, currency=currency, convert_to=reporting_currency,
+        )
+    except MissingRate as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@app.patch("/api/categories/{category_id}", response_model=CategoryResponse)
+def update_category(category_id: int, upd: CategoryUpdate, s: Session = Depends(get_session)):
+    """Rename a category or move it, with its subcategories, under another parent."""
+    c = s.get(Category, category_id)
+    if not c:
+        raise HTTPException(status_code=404, detail="category not found")
+    fields = upd.dict(exclude_unset=True)
+    if "parent_id" in fields:
+        categories.move(s, c, fields["parent_id"])
+    if fields.get("name"):
+        c.name = fields["name"]
+        s.add(c)
+    s.commit()
+    data_versions.bump("category")
+    s.refresh(c)
+    return c
+
+
+@app.delete("/api/categories/{category_id}")
+def delete_category(category_id: int, s: Session = Depends(get_session)):
+    """Delete a category and its subcategories; their transactions become uncategorized."""
+    c = s.get(Category, category_id)
+    if not c:
+        raise HTTPException(status_code=404, detail="category not found")
+    deleted = categories.delete_subtree(s, c)
+    s.commit()
+    data_versions.bump("category", "transaction", "planneditem", "budget", "categoryrule")
+    return {"status": "ok", "deleted": deleted}
+
+
+@app.post("/api/rules", response_model=CategoryRuleResponse)
+def create_rule(rule: CategoryRuleCreate, s: Session = Depends(get_session)):
+    """Add an auto-categorization rule; it applies to later imports and to `POST /api/rules/apply`."""
+    if not s.get(Category, rule.category_id):
+        raise HTTPException(status_code=404, detail="category not found")
+    if not rule.pattern and rule.min_amount is None and rule.max_amount is None:
+        raise HTTPException(status_code=400, detail="a rule needs a pattern or an amount range")
+    rules.validate(rule.pattern, rule.is_regex)
+    data = from_api(rule.dict(), "categoryrule")
+    data["currency"] = data["currency"].upper()
+    r = CategoryRule(**data)
+    # Checked together: the matcher splices every regex rule into one pattern.
+    rules.check_combined(s.exec(select(CategoryRule)).all() + [r])
+    s.add(r)
+    s.commit()
+    data_versions.bump("categoryrule")
+    s.refresh(r)
+    rules.rule_cache.invalidate()
+    return api_view(r)
+
+
+@app.get("/api/rules", response_model=List[CategoryRuleResponse])
+def list_rules(s: Session = Depends(get_read_session)):
+    return [api_view(r) for r in s.exec(select(CategoryRule).order_by(CategoryRule.priority, CategoryRule.id)).all()]
+
+
+@app.delete("/api/rules/{rule_id}")
+def delete_rule(rule_id: int, s: Session = Depends(get_session)):
+    r = s.get(CategoryRule, rule_id)
+    if not r:
+        raise HTTPException(status_code=404, detail="rule not found")
+    s.delete(r)
+    s.commit()
+    data_versions.bump("categoryrule")
+    rules.rule_cache.invalidate()
+    return {"status": "ok"}
+
+
+@app.post("/api/rules/apply", response_model=CategorizeResponse)
+def apply_rules(all: bool = False, s: Session = Depends(get_session)):
+    """Categorize stored transactions by the rules: uncategorized ones, or with `all` every transaction."""
+    result = rules.backfill(s, only_uncategorized=not all)
+    data_versions.bump("transaction")
+    return result
 
 
 @app.post("/api/accounts", response_model=AccountResponse)
-def create_account(acc: AccountCreate):
-    a = Account(**acc.dict())
-    with get_session() as s:
-        s.add(a)
-        s.commit()
-        s.refresh(a)
-    return a
+def create_account(acc: AccountCreate, s: Session = Depends(get_session)):
+    """`balance` is the opening balance; afterwards the balance follows the account's transactions."""
+    data = from_api(acc.dict(), "account")
+    a = Account(**data, opening_balance=data["balance"])
+    s.add(a)
+    s.commit()
+    data_versions.bump("account")
+    s.refresh(a)
+    forecast_cache.invalidate_balances()
+    return api_view(a)
 
 
 @app.get("/api/accounts", response_model=List[AccountResponse])
-def list_accounts():
-    with get_session() as s:
-        accs = s.exec(select(Account)).all()
-    return accs
+@cached("account", "transaction")
+def list_accounts(request: Request, s: Session = Depends(get_read_session)):
+    result = s.exec(select(*fastjson.columns(Account, AccountResponse)))
+    return fastjson.rows_response(request, result.keys(), result, "account")
+
+
+@app.get("/api/accounts/{account_id}/balance", response_model=BalanceResponse)
+def account_balance(account_id: int, as_of: Optional[datetime] = None, s: Session = Depends(get_read_session)):
+    """Balance from every transaction dated before `as_of` (default now): nearest snapshot plus the transactions since."""
+    result = balances.balance_as_of(s, account_id, as_of or datetime.utcnow())
+    result["balance"] = to_major(result["balance"], result["currency"])
+    return result
 
 
 @app.post("/api/transactions", response_model=TransactionResponse)
-def create_transaction(tx: TransactionCreate):
-    t = Transaction(**tx.dict())
-    with get_session() as s:
-        s.add(t)
+def create_transaction(
+    tx: TransactionCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, max_length=idempotency.MAX_KEY_LENGTH),
+    s: Session = Depends(get_session),
+):
+    """Record a transaction. An `Idempotency-Key` header makes retries (e.g. an offline queue replay) safe."""
+    if idempotency_key:
+        fingerprint = idempotency.fingerprint(tx.dict())
+        replay = idempotency.lookup(s, "transaction", idempotency_key, fingerprint)
+        if replay is not None:
+            response.headers["Idempotent-Replayed"] = "true"
+            return replay
+    t = Transaction(**from_api(tx.dict(exclude_none=True), "transaction"))
+    s.add(t)
+    rollup.apply(s, t)
+    balances.apply(s, t)
+    if idempotency_key:
+        s.flush()
+        idempotency.record(s, "transaction", idempotency_key, fingerprint, api_view(t))
+    try:
         s.commit()
-        s.refresh(t)
-    return t
+    except IntegrityError:
+        s.rollback()
+        replay = idempotency.lookup(s, "transaction", idempotency_key, fingerprint) if idempotency_key else None
+        if replay is None:
+            raise
+        response.headers["Idempotent-Replayed"] = "true"
+        return replay
+    data_versions.bump("transaction", "account")
+    s.refresh(t)
+    forecast_cache.invalidate_balances()
+    return api_view(t)
+
+
+TX_PAGE_SIZE = 100
+TX_PAGE_MAX = 1000
+TX_STREAM_CHUNK = 500
+
+
+def _encode_cursor(ts: datetime, tx_id: int) -> str:
+    raw = f"{ts.isoformat()}|{tx_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def _decode_cursor(cursor: str):
+    try:
+        ts, tx_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(ts), int(tx_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+
+
+def _iter_ndjson(s: Session, stmt):
+    # stream_results keeps a server-side cursor open; rows are fetched in
+    # chunks instead of materializing the whole result set.
+    result = s.exec(stmt.execution_options(stream_results=True, yield_per=TX_STREAM_CHUNK))
+    for t in result:
+        yield TransactionResponse(**api_view(t)).json() + "\n"
 
 
 @app.get("/api/transactions", response_model=List[TransactionResponse])
-def list_transactions():
-    with get_session() as s:
-        txs = s.exec(select(Transaction).order_by(Transaction.timestamp.desc())).all()
-    return txs
+@cached("transaction")
+def list_transactions(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    account_id: Optional[int] = None,
+    category_id: Optional[int] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    min_amount: Optional[Decimal] = None,
+    max_amount: Optional[Decimal] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    s: Session = Depends(get_read_session),
+):
+    """List transactions newest first using keyset pagination on (timestamp, id).
+
+    `cursor` is the opaque value from the previous page's `X-Next-Cursor` header.
+    With `format=ndjson` all matching rows are streamed one JSON object per line
+    (bounded by `limit` only if it is given).
+    """
+    stmt = select(Transaction) if format == "ndjson" else select(*fastjson.columns(Transaction, TransactionResponse))
+    if account_id is not None:
+        stmt = stmt.where(Transaction.account_id == account_id)
+    if category_id is not None:
+        stmt = stmt.where(Transaction.category_id == category_id)
+    if date_from is not None:
+        stmt = stmt.where(Transaction.timestamp >= date_from)
+    if date_to is not None:
+        stmt = stmt.where(Transaction.timestamp < date_to)
+    # Amount bounds are in major units; compare in each row's own currency scale.
+    if min_amount is not None:
+        stmt = stmt.where(common_units(Transaction.amount, Transaction.currency) >= to_common(min_amount))
+    if max_amount is not None:
+        stmt = stmt.where(common_units(Transaction.amount, Transaction.currency) <= to_common(max_amount))
+    if cursor:
+        ts, tx_id = _decode_cursor(cursor)
+        stmt = stmt.where(tuple_(Transaction.timestamp, Transaction.id) < tuple_(ts, tx_id))
+    stmt = stmt.order_by(Transaction.timestamp.desc(), Transaction.id.desc())
+
+    if format == "ndjson":
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return StreamingResponse(_iter_ndjson(s, stmt), media_type="application/x-ndjson")
+
+    limit = min(limit or TX_PAGE_SIZE, TX_PAGE_MAX)
+    result = s.exec(stmt.limit(limit + 1))
+    keys = list(result.keys())
+    rows = result.all()
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = dict(zip(keys, rows[-1]))
+        headers["X-Next-Cursor"] = _encode_cursor(last["timestamp"], last["id"])
+    return fastjson.rows_response(request, keys, rows, "transaction", headers)
+
+
+@app.get("/api/transactions/search", response_model=List[TransactionSearchHit])
+def search_transactions(
+    response: Response,
+    q: str = Query(..., min_length=1),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    account_id: Optional[int] = None,
+    category_id: Optional[int] = None,
+    limit: int = Query(search.DEFAULT_LIMIT, ge=1, le=search.MAX_LIMIT),
+    offset: int = Query(0, ge=0),
+    s: Session = Depends(get_read_session),
+):
+    """Full-text search over descriptions and attachment names, best match first.
+
+    `q` takes words, "phrases", prefix* terms and OR; `snippet` marks the
+    matched words in the description with [brackets].
+    """
+    if search.to_match(q) is None:
+        raise HTTPException(status_code=400, detail="query has no search terms")
+    started = time.perf_counter()
+    hits = search.search(s, q, date_from=date_from, date_to=date_to, account_id=account_id,
+                         category_id=category_id, limit=limit, offset=offset)
+    response.headers["Server-Timing"] = f"search;dur={(time.perf_counter() - started) * 1000:.1f}"
+    return [{**api_view(t), "rank": rank, "snippet": snippet} for t, rank, snippet in hits]
+
+
+@app.post("/api/transactions/bulk", response_model=BulkImportResponse)
+def bulk_import_transactions(
+    file: UploadFile = File(...),
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson|ofx)$"),
+    batch_size: int = Query(importer.DEFAULT_BATCH_SIZE, ge=1, le=50000),
+    account_id: Optional[int] = None,
+    s: Session = Depends(get_session),
+):
+    """Import a CSV, NDJSON or OFX statement in one DB transaction.
+
+    The format is taken from `format` or the file extension. Rows failing
+    TransactionCreate validation are skipped and listed in `errors`.
+    """
+    fmt = format or importer.detect_format(file.filename)
+    if not fmt:
+        raise HTTPException(status_code=400, detail="cannot detect file format, pass ?format=csv|ndjson|ofx")
+    result = importer.import_stream(s, importer.text_stream(file.file), fmt, batch_size=batch_size, account_id=account_id)
+    data_versions.bump("transaction", "account")
+    forecast_cache.invalidate_balances()
+    return result
+
+
+@app.get("/api/export")
+def export_transactions(
+    format: str = "csv",
+    since: Optional[int] = Query(None, ge=0),
+    watermark: Optional[str] = Query(None, min_length=1, max_length=100),
+    s: Session = Depends(get_read_session),
+    w: Session = Depends(get_session),
+):
+    """Stream transactions with category and account names as CSV or Parquet, in id order.
+
+    Only ids after `since` are exported; with `watermark` (a name, e.g. the
+    consuming job) `since` defaults to where the previous export under that
+    name stopped, and the position is saved once this one has been fully
+    sent. `X-Export-Watermark` is the last id the export covers.
+
+    Rows stream from a reader connection; the writer session connects
+    only for the short watermark update at the end.
+    """
+    export.check_format(format)
+    since, upper = export.bounds(s, since, watermark)
+    headers = {
+        "Content-Disposition": f'attachment; filename="transactions-{since + 1}-{upper}.{format}"',
+        "X-Export-Since": str(since),
+        "X-Export-Watermark": str(upper),
+    }
+    return StreamingResponse(
+        export.stream(s, format, since, upper, watermark, writer=w), media_type=export.MEDIA_TYPES[format], headers=headers
+    )
+
+
+@app.get("/api/sync", response_model=SyncResponse)
+def sync_changes(
+    request: Request,
+    since: int = Query(0, ge=0),
+    limit: int = Query(sync.DEFAULT_LIMIT, ge=1, le=sync.MAX_LIMIT),
+    s: Session = Depends(get_read_session),
+):
+    """Rows of every synced table changed or deleted after cursor `since` (0: everything).
+
+    Apply `changes` in order, store `cursor` and call again while `more` is
+    true. With `reset` the client's copy is from another database: drop it
+    and apply this page as a fresh snapshot.
+    """
+    return fastjson.body_response(request, orjson.dumps(sync.changes(s, since, limit)))
 
 
 @app.post("/api/budgets", response_model=BudgetResponse)
-def create_budget(b: BudgetCreate):
-    budget = Budget(**b.dict())
-    with get_session() as s:
-        s.add(budget)
-        s.commit()
-        s.refresh(budget)
-    return budget
+def create_budget(b: BudgetCreate, s: Session = Depends(get_session)):
+    budget = Budget(**from_api(b.dict(), "budget"))
+    s.add(budget)
+    s.commit()
+    data_versions.bump("budget")
+    s.refresh(budget)
+    return api_view(budget)
 
 
 @app.get("/api/budgets", response_model=List[BudgetResponse])
-def list_budgets():
-    with get_session() as s:
-        bs = s.exec(select(Budget)).all()
-    return bs
+@cached("budget")
+def list_budgets(request: Request, s: Session = Depends(get_read_session)):
+    result = s.exec(select(*fastjson.columns(Budget, BudgetResponse)))
+    return fastjson.rows_response(request, result.keys(), result, "budget")
+
+
+@app.get("/api/budgets/{year_month}/status", response_model=BudgetStatusResponse)
+def budget_status(
+    year_month: str,
+    currency: Optional[str] = None,
+    reporting_currency: Optional[str] = None,
+    s: Session = Depends(get_read_session),
+):
+    """Budget vs actual spending for a month (YYYY-MM), per budgeted category.
+
+    Actual spending of a category includes its subcategories. `daily_burn`
+    is spending per elapsed day; `projected` extends it to the month's end.
+    Amounts are in `currency` (only spending in it counts), else in
+    `reporting_currency` (default HOMEBUH_REPORTING_CURRENCY or USD),
+    converted at the month-end rate; a missing rate is a 422.
+    """
+    try:
+        return budgets.budget_status(s, year_month, currency=currency, convert_to=reporting_currency)
+    except MissingRate as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
 
 @app.post("/api/planned", response_model=PlannedItemResponse)
-def create_planned(p: PlannedItemCreate):
-    item = PlannedItem(**p.dict())
-    with get_session() as s:
-        s.add(item)
-        s.commit()
-        s.refresh(item)
-    return item
+def create_planned(p: PlannedItemCreate, s: Session = Depends(get_session)):
+    account = None
+    if p.account_id is not None:
+        account = s.get(Account, p.account_id)
+        if not account:
+            raise HTTPException(status_code=404, detail="account not found")
+    data = p.dict()
+    data["currency"] = data["currency"] or (account.currency if account else "USD")
+    item = PlannedItem(**from_api(data, "planneditem"))
+    s.add(item)
+    s.commit()
+    data_versions.bump("planneditem")
+    s.refresh(item)
+    forecast_cache.invalidate_item(item)
+    return api_view(item)
 
 
 @app.get("/api/planned", response_model=List[PlannedItemResponse])
-def list_planned():
-    with get_session() as s:
-        ps = s.exec(select(PlannedItem)).all()
-    return ps
+@cached("planneditem")
+def list_planned(request: Request, s: Session = Depends(get_read_session)):
+    result = s.exec(select(*fastjson.columns(PlannedItem, PlannedItemResponse)))
+    return fastjson.rows_response(request, result.keys(), result, "planneditem")
+
+
+@app.get("/api/forecast", response_model=ForecastResponse)
+def cash_flow_forecast(
+    response: Response,
+    months: int = Query(3, ge=1, le=MAX_MONTHS),
+    account_id: Optional[int] = None,
+    reporting_currency: Optional[str] = None,
+    s: Session = Depends(get_read_session),
+):
+    """Projected daily balance per account (and in total) from today for `months` months.
+
+    Starts from the current Account.balance and applies planned items,
+    repeating recurring ones. Served from forecast_cache; only days
+    invalidated by writes since the last call are recomputed. Planned
+    amounts in another currency than their account, and the total, are
+    converted at today's rates (`reporting_currency`, default
+    HOMEBUH_REPORTING_CURRENCY or USD); a missing rate is a 422.
+    """
+    started = time.perf_counter()
+    try:
+        result = forecast_cache.get(s, months=months, account_id=account_id, currency=reporting_currency)
+    except MissingRate as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    response.headers["Server-Timing"] = f"forecast;dur={(time.perf_counter() - started) * 1000:.1f}"
+    return result
+
+
+@app.post("/api/fx/rates", response_model=FxLoadResponse)
+def load_fx_rates(file: UploadFile = File(...), s: Session = Depends(get_session)):
+    """Load exchange rates from a CSV with columns date,base,quote,rate; existing days are updated."""
+    try:
+        loaded = fx.load_csv(s, importer.text_stream(file.file))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    data_versions.bump("fxrate")
+    return {"loaded": loaded}
+
+
+@app.get("/api/fx/rate", response_model=FxRateResponse)
+def get_fx_rate(base: str, quote: str, on: Optional[str] = Query(None, alias="date"), s: Session = Depends(get_read_session)):
+    """Rate in effect on `date` (default today): the latest loaded on or before it, inverse or via the pivot currency."""
+    try:
+        day = datetime.strptime(on, "%Y-%m-%d").date() if on else datetime.utcnow().date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="date must be YYYY-MM-DD")
+    try:
+        rate = rates.rate(s, base, quote, day)
+    except MissingRate as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"base": base.upper(), "quote": quote.upper(), "date": day.isoformat(), "rate": rate}
+
+
+def _finite(values) -> List[Optional[float]]:
+    # NaN marks an empty period and is not valid JSON.
+    return [None if v != v else v for v in values.tolist()]
+
+
+@app.get("/api/analytics/trend", response_model=TrendResponse)
+def analytics_trend(
+    response: Response,
+    freq: str = "day",
+    kind: str = "expenses",
+    window: int = Query(30, ge=1, le=366),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    account_id: Optional[int] = None,
+    category_id: Optional[int] = None,
+    currency: Optional[str] = None,
+    reporting_currency: Optional[str] = None,
+    chart: bool = False,
+    s: Session = Depends(get_read_session),
+):
+    """Totals per day, week or month with a trailing `window`-period mean and the median / 90th percentile
+    of single transactions; `chart=true` also renders a line chart of the moving average (of the totals if window=1).
+
+    Amounts are in `currency` (only transactions in it count), else in
+    `reporting_currency` (default HOMEBUH_REPORTING_CURRENCY or USD),
+    converted at month-end rates; a missing rate is a 422.
+    """
+    if freq not in analytics.FREQS:
+        raise HTTPException(status_code=400, detail=f"unsupported freq: {freq}")
+    started = time.perf_counter()
+    try:
+        cols = analytics.load(s, kind, date_from=date_from, date_to=date_to, account_id=account_id,
+                              category_id=category_id, currency=currency, convert_to=reporting_currency)
+    except MissingRate as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    load_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    series = analytics.resample(cols, freq)
+    moving = analytics.rolling(series.totals, window)
+    pct = analytics.percentiles(cols, freq, (50, 90))
+    compute_ms = (time.perf_counter() - started) * 1000
+    response.headers["Server-Timing"] = f"load;dur={load_ms:.1f}, compute;dur={compute_ms:.1f}"
+    labels = analytics.labels(series.periods)
+    url = None
+    if chart and labels:
+        plotted = moving if window > 1 else series.totals
+        title = f"{kind} per {freq}" + (f", {window}-{freq} mean" if window > 1 else "")
+        (_, chart_path), = render_charts(
+            [{"type": "line", "labels": labels, "values": plotted.tolist(), "title": title}], reports_store
+        )
+        if chart_path is None:
+            raise HTTPException(status_code=500, detail="chart rendering failed")
+        url = f"/api/uploads_report/{chart_path.name}"
+    return {
+        "freq": freq, "window": window, "currency": (currency or fx.reporting_currency(reporting_currency)).upper(),
+        "labels": labels,
+        "values": series.totals.tolist(), "rolling": moving.tolist(),
+        "p50": _finite(pct[50]), "p90": _finite(pct[90]), "counts": series.counts.tolist(), "chart": url,
+    }
+
+
+@app.get("/api/analytics/yoy", response_model=YoYResponse)
+def analytics_yoy(
+    year: Optional[int] = Query(None, ge=1971, le=9999),
+    kind: str = "expenses",
+    reporting_currency: Optional[str] = None,
+    s: Session = Depends(get_read_session),
+):
+    """Per-category totals of `year` (default: this year) against the same span of the year before.
+
+    Amounts are converted into `reporting_currency` (default
+    HOMEBUH_REPORTING_CURRENCY or USD) at month-end rates; a missing rate is a 422.
+    """
+    today = datetime.utcnow().date()
+    year = year or today.year
+    through = analytics.default_through(year, today)
+    try:
+        cols = analytics.load(
+            s, kind, date_from=datetime(year - 1, 1, 1), date_to=datetime(year + 1, 1, 1), convert_to=reporting_currency,
+        )
+    except MissingRate as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    items = analytics.year_over_year(cols, year, through)
+    ids = [i["category_id"] for i in items if i["category_id"] is not None]
+    names = dict(s.exec(select(Category.id, Category.name).where(Category.id.in_(ids))).all()) if ids else {}
+    return {
+        "year": year, "through": through.isoformat(), "currency": fx.reporting_currency(reporting_currency),
+        "items": [dict(i, name=names.get(i["category_id"])) for i in items],
+    }
 
 
 @app.post("/api/report")
-def generate_report(query: dict):
+async def generate_report(query: dict, s: Session = Depends(get_read_session)):
     """Generate a simple report. Expected JSON: {"type":"expenses_by_category","year_month":"2025-12"} or {"query":"free text"}
+    `type` is `<expenses|income|totals>_by_<category|account|month|day>`; `currency` narrows to one currency,
+    `reporting_currency` (default HOMEBUH_REPORTING_CURRENCY) converts all amounts into one.
     If OPENAI_API_KEY set, will forward prompt to OpenAI (user must configure key).
     """
     prompt = query.get("query")
-    # If openai key present, we can optionally forward. For now return a generated chart from data.
-    with get_session() as s:
-        txs = s.exec(select(Transaction)).all()
-    # simple aggregation by category id
-    buckets = {}
-    labels = []
-    values = []
-    for t in txs:
-        key = str(t.category_id or "Uncategorized")
-        buckets[key] = buckets.get(key, 0) + (t.amount or 0)
-    for k, v in buckets.items():
-        labels.append(k)
-        values.append(v)
-
-    from pathlib import Path
-    out = Path(__file__).resolve().parent / "reports"
-    out.mkdir(parents=True, exist_ok=True)
-    chart_path = out / f"report_{int(datetime.utcnow().timestamp())}.png"
-    if labels:
-        generate_bar_chart(labels, values, chart_path)
-    else:
-        # create empty placeholder
-        with open(chart_path, "wb") as f:
-            f.write(b"")
+    kind, group_by = parse_report_type(query.get("type"))
+    reporting_currency = query.get("reporting_currency") or REPORTING_CURRENCY
+    buckets = await run_in_threadpool(
+        aggregate, s, group_by=group_by, kind=kind, year_month=query.get("year_month"), currency=query.get("currency"),
+        convert_to=reporting_currency,
+    )
+    labels = [b.label for b in buckets]
+    values = [float(b.total) for b in buckets]
+
+    (_, chart_path), = await run_in_threadpool(render_charts, [{"type": "bar", "labels": labels, "values": values}], reports_store)
+    if chart_path is None:
+        raise HTTPException(status_code=500, detail="chart rendering failed")
 
     text = "AI report placeholder."
-    # If OPENAI_API_KEY provided, user can change below to call API
     if os.getenv("OPENAI_API_KEY") and prompt:
         try:
-            import requests, json
-            # Basic example: call OpenAI completions (user must adapt to API version)
-            # This is a fallback example; recommend using server-side OpenAI official SDK.
-            api_key = os.getenv("OPENAI_API_KEY")
-            resp = requests.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
-                json={"model":"gpt-4o-mini","messages":[{"role":"user","content": prompt}], "max_tokens":500},
-                timeout=15,
-            )
-            if resp.status_code == 200:
-                j = resp.json()
-                text = j.get("choices", [{}])[0].get("message", {}).get("content", text)
-        except Exception:
+            text = await llm.chat([{"role": "user", "content": prompt}], max_tokens=500) or text
+        except LLMError:
             pass
 
-    return {"text": text, "chart": f"/api/uploads_report/{chart_path.name}"}
+    return {
+        "text": text, "chart": f"/api/uploads_report/{chart_path.name}", "labels": labels, "values": values,
+        "currency": reporting_currency.upper() if reporting_currency else query.get("currency"),
+    }
 
 
 @app.get("/api/uploads_report/{name}")
-def serve_report(name: str):
-    p = Path(__file__).resolve().parent / "reports" / name
-    if not p.exists():
+def serve_report(name: str, request: Request):
+    p = reports_store.get(name)
+    if p is None:
         raise HTTPException(status_code=404, detail="report not found")
+    if name.startswith("chart_"):
+        # Content-addressed: the file name is a hash of its inputs and never changes.
+        etag = f'"{p.stem}"'
+        headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return FileResponse(p, media_type="image/png", headers=headers)
     return FileResponse(p)
 
 
+@app.get("/api/reports/metrics")
+def reports_metrics():
+    """Report artifact store statistics: hit rate, bytes stored, evictions."""
+    return reports_store.metrics()
+
+
+@app.get("/api/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """Request latency per route and time spent in DB, chart and LLM calls, in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/api/debug/profile", response_class=PlainTextResponse)
+async def debug_profile(
+    seconds: float = Query(10, gt=0, le=metrics.MAX_PROFILE_SECONDS),
+    idle: bool = False,
+):
+    """Sample all threads for `seconds` and return collapsed stacks (flamegraph.pl, speedscope).
+
+    Enabled by HOMEBUH_PROFILING=1. Threads blocked in a wait are left out
+    unless `idle` is set.
+    """
+    if not metrics.PROFILING:
+        raise HTTPException(status_code=404, detail="profiling is disabled (set HOMEBUH_PROFILING=1)")
+    try:
+        stacks = await run_in_threadpool(metrics.sample, seconds, idle=idle)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    name = f"homebuh-{datetime.utcnow():%Y%m%d-%H%M%S}.folded"
+    return PlainTextResponse(
+        metrics.collapsed(stacks), headers={"Content-Disposition": f'attachment; filename="{name}"'},
+    )
+
+
 def _extract_json_from_text(s: str):
     # Try to extract JSON block from model output (strip markdown code fences)
     # Common patterns: ```json { ... } ``` or { ... }
@@ -239,7 +831,7 @@ def _extract_json_from_text(s: str):
 
 
 @app.post("/api/ai/chat", response_model=AIReportResponse)
-def ai_chat(request: AIReportRequest):
+async def ai_chat(request: AIReportRequest, response: Response, s: Session = Depends(get_read_session)):
     """Interactive AI-driven report generation.
     Expected body: {"prompt": "user text describing required report"}
 
@@ -251,32 +843,31 @@ def ai_chat(request: AIReportRequest):
       ]
     }
 
-    If `OPENAI_API_KEY` is present, server will forward a structured prompt to OpenAI.
+    If `OPENAI_API_KEY` is present, server will forward a structured prompt to OpenAI,
+    grounded with a compact digest of the user's data (see summary.py).
     Otherwise server will attempt to generate a simple sample report from transactions.
     """
-    prompt = request.get("prompt") or request.get("query") or ""
+    prompt = request.prompt or request.query or ""
     if not prompt:
         raise HTTPException(status_code=400, detail="prompt required")
 
     # If no API key, generate fallback sample
+    def released(fn, *args, **kwargs):
+        # Give the reader back before the slow part (LLM call, chart rendering).
+        try:
+            return fn(s, *args, **kwargs)
+        finally:
+            s.close()
+
     if not os.getenv("OPENAI_API_KEY"):
-        # simple aggregation by category
-        with get_session() as s:
-            txs = s.exec(select(Transaction)).all()
-        buckets = {}
-        for t in txs:
-            key = str(t.category_id or "Uncategorized")
-            buckets[key] = buckets.get(key, 0) + (t.amount or 0)
-        labels = list(buckets.keys())
-        values = [buckets[k] for k in labels]
-        outdir = Path(__file__).resolve().parent / "reports"
-        outdir.mkdir(parents=True, exist_ok=True)
-        chart_path = outdir / f"ai_report_{int(datetime.utcnow().timestamp())}.png"
-        if labels:
-            generate_bar_chart(labels, values, chart_path)
-        else:
-            with open(chart_path, "wb") as f:
-                f.write(b"")
+        buckets = await run_in_threadpool(released, aggregate, group_by="category")
+        labels = [b.label for b in buckets]
+        values = [float(b.total) for b in buckets]
+        (_, chart_path), = await run_in_threadpool(
+            render_charts, [{"type": "bar", "labels": labels, "values": values, "title": "Sample aggregation"}], reports_store
+        )
+        if chart_path is None:
+            raise HTTPException(status_code=500, detail="chart rendering failed")
         return {"text": "Fallback AI disabled — sample aggregation.", "charts": [{"url": f"/api/uploads_report/{chart_path.name}", "title": "Sample aggregation"}]}
 
     # Build system prompt for OpenAI
@@ -284,102 +875,82 @@ def ai_chat(request: AIReportRequest):
         "You are an assistant that returns a JSON object describing a financial report. "
         "The JSON MUST contain keys: 'text' (string) and optionally 'charts' (array). "
         "Each chart must be an object with 'type' (bar|line|pie), 'labels' (array of strings), 'values' (array of numbers), 'title' (string). "
-        "Return JSON only. Do not include extra commentary. If unsure, return empty charts array."
+        "Return JSON only. Do not include extra commentary. If unsure, return empty charts array. "
+        "Use only the labels and numbers from the data summary below; do not invent data."
     )
+    digest = await run_in_threadpool(released, digest_cache.get_or_build)
+    system = f"{system}\n\nData summary:\n{digest.text}"
 
     messages = [
         {"role": "system", "content": system},
         {"role": "user", "content": prompt},
     ]
 
-    api_key = os.getenv("OPENAI_API_KEY")
+    prompt_tokens = estimate_tokens(system) + estimate_tokens(prompt)
+    started = time.perf_counter()
     try:
-        import requests
-        payload = {
-            "model": "gpt-4o-mini",
-            "messages": messages,
-            "temperature": 0.2,
-            "max_tokens": 800,
-        }
-        resp = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
-            json=payload,
-            timeout=30,
-        )
-        if resp.status_code != 200:
-            raise HTTPException(status_code=502, detail=f"OpenAI error: {resp.status_code}")
-        j = resp.json()
-        text_out = j.get("choices", [])[0].get("message", {}).get("content", "")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"AI call failed: {e}")
+        text_out = await llm.chat(messages, temperature=0.2, max_tokens=800)
+    except LLMError as e:
+        raise HTTPException(status_code=502, detail=f"AI call failed: {e}")
+    llm_ms = (time.perf_counter() - started) * 1000
+    log.info(
+        "ai_chat prompt_tokens~%d digest_tokens~%d digest_ms=%.1f digest_cached=%s llm_ms=%.1f",
+        prompt_tokens, digest.tokens, digest.build_ms, digest.cached, llm_ms,
+    )
+    response.headers["Server-Timing"] = f"digest;dur={digest.build_ms:.1f}, llm;dur={llm_ms:.1f}"
+    response.headers["X-Prompt-Tokens"] = str(prompt_tokens)
 
     # Try parse JSON from model
     parsed = _extract_json_from_text(text_out)
     if not parsed:
         raise HTTPException(status_code=500, detail="Failed to parse JSON from AI response")
 
-    charts_info = parsed.get("charts", [])
-    results = []
-    outdir = Path(__file__).resolve().parent / "reports"
-    outdir.mkdir(parents=True, exist_ok=True)
-
-    for idx, ch in enumerate(charts_info):
-        ctype = ch.get("type")
-        labels = ch.get("labels", [])
-        values = ch.get("values", [])
-        title = ch.get("title", f"chart_{idx}")
-        fname = f"ai_chart_{int(datetime.utcnow().timestamp())}_{idx}.png"
-        outpath = outdir / fname
-        try:
-            if ctype == "bar":
-                generate_bar_chart(labels, values, outpath)
-            elif ctype == "line":
-                generate_line_chart(labels, values, outpath)
-            elif ctype == "pie":
-                generate_pie_chart(labels, values, outpath)
-            else:
-                # unsupported type -> skip
-                continue
-            results.append({"title": title, "url": f"/api/uploads_report/{fname}"})
-        except Exception:
-            continue
+    charts_info = [ch for ch in parsed.get("charts", []) if isinstance(ch, dict)]
+    specs = [dict(ch, title=ch.get("title", f"chart_{idx}")) for idx, ch in enumerate(charts_info)]
+    # All charts render in parallel in the worker pool; unsupported or failed ones are skipped.
+    rendered = await run_in_threadpool(render_charts, specs, reports_store)
+    results = [
+        {"title": spec["title"], "url": f"/api/uploads_report/{path.name}"}
+        for spec, path in rendered
+        if path is not None
+    ]
 
     return {"text": parsed.get("text", ""), "charts": results}
 
 
 @app.post("/api/transfer", response_model=TransferResponse)
-def transfer(req: TransferRequest):
-    """Transfer amount between accounts. Creates two transactions and updates balances."""
-    if req.amount <= 0:
-        raise HTTPException(status_code=400, detail="amount must be positive")
-    with get_session() as s:
-        src = s.get(Account, req.from_account_id)
-        dst = s.get(Account, req.to_account_id)
-        if not src or not dst:
-            raise HTTPException(status_code=404, detail="account not found")
-        if src.id == dst.id:
-            raise HTTPException(status_code=400, detail="source and destination must differ")
-        # basic currency check omitted (assume same currency)
-        if src.balance < req.amount:
-            raise HTTPException(status_code=400, detail="insufficient funds")
-
-        # adjust balances
-        src.balance = src.balance - req.amount
-        dst.balance = dst.balance + req.amount
-
-        desc1 = req.description or f"Transfer to account {dst.name}"
-        desc2 = req.description or f"Transfer from account {src.name}"
-
-        tx1 = Transaction(amount=-abs(req.amount), currency=req.currency or "USD", account_id=src.id, description=desc1)
-        tx2 = Transaction(amount=abs(req.amount), currency=req.currency or "USD", account_id=dst.id, description=desc2)
-
-        s.add(src)
-        s.add(dst)
-        s.add(tx1)
-        s.add(tx2)
+def transfer(
+    req: TransferRequest,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, max_length=idempotency.MAX_KEY_LENGTH),
+    s: Session = Depends(get_session),
+):
+    """Transfer amount between accounts. Creates two transactions and updates balances.
+
+    With an `Idempotency-Key` header a retried request returns the first
+    response (marked `Idempotent-Replayed: true`) instead of posting again.
+    """
+    if idempotency_key:
+        fingerprint = idempotency.fingerprint(req.dict())
+        replay = idempotency.lookup(s, "transfer", idempotency_key, fingerprint)
+        if replay is not None:
+            response.headers["Idempotent-Replayed"] = "true"
+            return replay
+
+    tx1, tx2 = transfers.post(s, req.from_account_id, req.to_account_id, req.amount, req.currency, req.description)
+    body = {"status": "ok", "from_tx": api_view(tx1), "to_tx": api_view(tx2)}
+    if idempotency_key:
+        idempotency.record(s, "transfer", idempotency_key, fingerprint, body)
+    try:
         s.commit()
-        s.refresh(tx1)
-        s.refresh(tx2)
-
-    return {"status": "ok", "from_tx": tx1, "to_tx": tx2}
+    except IntegrityError:
+        # A concurrent request with the same key committed first.
+        s.rollback()
+        replay = idempotency.lookup(s, "transfer", idempotency_key, fingerprint) if idempotency_key else None
+        if replay is None:
+            raise
+        response.headers["Idempotent-Replayed"] = "true"
+        return replay
+    data_versions.bump("transaction", "account")
+    forecast_cache.invalidate_balances()
+    return body
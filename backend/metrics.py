@@ -0,0 +1,300 @@
+"""Request metrics, timing spans and a sampling profiler.
+
+`MetricsMiddleware` records every request's latency in a histogram labelled
+by method, route template and status. Code on the hot paths reports where
+the time went with `span(...)`. SQL statements are timed through
+SQLAlchemy cursor events on every engine ("db"). Chart rendering
+(`utils.render_charts`, "chart") and OpenAI calls (`ai_client`, "llm") are
+wrapped by hand. Spans go to a second histogram and to the response's
+Server-Timing header, so the browser's network panel shows them per
+request. `/api/metrics` renders both histograms in the Prometheus text
+format. No client library is needed.
+
+`/api/debug/profile?seconds=N` samples the stacks of all threads for N
+seconds and returns them in the collapsed format that flamegraph.pl,
+speedscope and inferno read. It is off unless HOMEBUH_PROFILING=1, and one
+profile runs at a time.
+
+    python -m backend.metrics bench [--queries 100000]
+"""
+import argparse
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILING = os.getenv("HOMEBUH_PROFILING", "") == "1"
+PROFILE_INTERVAL_MS = float(os.getenv("HOMEBUH_PROFILE_INTERVAL_MS", "5"))
+MAX_PROFILE_SECONDS = 60
+
+# Seconds; fine at the low end for SQL statements, up to slow LLM replies.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Prometheus histogram with labels; observations are counted in their bucket and summed on output."""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str], buckets: Sequence[float] = BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self._series: Dict[tuple, list] = {}
+
+    def observe(self, seconds: float, *values: str):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += seconds
+
+    def snapshot(self) -> Dict[tuple, Tuple[List[int], float]]:
+        with self._lock:
+            return {k: (list(counts), total) for k, (counts, total) in self._series.items()}
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total) in sorted(self.snapshot().items()):
+            labels = [f'{k}="{_escape(v)}"' for k, v in zip(self.labels, values)]
+            series = "{" + ",".join(labels) + "}" if labels else ""
+            running = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                running += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket = ",".join(labels + [f'le="{le}"'])
+                lines.append(f"{self.name}_bucket{{{bucket}}} {running}")
+            lines.append(f"{self.name}_sum{series} {total!r}")
+            lines.append(f"{self.name}_count{series} {running}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+request_seconds = Histogram(
+    "homebuh_request_duration_seconds", "Time from request to the last byte of the response.",
+    ("method", "route", "status"),
+)
+span_seconds = Histogram("homebuh_span_duration_seconds", "Time spent in database, chart and LLM calls.", ("span",))
+
+# Extra gauges for /api/metrics: name -> (documentation, callable returning the value).
+gauges: Dict[str, Tuple[str, Callable[[], float]]] = {}
+
+
+def render() -> str:
+    lines = request_seconds.render() + span_seconds.render()
+    for name, (documentation, read) in sorted(gauges.items()):
+        lines += [f"# HELP {name} {documentation}", f"# TYPE {name} gauge", f"{name} {read()!r}"]
+    return "\n".join(lines) + "\n"
+
+
+def clear():
+    request_seconds.clear()
+    span_seconds.clear()
+
+
+# ---- spans ----
+
+# Span totals of the current request: name -> [seconds, count]. The
+# middleware puts a fresh dict here; handlers run in a copy of its context
+# (threadpool included) and so add to the same dict.
+_request_spans: ContextVar[Optional[Dict[str, list]]] = ContextVar("homebuh_spans", default=None)
+
+
+def record(name: str, seconds: float):
+    span_seconds.observe(seconds, name)
+    spans = _request_spans.get()
+    if spans is not None:
+        entry = spans.setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+
+
+@contextmanager
+def span(name: str):
+    """Time the block as span `name`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("homebuh_query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _query_done(conn, cursor, statement, parameters, context, executemany):
+    record("db", time.perf_counter() - conn.info["homebuh_query_started"].pop())
+
+
+@event.listens_for(Engine, "handle_error")
+def _query_failed(context):
+    started = context.connection.info.get("homebuh_query_started") if context.connection is not None else None
+    if started:
+        record("db", time.perf_counter() - started.pop())
+
+
+def server_timing(spans: Dict[str, list], existing: str = "") -> str:
+    """Server-Timing entries for `spans`, after the ones a handler set itself (which win)."""
+    named = {part.split(";", 1)[0].strip() for part in existing.split(",") if part.strip()}
+    parts = [existing] if existing else []
+    for name, (seconds, count) in spans.items():
+        if name not in named:
+            parts.append(f'{name};dur={seconds * 1000:.1f};desc="{count} calls"')
+    return ", ".join(parts)
+
+
+class MetricsMiddleware:
+    """ASGI middleware: request latency histogram and span totals in Server-Timing.
+
+    Plain ASGI rather than BaseHTTPMiddleware, so streamed responses pass
+    through untouched and are timed to their last byte.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        spans: Dict[str, list] = {}
+        token = _request_spans.set(spans)
+        status = 500
+
+        async def send_timed(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if spans:
+                    headers = [(k, v) for k, v in message.get("headers", []) if k.lower() != b"server-timing"]
+                    existing = b", ".join(v for k, v in message.get("headers", []) if k.lower() == b"server-timing")
+                    headers.append((b"server-timing", server_timing(spans, existing.decode("latin-1")).encode("latin-1")))
+                    message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            _request_spans.reset(token)
+            # The router stores the matched route in the scope; label by its
+            # template so /api/accounts/1 and /api/accounts/2 are one series.
+            route = scope.get("route")
+            request_seconds.observe(
+                time.perf_counter() - started, scope["method"], getattr(route, "path", "unmatched"), str(status),
+            )
+
+
+# ---- sampling profiler ----
+
+_profiling = threading.Lock()
+
+# Innermost frames of threads that are waiting, not working.
+_IDLE = {
+    ("threading.py", "wait"), ("selectors.py", "select"), ("queue.py", "get"),
+    ("connection.py", "wait"), ("connection.py", "_recv"), ("thread.py", "_worker"),
+}
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample(seconds: float, interval: float = PROFILE_INTERVAL_MS / 1000, idle: bool = False) -> Counter:
+    """Sample every thread's stack each `interval` s for `seconds` s; returns collapsed stack -> samples.
+
+    Stacks run from the thread name down to the innermost frame. Threads
+    blocked in a wait are skipped unless `idle`. Raises RuntimeError if a
+    profile is already running.
+    """
+    if not _profiling.acquire(blocking=False):
+        raise RuntimeError("a profile is already running")
+    try:
+        me = threading.get_ident()
+        stacks: Counter = Counter()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                code = frame.f_code
+                if not idle and (os.path.basename(code.co_filename), code.co_name) in _IDLE:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                frames.append(names.get(ident, f"thread-{ident}").replace(" ", "_"))
+                stacks[";".join(reversed(frames))] += 1
+            time.sleep(interval)
+        return stacks
+    finally:
+        _profiling.release()
+
+
+def collapsed(stacks: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def bench(queries: int = 100_000, rounds: int = 5):
+    """Cost of the per-statement timing on small SELECTs, and of a histogram observation."""
+    from sqlalchemy import create_engine, text
+
+    listeners = (("before_cursor_execute", _query_started), ("after_cursor_execute", _query_done))
+    engine = create_engine("sqlite://")
+    stmt = text("SELECT 1")
+    best = {True: float("inf"), False: float("inf")}
+    with engine.connect() as conn:
+        # Alternating rounds, best of each: one long run per mode mostly measures warm-up and noise.
+        for _ in range(rounds):
+            for timed in (False, True):
+                for name, fn in listeners:
+                    (event.listen if timed else event.remove)(Engine, name, fn)
+                started = time.perf_counter()
+                for _ in range(queries):
+                    conn.execute(stmt).scalar()
+                best[timed] = min(best[timed], (time.perf_counter() - started) / queries * 1e6)
+
+    h = Histogram("bench", "bench", ("route",))
+    started = time.perf_counter()
+    for i in range(queries):
+        h.observe(i % 1000 / 10_000, "/api/transactions")
+    observe_us = (time.perf_counter() - started) / queries * 1e6
+    print(f"SELECT 1: {best[False]:.1f} us untimed, {best[True]:.1f} us timed "
+          f"(+{best[True] - best[False]:.1f} us per statement, best of {rounds})")
+    print(f"histogram observation: {observe_us:.2f} us")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m backend.metrics")
+    sub = parser.add_subparsers(dest="command", required=True)
+    b = sub.add_parser("bench", help="overhead of statement timing and histogram observations")
+    b.add_argument("--queries", type=int, default=100_000)
+    args = parser.parse_args(argv)
+    bench(args.queries)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,23 +1,57 @@
 from typing import Optional
 from sqlmodel import SQLModel, Field, Relationship
-from datetime import datetime
+from sqlalchemy import BigInteger, Column, Index
+from datetime import date, datetime
+
+def Money(**kwargs):
+    """Integer amount in the currency's minor unit (see money.py).
+
+    BIGINT so sums and balances don't overflow 32 bits on Postgres.
+    """
+    if "default" in kwargs:
+        kwargs["sa_column"] = Column(BigInteger, nullable=False, server_default=str(kwargs["default"]))
+    else:
+        kwargs["sa_column"] = Column(BigInteger, nullable=False)
+    return Field(**kwargs)
 
 class Category(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
     parent_id: Optional[int] = Field(default=None, foreign_key="category.id")
     children: list["Category"] = Relationship(back_populates="parent", sa_relationship_kwargs={"cascade":"all,delete"})
-    parent: Optional["Category"] = Relationship(back_populates="children")
+    parent: Optional["Category"] = Relationship(back_populates="children", sa_relationship_kwargs={"remote_side":"Category.id"})
+
+class CategoryClosure(SQLModel, table=True):
+    """Transitive closure of the category tree: one row per (ancestor, descendant), self included.
+
+    Maintained by categories.py on create, move and delete.
+    """
+    __table_args__ = (
+        Index("ix_categoryclosure_descendant", "descendant_id", "ancestor_id"),
+    )
+
+    ancestor_id: int = Field(foreign_key="category.id", primary_key=True)
+    descendant_id: int = Field(foreign_key="category.id", primary_key=True)
+    depth: int = 0
 
 class Account(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
-    balance: float = 0.0
+    balance: int = Money(default=0)  # opening_balance + ledger, kept in step by balances.py
     currency: str = "USD"
+    opening_balance: int = Money(default=0)
 
 class Transaction(SQLModel, table=True):
+    # Composite indexes back keyset pagination on (timestamp, id), optionally
+    # narrowed to one account or category (see list_transactions).
+    __table_args__ = (
+        Index("ix_transaction_timestamp_id", "timestamp", "id"),
+        Index("ix_transaction_account_timestamp_id", "account_id", "timestamp", "id"),
+        Index("ix_transaction_category_timestamp_id", "category_id", "timestamp", "id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    amount: float
+    amount: int = Money()
     currency: str = "USD"
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     description: Optional[str] = None
@@ -25,22 +59,109 @@ class Transaction(SQLModel, table=True):
     category_id: Optional[int] = Field(default=None, foreign_key="category.id")
 
 class Budget(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_budget_year_month_category", "year_month", "category_id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     year_month: str  # format YYYY-MM
     category_id: Optional[int] = Field(default=None, foreign_key="category.id")
-    amount: float
+    amount: int = Money()
+    currency: str = Field(default="USD", sa_column_kwargs={"server_default": "USD"})
 
 class PlannedItem(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     title: str
-    amount: float
+    amount: int = Money()
+    currency: str = Field(default="USD", sa_column_kwargs={"server_default": "USD"})
     due_date: Optional[datetime] = None
     type: str = "expense"  # or 'income'
     category_id: Optional[int] = Field(default=None, foreign_key="category.id")
+    account_id: Optional[int] = Field(default=None, foreign_key="account.id")
+    recurrence: Optional[str] = None  # None (once), 'weekly', 'monthly' or 'yearly'
+    recurrence_end: Optional[datetime] = None
 
 class Attachment(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     filename: str
     path: str
-    transaction_id: Optional[int] = Field(default=None, foreign_key="transaction.id")
+    sha256: Optional[str] = Field(default=None, index=True)
+    size: Optional[int] = None
+    content_type: Optional[str] = None
+    transaction_id: Optional[int] = Field(default=None, foreign_key="transaction.id", index=True)
     planned_id: Optional[int] = Field(default=None, foreign_key="planneditem.id")
+
+class CategoryRule(SQLModel, table=True):
+    """Auto-categorization rule: description pattern and/or amount range -> category (see rules.py)."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    category_id: int = Field(foreign_key="category.id", index=True)
+    pattern: Optional[str] = None
+    is_regex: bool = False
+    min_amount: Optional[int] = Field(default=None, sa_column=Column(BigInteger))
+    max_amount: Optional[int] = Field(default=None, sa_column=Column(BigInteger))
+    currency: str = "USD"
+    priority: int = 100
+
+class MonthlyRollup(SQLModel, table=True):
+    """Per-month totals maintained alongside Transaction writes (see rollup.py)."""
+    __table_args__ = (
+        Index("ix_monthlyrollup_key", "year_month", "category_id", "account_id", "currency", unique=True),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    year_month: str  # format YYYY-MM
+    category_id: Optional[int] = Field(default=None, foreign_key="category.id")
+    account_id: Optional[int] = Field(default=None, foreign_key="account.id")
+    currency: str = "USD"
+    total: int = Money(default=0)
+    count: int = 0
+    min_amount: int = Money(default=0)
+    max_amount: int = Money(default=0)
+    expense_total: int = Money(default=0)  # sum of negative amounts, stored as a positive number
+    expense_count: int = 0
+    income_total: int = Money(default=0)
+    income_count: int = 0
+
+class FxRate(SQLModel, table=True):
+    """1 `base` = `rate` `quote` from `day` until the pair's next row (see fx.py)."""
+    __table_args__ = (
+        Index("ix_fxrate_pair_day", "base", "quote", "day", unique=True),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    day: date
+    base: str
+    quote: str
+    rate: float  # a ratio, not money; converted amounts are rounded to minor units
+
+class IdempotencyKey(SQLModel, table=True):
+    """Stored response of a request sent with an Idempotency-Key header (see idempotency.py)."""
+    scope: str = Field(primary_key=True)  # endpoint name
+    key: str = Field(primary_key=True)
+    request_hash: str
+    response: str  # JSON body
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class BalanceSnapshot(SQLModel, table=True):
+    """Account balance from all transactions dated before `as_of` (see balances.py)."""
+    account_id: int = Field(foreign_key="account.id", primary_key=True)
+    as_of: datetime = Field(primary_key=True)
+    balance: int = Money()
+
+class ExportWatermark(SQLModel, table=True):
+    """Last transaction id a named incremental export has delivered (see export.py)."""
+    name: str = Field(primary_key=True)
+    last_id: int = 0
+    exported_at: datetime = Field(default_factory=datetime.utcnow)
+
+class ChangeLog(SQLModel, table=True):
+    """Latest write to each synced row; the id is the sync cursor (see sync.py)."""
+    __table_args__ = (
+        Index("ix_changelog_row", "table_name", "row_id", unique=True),
+        {"sqlite_autoincrement": True},  # ids of deleted entries are never handed out again
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    table_name: str
+    row_id: int
+    deleted: bool = False
@@ -0,0 +1,157 @@
+"""Money amounts as integers in the currency's minor unit.
+
+Account.balance and opening_balance, Transaction.amount, Budget.amount,
+PlannedItem.amount and the MonthlyRollup sums are stored as integer counts
+of the smallest unit (cents for USD, yen for JPY, fils for BHD), so every
+SUM runs on integers and is exact. The API speaks Decimal major units;
+`to_minor`/`to_major` convert at the edge using the currency's ISO 4217
+exponent.
+
+Sums across currencies (reports without a currency filter) first scale
+each amount to `COMMON_EXPONENT` decimals with `common_units`, which keeps
+them integer, then convert once with `from_common`.
+
+    python -m backend.money bench [--rows 1000000]
+"""
+import argparse
+import random
+import sqlite3
+import sys
+import time
+from decimal import ROUND_HALF_EVEN, Decimal
+from typing import Optional, Union
+
+from sqlalchemy import case
+
+DEFAULT_CURRENCY = "USD"
+DEFAULT_EXPONENT = 2
+# Currencies whose minor unit is not 1/100 (ISO 4217).
+EXPONENTS = {
+    "BIF": 0, "CLP": 0, "DJF": 0, "GNF": 0, "ISK": 0, "JPY": 0, "KMF": 0, "KRW": 0,
+    "PYG": 0, "RWF": 0, "UGX": 0, "UYI": 0, "VND": 0, "VUV": 0, "XAF": 0, "XOF": 0, "XPF": 0,
+    "BHD": 3, "IQD": 3, "JOD": 3, "KWD": 3, "LYD": 3, "OMR": 3, "TND": 3,
+}
+COMMON_EXPONENT = max(EXPONENTS.values())
+# Largest magnitude accepted in major units (exclusive). Far inside BIGINT
+# even in COMMON_EXPONENT units, so sums of many such amounts still fit.
+MAX_AMOUNT = Decimal(10) ** 12
+
+# Money columns per table; older versions stored them as REAL major units.
+MONEY_FIELDS = {
+    "account": ("balance", "opening_balance"),
+    "transaction": ("amount",),
+    "categoryrule": ("min_amount", "max_amount"),
+    "budget": ("amount",),
+    "planneditem": ("amount",),
+}
+
+Number = Union[Decimal, int, float, str]
+
+
+def exponent(currency: Optional[str]) -> int:
+    return EXPONENTS.get((currency or DEFAULT_CURRENCY).upper(), DEFAULT_EXPONENT)
+
+
+def to_minor(value: Number, currency: Optional[str] = DEFAULT_CURRENCY) -> int:
+    """Major units -> integer minor units; extra decimals are rounded half-to-even.
+
+    Raises OverflowError beyond MAX_AMOUNT and decimal.InvalidOperation for
+    values that are not numbers (NaN, "abc").
+    """
+    d = value if isinstance(value, Decimal) else Decimal(str(value))
+    if not abs(d) < MAX_AMOUNT:
+        raise OverflowError(f"amount out of range: {value}")
+    return int(d.scaleb(exponent(currency)).quantize(Decimal(1), rounding=ROUND_HALF_EVEN))
+
+
+def to_major(minor: Optional[int], currency: Optional[str] = DEFAULT_CURRENCY) -> Decimal:
+    return Decimal(int(minor or 0)).scaleb(-exponent(currency))
+
+
+def from_api(data: dict, table: str) -> dict:
+    """Convert the money fields of request data for `table` to minor units, in place."""
+    for field in MONEY_FIELDS[table]:
+        if data.get(field) is not None:
+            data[field] = to_minor(data[field], data.get("currency"))
+    return data
+
+
+def api_view(obj) -> dict:
+    """Column values of a model instance with money fields in Decimal major units."""
+    data = obj.dict()
+    for field in MONEY_FIELDS.get(obj.__tablename__, ()):
+        if data[field] is not None:
+            data[field] = to_major(data[field], data.get("currency"))
+    return data
+
+
+def _by_exponent(currency_column, factor):
+    """SQL CASE mapping each row's currency exponent through `factor`."""
+    groups = {}
+    for code, exp in EXPONENTS.items():
+        groups.setdefault(exp, []).append(code)
+    whens = [(currency_column.in_(codes), factor(exp)) for exp, codes in sorted(groups.items())]
+    return case(*whens, else_=factor(DEFAULT_EXPONENT))
+
+
+def minor_factor(currency_column):
+    """SQL expression giving 10**exponent for each row's currency (major -> minor units)."""
+    return _by_exponent(currency_column, lambda exp: 10 ** exp)
+
+
+def common_units(column, currency_column):
+    """SQL expression scaling a minor-unit column to COMMON_EXPONENT decimals (still an integer)."""
+    return column * _by_exponent(currency_column, lambda exp: 10 ** (COMMON_EXPONENT - exp))
+
+
+def from_common(value: Optional[int]) -> Decimal:
+    return Decimal(int(value or 0)).scaleb(-COMMON_EXPONENT)
+
+
+def to_common(value: Number) -> int:
+    """Major units -> COMMON_EXPONENT units, to compare against `common_units` in filters."""
+    d = value if isinstance(value, Decimal) else Decimal(str(value))
+    return int(d.scaleb(COMMON_EXPONENT).quantize(Decimal(1), rounding=ROUND_HALF_EVEN))
+
+
+def bench(rows: int = 1_000_000, seed: int = 7):
+    """Compare REAL and INTEGER storage of the same amounts: SUM speed and exactness."""
+    rnd = random.Random(seed)
+    cents = [rnd.randint(-500_000, 200_000) for _ in range(rows)]
+    exact = sum(to_major(c) for c in cents)
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE t_real (id INTEGER PRIMARY KEY, month INTEGER, amount REAL)")
+    conn.execute("CREATE TABLE t_int (id INTEGER PRIMARY KEY, month INTEGER, amount INTEGER)")
+    conn.executemany("INSERT INTO t_real (month, amount) VALUES (?, ?)", ((i % 120, c / 100) for i, c in enumerate(cents)))
+    conn.executemany("INSERT INTO t_int (month, amount) VALUES (?, ?)", ((i % 120, c) for i, c in enumerate(cents)))
+    for table in ("t_real", "t_int"):
+        conn.execute(f"CREATE INDEX ix_{table} ON {table} (month, amount)")
+    results = {}
+    for table in ("t_real", "t_int"):
+        best = float("inf")
+        for _ in range(3):
+            started = time.perf_counter()
+            total = conn.execute(f"SELECT SUM(amount) FROM {table}").fetchone()[0]
+            conn.execute(f"SELECT month, SUM(amount) FROM {table} GROUP BY month").fetchall()
+            best = min(best, time.perf_counter() - started)
+        results[table] = (best, total)
+    real_total = Decimal(repr(results["t_real"][1]))
+    int_total = to_major(results["t_int"][1])
+    print(f"{rows} rows, exact sum {exact}")
+    print(f"REAL:    {results['t_real'][0] * 1000:.1f} ms, sum {real_total} (error {real_total - exact})")
+    print(f"INTEGER: {results['t_int'][0] * 1000:.1f} ms, sum {int_total} (error {int_total - exact})")
+    return exact, int_total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m backend.money")
+    sub = parser.add_subparsers(dest="command", required=True)
+    b = sub.add_parser("bench", help="REAL vs INTEGER amount storage on synthetic rows")
+    b.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args(argv)
+    bench(args.rows)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
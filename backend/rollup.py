@@ -0,0 +1,208 @@
+"""Incrementally maintained monthly totals.
+
+`MonthlyRollup` holds one row per (year_month, category_id, account_id,
+currency), with sums in integer minor units. Writers call `apply`/`apply_many` in the same session before
+committing, so the rollup moves together with the Transaction rows it
+summarizes. `rebuild` recomputes everything from the ledger for backfill:
+
+    python -m backend.rollup rebuild
+"""
+import sys
+from collections import defaultdict
+from datetime import datetime
+from typing import Iterable
+
+from sqlalchemy import case, delete, func, insert, update
+from sqlmodel import Session, select
+
+from .models import MonthlyRollup, Transaction
+
+KEY_COLUMNS = ("year_month", "category_id", "account_id", "currency")
+
+
+def _key_filter(key):
+    conds = []
+    for name, value in zip(KEY_COLUMNS, key):
+        col = getattr(MonthlyRollup, name)
+        conds.append(col.is_(None) if value is None else col == value)
+    return conds
+
+
+def _delta(amounts):
+    expenses = [a for a in amounts if a < 0]
+    incomes = [a for a in amounts if a > 0]
+    return {
+        "total": sum(amounts),
+        "count": len(amounts),
+        "min_amount": min(amounts),
+        "max_amount": max(amounts),
+        "expense_total": -sum(expenses),
+        "expense_count": len(expenses),
+        "income_total": sum(incomes),
+        "income_count": len(incomes),
+    }
+
+
+def _merge(s: Session, key, d):
+    r = MonthlyRollup
+    result = s.exec(
+        update(r)
+        .where(*_key_filter(key))
+        .values(
+            total=r.total + d["total"],
+            count=r.count + d["count"],
+            min_amount=case((r.min_amount > d["min_amount"], d["min_amount"]), else_=r.min_amount),
+            max_amount=case((r.max_amount < d["max_amount"], d["max_amount"]), else_=r.max_amount),
+            expense_total=r.expense_total + d["expense_total"],
+            expense_count=r.expense_count + d["expense_count"],
+            income_total=r.income_total + d["income_total"],
+            income_count=r.income_count + d["income_count"],
+        )
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        s.exec(insert(r).values(**dict(zip(KEY_COLUMNS, key)), **d))
+
+
+def tx_key(tx: Transaction):
+    return (tx.timestamp.strftime("%Y-%m"), tx.category_id, tx.account_id, tx.currency or "USD")
+
+
+def _fold(s: Session, keyed_amounts):
+    grouped = defaultdict(list)
+    for key, amount in keyed_amounts:
+        grouped[key].append(amount or 0)
+    for key, amounts in grouped.items():
+        _merge(s, key, _delta(amounts))
+
+
+def apply_many(s: Session, txs: Iterable[Transaction]):
+    """Fold new transactions into the rollup. Does not commit."""
+    _fold(s, ((tx_key(tx), tx.amount) for tx in txs))
+
+
+def apply_keyed(s: Session, keyed_amounts: Iterable[tuple]):
+    """Fold (key, amount) pairs, key as in KEY_COLUMNS, into the rollup. Does not commit."""
+    _fold(s, keyed_amounts)
+
+
+def apply_mappings(s: Session, rows: Iterable[dict]):
+    """Like apply_many, for plain column dicts written with executemany."""
+    _fold(s, (
+        ((r["timestamp"].strftime("%Y-%m"), r.get("category_id"), r.get("account_id"), r.get("currency") or "USD"), r["amount"])
+        for r in rows
+    ))
+
+
+def apply(s: Session, tx: Transaction):
+    apply_many(s, [tx])
+
+
+def reassign_categories(s: Session, category_ids: Iterable[int], new_category_id=None):
+    """Fold the rollup rows of `category_ids` into `new_category_id`. Does not commit.
+
+    Used when categories are deleted and their transactions re-pointed.
+    """
+    r = MonthlyRollup
+    ids = list(category_ids)
+    rows = s.exec(select(r).where(r.category_id.in_(ids))).all()
+    moved = [
+        ((row.year_month, new_category_id, row.account_id, row.currency), {
+            "total": row.total, "count": row.count,
+            "min_amount": row.min_amount, "max_amount": row.max_amount,
+            "expense_total": row.expense_total, "expense_count": row.expense_count,
+            "income_total": row.income_total, "income_count": row.income_count,
+        })
+        for row in rows
+    ]
+    s.exec(delete(r).where(r.category_id.in_(ids)).execution_options(synchronize_session=False))
+    for key, d in moved:
+        _merge(s, key, d)
+
+
+SUMMARY_COLUMNS = [
+    "total", "count", "min_amount", "max_amount",
+    "expense_total", "expense_count", "income_total", "income_count",
+]
+
+
+def _summary_columns():
+    t = Transaction
+    amount = func.coalesce(t.amount, 0)
+    exprs = [
+        func.sum(amount),
+        func.count(t.id),
+        func.min(amount),
+        func.max(amount),
+        -func.sum(case((amount < 0, amount), else_=0)),
+        func.sum(case((amount < 0, 1), else_=0)),
+        func.sum(case((amount > 0, amount), else_=0)),
+        func.sum(case((amount > 0, 1), else_=0)),
+    ]
+    return [e.label(name) for e, name in zip(exprs, SUMMARY_COLUMNS)]
+
+
+def refresh_keys(s: Session, keys: Iterable[tuple]):
+    """Recompute the rollup rows for `keys` from the ledger. Does not commit.
+
+    For writes that move transactions out of a key: min/max cannot be
+    un-merged, so the rows they leave are summed again.
+    """
+    t = Transaction
+    for key in set(keys):
+        year_month, category_id, account_id, currency = key
+        year, month = map(int, year_month.split("-"))
+        start = datetime(year, month, 1)
+        end = datetime(year + month // 12, month % 12 + 1, 1)
+        stmt = select(*_summary_columns()).where(
+            t.timestamp >= start, t.timestamp < end, func.coalesce(t.currency, "USD") == currency,
+            t.category_id.is_(None) if category_id is None else t.category_id == category_id,
+            t.account_id.is_(None) if account_id is None else t.account_id == account_id,
+        )
+        values = dict(zip(SUMMARY_COLUMNS, s.exec(stmt).one()))
+        s.exec(delete(MonthlyRollup).where(*_key_filter(key)).execution_options(synchronize_session=False))
+        if values["count"]:
+            s.exec(insert(MonthlyRollup).values(**dict(zip(KEY_COLUMNS, key)), **values))
+
+
+def rebuild(s: Session) -> int:
+    """Recompute the whole rollup from Transaction rows and commit. Returns the row count."""
+    from .aggregates import period_expr
+
+    t = Transaction
+    month = period_expr(s, "month")
+    currency = func.coalesce(t.currency, "USD")
+    src = (
+        select(month, t.category_id, t.account_id, currency, *_summary_columns())
+        .group_by(month, t.category_id, t.account_id, currency)
+    )
+    s.exec(delete(MonthlyRollup))
+    s.exec(insert(MonthlyRollup).from_select(list(KEY_COLUMNS) + SUMMARY_COLUMNS, src))
+    s.commit()
+    return s.exec(select(func.count(MonthlyRollup.id))).one()
+
+
+def ensure_built(s: Session):
+    """Backfill the rollup once for databases created before it existed."""
+    has_rollup = s.exec(select(MonthlyRollup.id).limit(1)).first() is not None
+    has_txs = s.exec(select(Transaction.id).limit(1)).first() is not None
+    if has_txs and not has_rollup:
+        rebuild(s)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv != ["rebuild"]:
+        print("usage: python -m backend.rollup rebuild", file=sys.stderr)
+        return 2
+    from .db import engine, init_db
+
+    init_db()
+    with Session(engine) as s:
+        rows = rebuild(s)
+    print(f"rollup rebuilt: {rows} rows")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
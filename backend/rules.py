@@ -0,0 +1,356 @@
+"""Rule-based auto-categorization.
+
+A `CategoryRule` maps a description pattern (case-insensitive substring or
+regex) and/or a signed amount range to a category; when several rules fit
+a transaction the lowest `priority` (then the oldest rule) wins. Amount
+bounds are in the rule's currency and only apply to transactions in it.
+
+`Matcher` compiles the rules into two combined regexes instead of running
+each rule's pattern in turn: the substrings as one trie-shaped alternation,
+so each position of the description is tried once against all of them (like
+an Aho-Corasick automaton), and the regexes as one alternation that screens
+out descriptions no regex rule matches. Rules with only an amount range are
+checked last, in priority order.
+
+The bulk importer categorizes rows that arrive without a category;
+`backfill` does the same for uncategorized transactions already stored:
+
+    python -m backend.rules apply [--all]
+    python -m backend.rules bench [--rows 1000000] [--rules 300]
+"""
+import argparse
+import random
+import re
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import bindparam, func, update
+from sqlmodel import Session, select
+
+from . import rollup
+from .models import CategoryRule, Transaction
+
+BACKFILL_BATCH = 5000
+
+# Backreferences and named groups break once patterns are spliced into the
+# combined regex.
+_UNSUPPORTED = re.compile(r"\\\d|\(\?P[<=]")
+# Global inline flags, e.g. "(?i)uber", are only allowed at the start of a
+# whole regex, which a spliced-in pattern is not. Case is ignored anyway.
+_GLOBAL_FLAGS = re.compile(r"\(\?[aiLmsux]+\)")
+
+
+def validate(pattern: Optional[str], is_regex: bool):
+    """Raise 400 for a pattern the matcher cannot use."""
+    if not pattern or not is_regex:
+        return
+    if _UNSUPPORTED.search(pattern):
+        raise HTTPException(status_code=400, detail="backreferences and named groups are not supported in rule patterns")
+    if _GLOBAL_FLAGS.search(pattern):
+        raise HTTPException(
+            status_code=400,
+            detail="inline flags like (?i) are not supported in rule patterns; matching already ignores case",
+        )
+    try:
+        re.compile(f"(?:{pattern})")
+    except re.error as e:
+        raise HTTPException(status_code=400, detail=f"invalid regex: {e}")
+
+
+def check_combined(rules: List[CategoryRule]):
+    """Raise 422 if `rules` together cannot be compiled into a Matcher."""
+    try:
+        Matcher(rules)
+    except re.error as e:
+        raise HTTPException(status_code=422, detail=f"rule patterns cannot be combined: {e}")
+
+
+def _trie_regex(words) -> str:
+    """Regex source matching any of `words`, branching like a trie so each position is tried once.
+
+    Where one word is a prefix of another the longer one is tried first,
+    so a match is the longest word starting at that position.
+    """
+    trie: dict = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def emit(node) -> str:
+        branches = [re.escape(ch) + emit(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return emit(trie)
+
+
+class Matcher:
+    def __init__(self, rules: List[CategoryRule]):
+        rules = sorted(rules, key=lambda r: (r.priority, r.id or 0))
+        self._categories = [r.category_id for r in rules]
+        self._bounds = [
+            None if r.min_amount is None and r.max_amount is None else (r.currency, r.min_amount, r.max_amount)
+            for r in rules
+        ]
+        literals: Dict[str, List[int]] = {}
+        self._patterns: Dict[int, re.Pattern] = {}
+        self._amount_only: List[int] = []
+        alternatives = []
+        for i, r in enumerate(rules):
+            if r.pattern and not r.is_regex:
+                literals.setdefault(r.pattern.lower(), []).append(i)
+            elif r.pattern:
+                self._patterns[i] = re.compile(r.pattern, re.IGNORECASE)
+                alternatives.append(f"(?:{r.pattern})")
+            elif self._bounds[i] is not None:
+                self._amount_only.append(i)
+        # The longest literal found at a position stands for every literal
+        # that is a prefix of it: all of them match there too.
+        self._by_literal = {
+            word: sorted(i for k in range(1, len(word) + 1) for i in literals.get(word[:k], ()))
+            for word in literals
+        }
+        self._literals = re.compile(_trie_regex(literals), re.IGNORECASE) if literals else None
+        self._regexes = re.compile("|".join(alternatives), re.IGNORECASE) if alternatives else None
+
+    def __len__(self):
+        return len(self._categories)
+
+    def _fits(self, i: int, amount: int, currency: Optional[str]) -> bool:
+        bounds = self._bounds[i]
+        if bounds is None:
+            return True
+        rule_currency, low, high = bounds
+        return (
+            (currency or "USD") == rule_currency
+            and (low is None or amount >= low)
+            and (high is None or amount <= high)
+        )
+
+    def match(self, description: Optional[str], amount: int, currency: Optional[str] = "USD") -> Optional[int]:
+        """Category id of the best rule for a transaction (amount in minor units), or None."""
+        best = len(self._categories)
+        if description and self._literals is not None:
+            # search() rather than finditer: restarting one character after
+            # each match start also finds overlapping literals.
+            m = self._literals.search(description)
+            while m is not None:
+                for i in self._by_literal.get(m.group().lower(), ()):
+                    if i >= best:
+                        break
+                    if self._fits(i, amount, currency):
+                        best = i
+                        break
+                if best == 0:
+                    return self._categories[0]
+                m = self._literals.search(description, m.start() + 1)
+        # The combined regex only tells whether any regex rule matches; the
+        # few that can beat `best` are then tried in priority order.
+        if description and self._regexes is not None and self._regexes.search(description):
+            for i, pattern in self._patterns.items():
+                if i >= best:
+                    break
+                if self._fits(i, amount, currency) and pattern.search(description):
+                    best = i
+                    break
+        for i in self._amount_only:
+            if i >= best:
+                break
+            if self._fits(i, amount, currency):
+                best = i
+                break
+        return self._categories[best] if best < len(self._categories) else None
+
+
+class RuleCache:
+    """The compiled Matcher for the current rules, rebuilt when CategoryRule changes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._matcher = Matcher([])
+        self._version = None
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+    def get(self, s: Session) -> Matcher:
+        version = tuple(s.exec(select(func.count(CategoryRule.id), func.max(CategoryRule.id))).one())
+        with self._lock:
+            if version == self._version:
+                return self._matcher
+        matcher = Matcher(s.exec(select(CategoryRule)).all())
+        with self._lock:
+            self._matcher, self._version = matcher, version
+        return matcher
+
+
+rule_cache = RuleCache()
+
+
+def backfill(s: Session, only_uncategorized: bool = True, batch_size: int = BACKFILL_BATCH) -> dict:
+    """Categorize stored transactions by the rules and commit. Returns counts and throughput.
+
+    By default only uncategorized transactions are looked at; with
+    `only_uncategorized=False` every transaction is re-evaluated and ones
+    that no rule matches keep their category. Rows are read in id windows
+    and updated with executemany; the rollup rows they leave are recomputed
+    and the ones they join are merged into.
+    """
+    started = time.perf_counter()
+    matcher = rule_cache.get(s)
+    t = Transaction
+    stmt = update(t.__table__).where(t.__table__.c.id == bindparam("tx_id")).values(category_id=bindparam("new_category"))
+    scanned = changed = 0
+    last_id = (s.exec(select(func.max(t.id))).one() or 0) if len(matcher) else 0
+    left, joined = set(), []
+    # Windows of the primary key rather than "category_id IS NULL ORDER BY
+    # id", which SQLite answers from the category index and re-sorts for
+    # every batch.
+    for start in range(0, last_id, batch_size):
+        batch = s.exec(
+            select(t.id, t.description, t.amount, t.currency, t.timestamp, t.account_id, t.category_id)
+            .where(t.id > start, t.id <= start + batch_size)
+        ).all()
+        moved = []
+        for tx_id, description, amount, currency, ts, account_id, category_id in batch:
+            if only_uncategorized and category_id is not None:
+                continue
+            scanned += 1
+            new = matcher.match(description, amount, currency)
+            if new is not None and new != category_id:
+                moved.append({"tx_id": tx_id, "new_category": new})
+                month, currency = ts.strftime("%Y-%m"), currency or "USD"
+                left.add((month, category_id, account_id, currency))
+                joined.append(((month, new, account_id, currency), amount))
+        if moved:
+            s.execute(stmt, moved)
+            changed += len(moved)
+    # Once at the end: each rollup row is merged into a single time.
+    rollup.apply_keyed(s, joined)
+    rollup.refresh_keys(s, left)
+    s.commit()
+    seconds = time.perf_counter() - started
+    return {
+        "scanned": scanned,
+        "categorized": changed,
+        "seconds": round(seconds, 4),
+        "rows_per_second": round(scanned / seconds, 1) if seconds > 0 else 0.0,
+    }
+
+
+WORDS = [
+    "uber", "lyft", "starbucks", "amazon", "whole foods", "shell", "netflix", "spotify", "icloud", "airbnb",
+    "delta", "costco", "walgreens", "home depot", "ikea", "пятёрочка", "яндекс", "аптека", "мтс", "перекрёсток",
+]
+
+
+def bench(rows: int = 1_000_000, n_rules: int = 300, seed: int = 5):
+    """Combined matcher vs testing rules one by one, then a backfill on a synthetic ledger."""
+    from sqlalchemy import insert, text
+    from sqlmodel import SQLModel, create_engine
+    from sqlmodel.pool import StaticPool
+
+    from .models import Category
+
+    rnd = random.Random(seed)
+    merchants = [f"{rnd.choice(WORDS)} {i:04d}" for i in range(n_rules)]
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as s:
+        s.execute(insert(Category.__table__), [{"name": f"bench-{i}"} for i in range(20)])
+        rule_rows = []
+        for i, merchant in enumerate(merchants):
+            kind = i % 10
+            row = {"category_id": i % 20 + 1, "pattern": merchant, "is_regex": False, "min_amount": None, "max_amount": None,
+                   "currency": "USD", "priority": 100}
+            if kind == 0:
+                row.update(pattern=re.escape(merchant).replace(r"\ ", r"\s+") + r"\b", is_regex=True)
+            elif kind == 1:
+                row.update(max_amount=-1000, priority=50)
+            rule_rows.append(row)
+        rule_rows.append({"category_id": 1, "pattern": None, "is_regex": False, "currency": "USD",
+                          "min_amount": -500, "max_amount": -1, "priority": 500})
+        s.execute(insert(CategoryRule.__table__), rule_rows)
+        s.commit()
+
+        descriptions = [
+            f"POS {rnd.choice(merchants).upper()} store {rnd.randint(1, 999)}" if rnd.random() < 0.7 else f"card payment {rnd.randint(1, 99999)}"
+            for _ in range(1000)
+        ]
+        s.execute(text("CREATE TEMP TABLE bench_description (k INTEGER PRIMARY KEY, d TEXT)"))
+        s.execute(text("INSERT INTO bench_description VALUES (:k, :d)"), [{"k": k, "d": d} for k, d in enumerate(descriptions)])
+        s.execute(text(
+            "WITH RECURSIVE seq(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM seq WHERE i < :last) "
+            'INSERT INTO "transaction" (amount, currency, timestamp, description, account_id) '
+            "SELECT -(i * 7919) % 20000 - 1, 'USD', datetime('2020-01-01', '+' || (i * 26280 / :last) || ' hours') || '.000000', "
+            "b.d, i % 5 + 1 FROM seq JOIN bench_description b ON b.k = i % :n"
+        ), {"last": rows - 1, "n": len(descriptions)})
+        s.commit()
+        rollup.rebuild(s)
+
+        stored = s.exec(select(CategoryRule)).all()
+        matcher = Matcher(stored)
+        sample = s.exec(select(Transaction.description, Transaction.amount, Transaction.currency).limit(100_000)).all()
+        one_by_one = [
+            (r.category_id, re.compile(r.pattern if r.is_regex else re.escape(r.pattern), re.IGNORECASE) if r.pattern else None,
+             matcher._bounds[i])
+            for i, r in enumerate(sorted(stored, key=lambda r: (r.priority, r.id)))
+        ]
+
+        def naive(description, amount, currency):
+            for category_id, pattern, bounds in one_by_one:
+                if pattern is not None and not (description and pattern.search(description)):
+                    continue
+                if bounds is not None and not (currency == bounds[0] and (bounds[1] is None or amount >= bounds[1])
+                                               and (bounds[2] is None or amount <= bounds[2])):
+                    continue
+                return category_id
+            return None
+
+        started = time.perf_counter()
+        combined = [matcher.match(*row) for row in sample]
+        combined_s = time.perf_counter() - started
+        started = time.perf_counter()
+        expected = [naive(*row) for row in sample]
+        naive_s = time.perf_counter() - started
+        assert combined == expected
+        result = backfill(s)
+    print(f"{len(stored)} rules, {len(sample)} sample rows")
+    print(f"combined matcher: {len(sample) / combined_s:,.0f} rows/s; rule by rule: {len(sample) / naive_s:,.0f} rows/s")
+    print(f"backfill of {rows} transactions: {result['categorized']} categorized in {result['seconds']} s "
+          f"({result['rows_per_second']:,.0f} rows/s)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m backend.rules")
+    sub = parser.add_subparsers(dest="command", required=True)
+    a = sub.add_parser("apply", help="categorize stored transactions by the rules")
+    a.add_argument("--all", action="store_true", help="re-evaluate categorized transactions too")
+    b = sub.add_parser("bench", help="matcher and backfill throughput on synthetic transactions")
+    b.add_argument("--rows", type=int, default=1_000_000)
+    b.add_argument("--rules", type=int, default=300)
+    args = parser.parse_args(argv)
+
+    if args.command == "bench":
+        bench(args.rows, args.rules)
+        return 0
+    from .db import engine, init_db
+
+    init_db()
+    with Session(engine) as s:
+        result = backfill(s, only_uncategorized=not args.all)
+    print(f"categorized {result['categorized']} of {result['scanned']} transactions in {result['seconds']}s "
+          f"({result['rows_per_second']} rows/s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
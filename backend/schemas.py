@@ -1,7 +1,15 @@
 """Pydantic schemas for request/response validation."""
-from pydantic import BaseModel, Field
-from typing import Optional, List
+from pydantic import BaseModel, Field, condecimal
+from typing import Dict, Optional, List
 from datetime import datetime
+from decimal import Decimal
+
+from .money import COMMON_EXPONENT, MAX_AMOUNT
+
+# A money amount in a request: in range for storage, with no more decimals
+# than any currency has (fewer are rounded to the currency's exponent).
+Money = condecimal(gt=-MAX_AMOUNT, lt=MAX_AMOUNT, decimal_places=COMMON_EXPONENT)
+PositiveMoney = condecimal(gt=0, lt=MAX_AMOUNT, decimal_places=COMMON_EXPONENT)
 
 
 # Category schemas
@@ -19,18 +27,40 @@ class CategoryResponse(BaseModel):
         from_attributes = True
 
 
+class CategoryUpdate(BaseModel):
+    """Rename and/or move a category; send `parent_id: null` to make it a root."""
+    name: Optional[str] = None
+    parent_id: Optional[int] = None
+
+
+class CategoryTreeNode(BaseModel):
+    id: int
+    name: str
+    parent_id: Optional[int] = None
+    total: Decimal = Decimal(0)
+    count: int = 0
+    subtree_total: Decimal = Decimal(0)
+    subtree_count: int = 0
+    currency: str
+    children: List["CategoryTreeNode"] = []
+
+
+CategoryTreeNode.update_forward_refs()
+
+
 # Account schemas
 class AccountCreate(BaseModel):
     name: str
-    balance: float = 0.0
+    balance: Money = Decimal(0)
     currency: str = "USD"
 
 
 class AccountResponse(BaseModel):
     id: int
     name: str
-    balance: float
+    balance: Decimal
     currency: str
+    opening_balance: Decimal = Decimal(0)
 
     class Config:
         from_attributes = True
@@ -38,16 +68,30 @@ class AccountResponse(BaseModel):
 
 # Transaction schemas
 class TransactionCreate(BaseModel):
-    amount: float
+    amount: Money
     currency: Optional[str] = "USD"
     description: Optional[str] = None
     account_id: Optional[int] = None
     category_id: Optional[int] = None
+    timestamp: Optional[datetime] = Field(None, description="Defaults to the current time")
+
+
+class BulkImportError(BaseModel):
+    line: int
+    error: str
+
+
+class BulkImportResponse(BaseModel):
+    inserted: int
+    categorized: int = 0
+    errors: List[BulkImportError] = []
+    seconds: float
+    rows_per_second: float
 
 
 class TransactionResponse(BaseModel):
     id: int
-    amount: float
+    amount: Decimal
     currency: str
     timestamp: datetime
     description: Optional[str]
@@ -58,50 +102,216 @@ class TransactionResponse(BaseModel):
         from_attributes = True
 
 
+class TransactionSearchHit(TransactionResponse):
+    rank: float
+    snippet: Optional[str]
+
+
+# Categorization rule schemas
+class CategoryRuleCreate(BaseModel):
+    category_id: int
+    pattern: Optional[str] = Field(None, description="Case-insensitive substring, or a regex with is_regex")
+    is_regex: bool = False
+    min_amount: Optional[Money] = Field(None, description="Signed, in `currency`; expenses are negative")
+    max_amount: Optional[Money] = None
+    currency: str = "USD"
+    priority: int = Field(100, description="Lower wins when several rules match")
+
+
+class CategoryRuleResponse(BaseModel):
+    id: int
+    category_id: int
+    pattern: Optional[str]
+    is_regex: bool
+    min_amount: Optional[Decimal]
+    max_amount: Optional[Decimal]
+    currency: str
+    priority: int
+
+    class Config:
+        from_attributes = True
+
+
+class CategorizeResponse(BaseModel):
+    scanned: int
+    categorized: int
+    seconds: float
+    rows_per_second: float
+
+
 # Budget schemas
 class BudgetCreate(BaseModel):
     year_month: str = Field(..., description="Format: YYYY-MM")
     category_id: Optional[int] = None
-    amount: float
+    amount: Money
+    currency: str = "USD"
 
 
 class BudgetResponse(BaseModel):
     id: int
     year_month: str
     category_id: Optional[int]
-    amount: float
+    amount: Decimal
+    currency: str = "USD"
 
     class Config:
         from_attributes = True
 
 
+class BudgetStatusItem(BaseModel):
+    category_id: Optional[int]
+    category: str
+    budget: Decimal
+    actual: Decimal
+    remaining: Decimal
+    percent_used: Optional[float]
+    daily_burn: Decimal
+    projected: Decimal
+    over_budget: bool
+
+
+class BudgetStatusResponse(BaseModel):
+    year_month: str
+    days_in_month: int
+    days_elapsed: int
+    currency: str
+    items: List[BudgetStatusItem] = []
+
+
 # PlannedItem schemas
 class PlannedItemCreate(BaseModel):
     title: str
-    amount: float
+    amount: Money
+    currency: Optional[str] = Field(None, description="Defaults to the account's currency, else USD")
     due_date: Optional[datetime] = None
     type: str = "expense"  # or 'income'
     category_id: Optional[int] = None
+    account_id: Optional[int] = None
+    recurrence: Optional[str] = Field(None, regex="^(weekly|monthly|yearly)$", description="Repeat from due_date; omit for a one-off item")
+    recurrence_end: Optional[datetime] = None
 
 
 class PlannedItemResponse(BaseModel):
     id: int
     title: str
-    amount: float
+    amount: Decimal
+    currency: str = "USD"
     due_date: Optional[datetime]
     type: str
     category_id: Optional[int]
+    account_id: Optional[int] = None
+    recurrence: Optional[str] = None
+    recurrence_end: Optional[datetime] = None
 
     class Config:
         from_attributes = True
 
 
+class ForecastPoint(BaseModel):
+    date: str
+    balance: Decimal
+
+
+class ForecastSeries(BaseModel):
+    account_id: Optional[int]
+    name: str
+    currency: Optional[str]
+    start_balance: Decimal
+    min_balance: Decimal
+    min_date: Optional[str]
+    points: List[ForecastPoint] = []
+
+
+class ForecastResponse(BaseModel):
+    start: Optional[str]
+    end: Optional[str]
+    accounts: List[ForecastSeries] = []
+    total: Optional[ForecastSeries] = None
+
+
+# Analytics schemas
+class TrendResponse(BaseModel):
+    freq: str
+    window: int
+    currency: str
+    labels: List[str] = []
+    values: List[float] = []
+    rolling: List[float] = []
+    p50: List[Optional[float]] = []  # None for periods without transactions
+    p90: List[Optional[float]] = []
+    counts: List[int] = []
+    chart: Optional[str] = None
+
+
+class YoYItem(BaseModel):
+    category_id: Optional[int]
+    name: Optional[str]
+    current: float
+    previous: float
+    change_pct: Optional[float]
+
+
+class YoYResponse(BaseModel):
+    year: int
+    through: str
+    currency: str
+    items: List[YoYItem] = []
+
+
+# Exchange rate schemas
+class FxLoadResponse(BaseModel):
+    loaded: int
+
+
+class FxRateResponse(BaseModel):
+    base: str
+    quote: str
+    date: str
+    rate: Decimal
+
+
+class BalanceResponse(BaseModel):
+    account_id: int
+    currency: str
+    as_of: datetime
+    balance: Decimal
+    snapshot: Optional[datetime] = None
+    scanned: int
+
+
+# Sync schemas
+class SyncTableChanges(BaseModel):
+    upserts: List[dict] = []  # rows as the table's list endpoint returns them
+    deletes: List[int] = []
+
+
+class SyncResponse(BaseModel):
+    cursor: int
+    more: bool
+    reset: bool
+    changes: Dict[str, SyncTableChanges] = {}
+
+
+# Attachment schemas
+class AttachmentResponse(BaseModel):
+    id: int
+    filename: str
+    name: str = Field(description="Stored file name (content hash and extension)")
+    url: str
+    sha256: str
+    size: int
+    content_type: Optional[str] = None
+    transaction_id: Optional[int] = None
+    planned_id: Optional[int] = None
+    deduplicated: bool = False
+
+
 # Transfer schemas
 class TransferRequest(BaseModel):
     from_account_id: int
     to_account_id: int
-    amount: float = Field(..., gt=0, description="Amount must be positive")
-    currency: Optional[str] = "USD"
+    amount: PositiveMoney = Field(..., description="Amount must be positive")
+    currency: Optional[str] = Field(None, description="Currency of `amount`; defaults to the source account's")
     description: Optional[str] = None
 
 
@@ -113,7 +323,7 @@ class TransferResponse(BaseModel):
 
 # AI Report schemas
 class AIReportRequest(BaseModel):
-    prompt: str = Field(..., min_length=1)
+    prompt: str = Field(..., description="Free-text report request; empty prompts are rejected with 400")
     query: Optional[str] = None
 
 
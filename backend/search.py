@@ -0,0 +1,297 @@
+"""Full-text search over transaction descriptions and attachment file names.
+
+On SQLite the FTS5 table `transaction_fts` holds one row per transaction
+(rowid = Transaction.id) with its description and the names of its
+attachments. Triggers on "transaction" and attachment keep it in step, so
+every writer (API, bulk import, raw SQL) is covered without extra code. It
+is created together with the other tables and backfilled on first creation;
+`rebuild` recomputes it.
+
+Queries take words (all must match), "quoted phrases", prefix* terms and
+OR. Results are ranked with bm25, descriptions weighted above file names;
+very common terms are ranked in windows of their newest matches (RANK_WINDOW).
+Without FTS5 (e.g. on Postgres) search falls back to an unranked LIKE on
+descriptions requiring every word.
+
+    python -m backend.search rebuild
+    python -m backend.search bench [--rows 1000000]
+"""
+import argparse
+import logging
+import re
+import sys
+import time
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import DateTime, Integer, bindparam, event, literal_column, text
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, SQLModel, select
+
+from .models import Transaction
+
+log = logging.getLogger("homebuh.search")
+
+FTS_TABLE = "transaction_fts"
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+RANK_WINDOW = 2000
+
+_ATTACHMENT_NAMES = "(SELECT group_concat(filename, ' ') FROM attachment WHERE transaction_id = {id})"
+
+DDL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    "description, attachments, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+    f'CREATE TRIGGER IF NOT EXISTS transaction_fts_insert AFTER INSERT ON "transaction" BEGIN '
+    f"INSERT INTO {FTS_TABLE} (rowid, description, attachments) VALUES (new.id, new.description, ''); END",
+    f'CREATE TRIGGER IF NOT EXISTS transaction_fts_update AFTER UPDATE OF description ON "transaction" BEGIN '
+    f"UPDATE {FTS_TABLE} SET description = new.description WHERE rowid = new.id; END",
+    f'CREATE TRIGGER IF NOT EXISTS transaction_fts_delete AFTER DELETE ON "transaction" BEGIN '
+    f"DELETE FROM {FTS_TABLE} WHERE rowid = old.id; END",
+    f"CREATE TRIGGER IF NOT EXISTS attachment_fts_insert AFTER INSERT ON attachment "
+    f"WHEN new.transaction_id IS NOT NULL BEGIN "
+    f"UPDATE {FTS_TABLE} SET attachments = {_ATTACHMENT_NAMES.format(id='new.transaction_id')} "
+    f"WHERE rowid = new.transaction_id; END",
+    f"CREATE TRIGGER IF NOT EXISTS attachment_fts_update AFTER UPDATE OF filename, transaction_id ON attachment BEGIN "
+    f"UPDATE {FTS_TABLE} SET attachments = {_ATTACHMENT_NAMES.format(id='old.transaction_id')} "
+    f"WHERE rowid = old.transaction_id; "
+    f"UPDATE {FTS_TABLE} SET attachments = {_ATTACHMENT_NAMES.format(id='new.transaction_id')} "
+    f"WHERE rowid = new.transaction_id; END",
+    f"CREATE TRIGGER IF NOT EXISTS attachment_fts_delete AFTER DELETE ON attachment "
+    f"WHEN old.transaction_id IS NOT NULL BEGIN "
+    f"UPDATE {FTS_TABLE} SET attachments = {_ATTACHMENT_NAMES.format(id='old.transaction_id')} "
+    f"WHERE rowid = old.transaction_id; END",
+]
+
+BACKFILL = (
+    f"INSERT INTO {FTS_TABLE} (rowid, description, attachments) "
+    f'SELECT t.id, t.description, COALESCE({_ATTACHMENT_NAMES.format(id="t.id")}, \'\') FROM "transaction" t'
+)
+
+
+def has_index(conn) -> bool:
+    if conn.dialect.name != "sqlite":
+        return False
+    return conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = :n"), {"n": FTS_TABLE}).first() is not None
+
+
+def ensure_index(conn) -> bool:
+    """Create the FTS table and triggers if missing (backfilling it). Returns whether FTS is available."""
+    if conn.dialect.name != "sqlite":
+        return False
+    fresh = not has_index(conn)
+    try:
+        for ddl in DDL:
+            conn.execute(text(ddl))
+    except OperationalError as e:  # SQLite built without FTS5
+        log.warning("full-text search unavailable: %s", e)
+        return False
+    if fresh:
+        conn.execute(text(BACKFILL))
+    return True
+
+
+@event.listens_for(SQLModel.metadata, "after_create")
+def _create_index(target, conn, **kw):
+    ensure_index(conn)
+
+
+def rebuild(s: Session) -> int:
+    """Recompute the index from Transaction and Attachment and commit. Returns rows indexed."""
+    conn = s.connection()
+    if not ensure_index(conn):
+        return 0
+    s.execute(text(f"DELETE FROM {FTS_TABLE}"))
+    s.execute(text(BACKFILL))
+    s.commit()
+    return s.execute(text(f"SELECT count(*) FROM {FTS_TABLE}")).scalar_one()
+
+
+_TOKEN = re.compile(r'"([^"]*)"?|(\S+)')
+_OPERATORS = ("OR", "AND")
+
+
+def to_match(query: str) -> Optional[str]:
+    """Translate a user query into a safe FTS5 MATCH expression (None if it has no terms).
+
+    Every term is quoted so punctuation and FTS5 keywords in user input are
+    matched literally; only `*` suffixes, "phrases" and OR/AND are syntax.
+    """
+    parts: List[str] = []
+    for phrase, word in _TOKEN.findall(query or ""):
+        if word.upper() in _OPERATORS:
+            if parts and parts[-1] not in _OPERATORS:
+                parts.append(word.upper())
+            continue
+        prefix = not phrase and word.endswith("*")
+        term = (phrase or word.rstrip("*")).replace('"', " ").strip()
+        if term:
+            parts.append(f'"{term}"' + ("*" if prefix else ""))
+    while parts and parts[-1] in _OPERATORS:
+        parts.pop()
+    return " ".join(parts) or None
+
+
+def _like_terms(query: str) -> List[str]:
+    return [(phrase or word).rstrip("*") for phrase, word in _TOKEN.findall(query or "") if (phrase or word).upper() not in _OPERATORS]
+
+
+def _contains(term: str) -> str:
+    """LIKE pattern matching `term` literally anywhere (use with escape="\\")."""
+    return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _fts_where(date_from, date_to, account_id, category_id):
+    where, binds = ["transaction_fts MATCH :match"], []
+    for name, value, cond in (
+        ("date_from", date_from, "t.timestamp >= :date_from"),
+        ("date_to", date_to, "t.timestamp < :date_to"),
+        ("account_id", account_id, "t.account_id = :account_id"),
+        ("category_id", category_id, "t.category_id = :category_id"),
+    ):
+        if value is not None:
+            where.append(cond)
+            binds.append(bindparam(name, value, type_=DateTime if name.startswith("date") else Integer))
+    return " AND ".join(where), binds
+
+
+def search(
+    s: Session,
+    query: str,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    account_id: Optional[int] = None,
+    category_id: Optional[int] = None,
+    limit: int = DEFAULT_LIMIT,
+    offset: int = 0,
+) -> List[tuple]:
+    """(Transaction, rank, snippet) for the best matches; lower rank is better.
+
+    A common word can match a large share of the ledger, and bm25 has to
+    score every match before sorting. So matches are ranked in windows of
+    RANK_WINDOW, newest (by id) first: the first pages hold the best of the
+    newest RANK_WINDOW matches, and paging past them continues with the best
+    of the next, older window. Every match is reachable and pages never
+    overlap; with at most RANK_WINDOW matches this is a plain ranking.
+    """
+    match = to_match(query)
+    if match is None:
+        return []
+    t = Transaction
+    if not has_index(s.connection()):
+        terms = [t.description.ilike(_contains(w), escape="\\") for w in _like_terms(query)]
+        stmt = select(t, literal_column("0.0").label("rank"), t.description.label("snippet")).where(*terms)
+        if date_from is not None:
+            stmt = stmt.where(t.timestamp >= date_from)
+        if date_to is not None:
+            stmt = stmt.where(t.timestamp < date_to)
+        if account_id is not None:
+            stmt = stmt.where(t.account_id == account_id)
+        if category_id is not None:
+            stmt = stmt.where(t.category_id == category_id)
+        return s.exec(stmt.order_by(t.timestamp.desc(), t.id.desc()).limit(limit).offset(offset)).all()
+
+    where, binds = _fts_where(date_from, date_to, account_id, category_id)
+    # CROSS JOIN keeps the FTS index as the outer loop; otherwise SQLite may
+    # walk a filter index and evaluate MATCH once per transaction.
+    source = f'FROM {FTS_TABLE} CROSS JOIN "transaction" t ON t.id = {FTS_TABLE}.rowid WHERE {where}'
+
+    def nth_newest(n: int) -> Optional[int]:
+        return s.execute(
+            text(f"SELECT {FTS_TABLE}.rowid {source} ORDER BY {FTS_TABLE}.rowid DESC LIMIT 1 OFFSET :n")
+            .bindparams(*binds, match=match, n=n)
+        ).scalar()
+
+    ranked = []
+    window = offset // RANK_WINDOW
+    upper = nth_newest(window * RANK_WINDOW) if window else None
+    while len(ranked) < limit and (upper is not None or not window):
+        # This window's matches have ids in (lower, upper]; None bounds are open.
+        lower = nth_newest((window + 1) * RANK_WINDOW)
+        ranked += s.execute(
+            text(
+                f"SELECT {FTS_TABLE}.rowid, bm25({FTS_TABLE}, 1.0, 0.5) AS rank, "
+                f"highlight({FTS_TABLE}, 0, '[', ']') {source} "
+                f"AND {FTS_TABLE}.rowid > :lower AND {FTS_TABLE}.rowid <= :upper "
+                "ORDER BY rank, t.timestamp DESC LIMIT :limit OFFSET :offset"
+            ).bindparams(
+                *binds, match=match, lower=lower or 0, upper=upper if upper is not None else sys.maxsize,
+                limit=limit - len(ranked), offset=max(0, offset - window * RANK_WINDOW),
+            )
+        ).all()
+        if lower is None:
+            break
+        window, upper = window + 1, lower
+    txs = {tx.id: tx for tx in s.exec(select(t).where(t.id.in_([r[0] for r in ranked])))}
+    return [(txs[tx_id], rank, snippet) for tx_id, rank, snippet in ranked]
+
+
+MERCHANTS = [
+    "Uber trip", "Uber Eats order", "Lyft ride", "Starbucks coffee", "Amazon Marketplace", "Whole Foods Market",
+    "Shell fuel station", "Netflix subscription", "Spotify premium", "Apple iCloud storage", "Airbnb booking",
+    "Delta Air Lines ticket", "Costco wholesale", "Walgreens pharmacy", "Home Depot", "IKEA furniture",
+    "Пятёрочка продукты", "Яндекс Такси поездка", "Аптека Ригла", "Салон связи МТС",
+]
+
+
+def bench(rows: int = 1_000_000, seed: int = 11):
+    """Time ranked, prefix and phrase searches (with filters) against a LIKE scan."""
+    from sqlmodel import create_engine
+    from sqlmodel.pool import StaticPool
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as s:
+        s.execute(text("CREATE TEMP TABLE merchant (k INTEGER PRIMARY KEY, name TEXT)"))
+        s.execute(text("INSERT INTO merchant VALUES (:k, :name)"), [{"k": k, "name": n} for k, n in enumerate(MERCHANTS)])
+        started = time.perf_counter()
+        s.execute(text(
+            "WITH RECURSIVE seq(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM seq WHERE i < :last) "
+            'INSERT INTO "transaction" (amount, currency, timestamp, description, account_id) '
+            "SELECT -(i * 7919) % 90000 - 100, 'USD', datetime('2018-01-01', '+' || (i * 43800 / :last) || ' hours') || '.000000', "
+            "m.name || ' #' || ((i * :seed) % 100000), (i / 3) % 5 + 1 FROM seq JOIN merchant m ON m.k = (i * 7) % :n"
+        ), {"last": rows - 1, "seed": seed, "n": len(MERCHANTS)})
+        s.commit()
+        insert_s = time.perf_counter() - started
+
+        def timed(label, **kw):
+            best = float("inf")
+            for _ in range(3):
+                started = time.perf_counter()
+                hits = search(s, **kw)
+                best = min(best, time.perf_counter() - started)
+            print(f"{label:<40} {best * 1000:8.1f} ms  {len(hits)} hits")
+
+        print(f"{rows} transactions inserted and indexed by triggers in {insert_s:.1f} s")
+        timed("ranked: uber", query="uber")
+        timed("prefix: star*", query="star*")
+        timed('phrase: "whole foods"', query='"whole foods"')
+        timed("cyrillic prefix: такс*", query="такс*")
+        timed("uber + account + 2019", query="uber", account_id=2,
+              date_from=datetime(2019, 1, 1), date_to=datetime(2020, 1, 1))
+        started = time.perf_counter()
+        like = s.exec(select(Transaction.id).where(Transaction.description.ilike("%uber%")).limit(DEFAULT_LIMIT)).all()
+        print(f"{'LIKE %uber% (unranked)':<40} {(time.perf_counter() - started) * 1000:8.1f} ms  {len(like)} hits")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m backend.search")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("rebuild", help="recompute the full-text index")
+    b = sub.add_parser("bench", help="search timings on synthetic transactions")
+    b.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args(argv)
+
+    if args.command == "bench":
+        bench(args.rows)
+        return 0
+    from .db import engine, init_db
+
+    init_db()
+    with Session(engine) as s:
+        print(f"full-text index rebuilt: {rebuild(s)} rows")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
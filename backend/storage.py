@@ -0,0 +1,107 @@
+"""Content-addressed storage for uploaded files.
+
+Uploads are streamed to disk in chunks while their SHA-256 is computed, then
+stored as `<sha256><ext>`: identical content is kept once no matter how many
+attachments point to it. Reads support single HTTP byte ranges.
+"""
+import hashlib
+import re
+import uuid
+from pathlib import Path
+from typing import Optional, Tuple
+
+import aiofiles
+import aiofiles.os
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
+
+CHUNK_SIZE = 1024 * 1024
+
+_SAFE_SUFFIX = re.compile(r"^\.[a-z0-9]{1,10}$")
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _suffix(filename: Optional[str]) -> str:
+    suffix = Path(filename or "").suffix.lower()
+    return suffix if _SAFE_SUFFIX.match(suffix) else ""
+
+
+async def save_upload(upload: UploadFile, root: Path) -> Tuple[str, str, int, bool]:
+    """Stream `upload` into `root`. Returns (stored_name, sha256, size, deduplicated)."""
+    tmp = root / f".upload-{uuid.uuid4().hex}.tmp"
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(tmp, "wb") as f:
+            while True:
+                chunk = await upload.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                size += len(chunk)
+                await f.write(chunk)
+        digest = hasher.hexdigest()
+        name = digest + _suffix(upload.filename)
+        dest = root / name
+        if await aiofiles.os.path.exists(dest):
+            await aiofiles.os.remove(tmp)
+            return name, digest, size, True
+        await aiofiles.os.replace(tmp, dest)
+        return name, digest, size, False
+    except BaseException:
+        if await aiofiles.os.path.exists(tmp):
+            await aiofiles.os.remove(tmp)
+        raise
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single `bytes=` range into inclusive (start, end); None if absent or multi-range.
+
+    Raises 416 when the range cannot be satisfied.
+    """
+    m = _RANGE.match(header.strip())
+    if not m:
+        return None
+    first, last = m.groups()
+    if first == "" and last == "":
+        return None
+    if first == "":
+        # suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise HTTPException(status_code=416, detail="range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+        start, end = max(size - length, 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, detail="range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+async def _iter_file(path: Path, start: int, length: int):
+    async with aiofiles.open(path, "rb") as f:
+        await f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = await f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def range_response(path: Path, range_header: str, media_type: str, headers: dict) -> Optional[StreamingResponse]:
+    """206 response for a valid Range header, or None to fall back to a full response."""
+    size = path.stat().st_size
+    rng = parse_range(range_header, size)
+    if rng is None:
+        return None
+    start, end = rng
+    length = end - start + 1
+    headers = dict(headers, **{
+        "Content-Range": f"bytes {start}-{end}/{size}",
+        "Content-Length": str(length),
+        "Accept-Ranges": "bytes",
+    })
+    return StreamingResponse(_iter_file(path, start, length), status_code=206, media_type=media_type, headers=headers)
@@ -0,0 +1,186 @@
+"""Compact data digest that grounds the AI report prompt.
+
+The digest is built from SQL aggregates only (MonthlyRollup, a grouped scan
+of recent descriptions, Budget) and trimmed to a token budget, so the model
+sees real labels and numbers without us shipping raw transactions. Digests
+are cached per data version, which every write changes: the newest
+change-log entry (SQLite triggers, so it covers the CLI tools too) and this
+process's `httpcache.data_versions` (for databases without the triggers).
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy import func, select
+from sqlmodel import Session
+
+from . import budgets
+from .aggregates import UNCATEGORIZED, month_bounds
+from .fx import MissingRate
+from .httpcache import data_versions
+from .models import Category, ChangeLog, MonthlyRollup, Transaction
+from .money import common_units, to_major
+
+DEFAULT_MONTHS = 6
+DEFAULT_TOP_MERCHANTS = 10
+DEFAULT_TOKEN_BUDGET = 1500
+# Tables whose writes change the digest.
+VERSIONED_TABLES = ("transaction", "category", "budget", "account", "categoryrule", "fxrate")
+
+
+class Digest(NamedTuple):
+    text: str
+    tokens: int
+    build_ms: float
+    cached: bool
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English/number-heavy text; good enough for budgeting.
+    return (len(text) + 3) // 4
+
+
+def data_version(s: Session) -> str:
+    """Cheap fingerprint of everything the digest depends on."""
+    # Updates (rules backfill, category renames and moves) rewrite rows in
+    # place, so max ids and rollup totals would not see them.
+    last_change = s.exec(select(func.max(ChangeLog.id))).one()[0]
+    versions = [data_versions.get(t) for t in VERSIONED_TABLES]
+    return hashlib.sha1(repr((last_change, data_versions.generation, versions)).encode()).hexdigest()
+
+
+def _recent_months(today: date, months: int) -> List[str]:
+    y, m = today.year, today.month
+    out = []
+    for _ in range(months):
+        out.append(f"{y:04d}-{m:02d}")
+        y, m = (y - 1, 12) if m == 1 else (y, m - 1)
+    return out[::-1]
+
+
+def _fmt(v) -> str:
+    return f"{v:.2f}".rstrip("0").rstrip(".")
+
+
+def _budget_lines(s: Session, year_month: str, today: date) -> List[str]:
+    # Same figures as /api/budgets/{year_month}/status: subcategories roll up
+    # and a budget without a category is the overall limit.
+    try:
+        status = budgets.budget_status(s, year_month, today=today)
+    except MissingRate as e:
+        return [f"not available: {e}"]
+    return [
+        f"{i['category']} [{status['currency']}]: budget {_fmt(i['budget'])}, spent {_fmt(i['actual'])}, left {_fmt(i['remaining'])}"
+        for i in status["items"]
+    ]
+
+
+def _monthly_lines(s: Session, months: List[str]) -> List[str]:
+    r = MonthlyRollup
+    rows = s.exec(
+        select(
+            r.year_month, Category.name, r.currency,
+            func.sum(r.expense_total), func.sum(r.income_total),
+        )
+        .select_from(r)
+        .outerjoin(Category, Category.id == r.category_id)
+        .where(r.year_month.in_(months))
+        .group_by(r.year_month, r.category_id, Category.name, r.currency)
+        .order_by(r.year_month.desc(), func.sum(r.expense_total).desc())
+    ).all()
+    lines = []
+    for ym, name, currency, spent, earned in rows:
+        parts = []
+        if spent:
+            parts.append(f"spent {_fmt(to_major(spent, currency))}")
+        if earned:
+            parts.append(f"earned {_fmt(to_major(earned, currency))}")
+        if parts:
+            lines.append(f"{ym} {name or UNCATEGORIZED} [{currency}]: {', '.join(parts)}")
+    return lines
+
+
+def _merchant_lines(s: Session, since: datetime, top_n: int) -> List[str]:
+    # Per currency, like the monthly lines; common units only rank them.
+    desc = func.lower(func.trim(Transaction.description))
+    spent = (-func.sum(Transaction.amount)).label("spent")
+    rows = s.exec(
+        select(desc, Transaction.currency, func.count(Transaction.id), spent)
+        .where(Transaction.timestamp >= since, Transaction.amount < 0, Transaction.description.isnot(None))
+        .group_by(desc, Transaction.currency)
+        .order_by(func.sum(common_units(Transaction.amount, Transaction.currency)))
+        .limit(top_n)
+    ).all()
+    return [
+        f"{name} [{currency}]: {n} payments, {_fmt(to_major(total, currency))}"
+        for name, currency, n, total in rows if name
+    ]
+
+
+def build_digest_text(
+    s: Session,
+    today: Optional[date] = None,
+    months: int = DEFAULT_MONTHS,
+    top_merchants: int = DEFAULT_TOP_MERCHANTS,
+    token_budget: int = DEFAULT_TOKEN_BUDGET,
+) -> str:
+    today = today or datetime.utcnow().date()
+    recent = _recent_months(today, months)
+    since, _ = month_bounds(recent[0])
+
+    # Sections in priority order: later ones are cut first when over budget.
+    sections = [
+        (f"Budget vs actual for {recent[-1]}", _budget_lines(s, recent[-1], today)),
+        (f"Monthly totals by category, last {months} months", _monthly_lines(s, recent)),
+        (f"Top merchants by spending since {recent[0]}", _merchant_lines(s, since, top_merchants)),
+    ]
+    out: List[str] = []
+    used = 0
+    for title, lines in sections:
+        if not lines:
+            continue
+        header = f"## {title}"
+        cost = estimate_tokens(header) + 1
+        if used + cost > token_budget:
+            break
+        out.append(header)
+        used += cost
+        for i, line in enumerate(lines):
+            cost = estimate_tokens(line) + 1
+            if used + cost > token_budget:
+                out.append(f"... ({len(lines) - i} more lines omitted)")
+                used += 8
+                break
+            out.append(line)
+            used += cost
+    return "\n".join(out) if out else "No transactions recorded yet."
+
+
+class DigestCache:
+    def __init__(self, max_entries: int = 16):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, s: Session, today: Optional[date] = None, **options) -> Digest:
+        started = time.perf_counter()
+        today = today or datetime.utcnow().date()
+        key = (data_version(s), today.isoformat()[:7], tuple(sorted(options.items())))
+        with self._lock:
+            text = self._entries.get(key)
+            if text is not None:
+                self._entries.move_to_end(key)
+        cached = text is not None
+        if not cached:
+            text = build_digest_text(s, today=today, **options)
+            with self._lock:
+                self._entries[key] = text
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return Digest(text, estimate_tokens(text), round((time.perf_counter() - started) * 1000, 2), cached)
+
+
+digest_cache = DigestCache()
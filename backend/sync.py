@@ -0,0 +1,202 @@
+"""Delta sync for offline clients: a change log and `GET /api/sync?since=<cursor>`.
+
+On SQLite, triggers on every synced table record each insert, update and
+delete in `changelog` as (table, row id, deleted). A write replaces the
+row's previous entry with one under a new AUTOINCREMENT id, so the log
+holds a single entry per row ever written and ids are never reused. A
+client keeps the last id it has applied as its cursor; `changes` returns
+the rows whose entry is newer, current values for live rows and ids for
+deleted ones, a page at a time. Cursor 0 is a full snapshot: rows that
+existed before the log are entered into it when the triggers are created.
+
+Like full-text search this relies on SQLite triggers, which cover every
+writer (API, bulk import, CLI tools); other databases get a 501.
+
+    python -m backend.sync bench [--rows 1000000] [--changed 1000]
+"""
+import argparse
+import sys
+import time
+from typing import Dict
+
+from fastapi import HTTPException
+from sqlalchemy import event, func, text
+from sqlmodel import Session, SQLModel, select
+
+from . import fastjson
+from .models import Account, Budget, Category, CategoryRule, ChangeLog, PlannedItem, Transaction
+from .schemas import (
+    AccountResponse, BudgetResponse, CategoryResponse, CategoryRuleResponse, PlannedItemResponse, TransactionResponse,
+)
+
+DEFAULT_LIMIT = 2000
+MAX_LIMIT = 10000
+
+# table name -> (model, schema of the row as the list endpoints return it)
+SYNCED = {
+    "category": (Category, CategoryResponse),
+    "account": (Account, AccountResponse),
+    "transaction": (Transaction, TransactionResponse),
+    "budget": (Budget, BudgetResponse),
+    "planneditem": (PlannedItem, PlannedItemResponse),
+    "categoryrule": (CategoryRule, CategoryRuleResponse),
+}
+
+_RECORD = (
+    "DELETE FROM changelog WHERE table_name = '{table}' AND row_id = {row}.id; "
+    "INSERT INTO changelog (table_name, row_id, deleted) VALUES ('{table}', {row}.id, {deleted}); "
+)
+
+
+def _triggers(table: str) -> Dict[str, str]:
+    return {
+        f"changelog_{table}_{op}": f'CREATE TRIGGER IF NOT EXISTS changelog_{table}_{op} AFTER {op.upper()} ON "{table}" '
+        f"BEGIN {_RECORD.format(table=table, row=row, deleted=deleted)}END"
+        for op, row, deleted in (("insert", "new", 0), ("update", "new", 0), ("delete", "old", 1))
+    }
+
+
+TRIGGERS = {name: ddl for table in SYNCED for name, ddl in _triggers(table).items()}
+
+SEED = (
+    "INSERT INTO changelog (table_name, row_id, deleted) "
+    "SELECT '{table}', id, 0 FROM \"{table}\" t WHERE NOT EXISTS "
+    "(SELECT 1 FROM changelog c WHERE c.table_name = '{table}' AND c.row_id = t.id) ORDER BY id"
+)
+
+
+def has_log(conn) -> bool:
+    if conn.dialect.name != "sqlite":
+        return False
+    found = conn.execute(
+        text("SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'changelog\\_%' ESCAPE '\\'")
+    ).scalar_one()
+    return found == len(TRIGGERS)
+
+
+def ensure_log(conn) -> bool:
+    """Create missing change-log triggers, entering rows written without them. Returns whether sync is available."""
+    if conn.dialect.name != "sqlite":
+        return False
+    if has_log(conn):
+        return True
+    for ddl in TRIGGERS.values():
+        conn.execute(text(ddl))
+    for table in SYNCED:
+        conn.execute(text(SEED.format(table=table)))
+    return True
+
+
+@event.listens_for(SQLModel.metadata, "after_create")
+def _create_log(target, conn, **kw):
+    ensure_log(conn)
+
+
+def changes(s: Session, since: int = 0, limit: int = DEFAULT_LIMIT) -> dict:
+    """Rows changed after cursor `since`, oldest change first, at most `limit` of them.
+
+    `more` means another page follows from the returned `cursor`. `reset`
+    means the cursor is from another database (e.g. one restored from a
+    backup): the client should drop its copy, and this page starts from 0.
+    """
+    if not has_log(s.connection()):
+        raise HTTPException(status_code=501, detail="delta sync needs SQLite (change-log triggers)")
+    last = s.exec(select(func.max(ChangeLog.id))).one() or 0
+    reset = since > last
+    if reset:
+        since = 0
+    c = ChangeLog
+    entries = s.exec(
+        select(c.id, c.table_name, c.row_id, c.deleted).where(c.id > since).order_by(c.id).limit(limit + 1)
+    ).all()
+    more = len(entries) > limit
+    entries = entries[:limit]
+
+    upserts: Dict[str, list] = {}
+    deletes: Dict[str, list] = {}
+    for _, table, row_id, deleted in entries:
+        if table in SYNCED:
+            (deletes if deleted else upserts).setdefault(table, []).append(row_id)
+    result = {}
+    for table in SYNCED:
+        rows = []
+        gone = deletes.get(table, [])
+        ids = upserts.get(table)
+        if ids:
+            model, schema = SYNCED[table]
+            found = s.exec(select(*fastjson.columns(model, schema)).where(model.id.in_(ids)))
+            rows = fastjson.to_dicts(found, list(found.keys()), table)
+            # Deleted since the entries were read.
+            present = {r["id"] for r in rows}
+            gone = gone + [i for i in ids if i not in present]
+        if rows or gone:
+            result[table] = {"upserts": rows, "deletes": gone}
+    return {
+        "cursor": entries[-1][0] if entries else since,
+        "more": more,
+        "reset": reset,
+        "changes": result,
+    }
+
+
+def bench(rows: int = 1_000_000, changed: int = 1000):
+    """Cost of the triggers on a bulk insert, and response size of a delta vs a full snapshot."""
+    import orjson
+    from sqlmodel import create_engine
+    from sqlmodel.pool import StaticPool
+
+    insert = (
+        "WITH RECURSIVE seq(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM seq WHERE i < :last) "
+        'INSERT INTO "transaction" (amount, currency, timestamp, description, account_id, category_id) '
+        "SELECT -((i * 7919) % 90000) - 100, 'USD', datetime('2021-01-01', '+' || i || ' minutes') || '.000000', "
+        "'Card payment #' || i, i % 5 + 1, i % 12 + 1 FROM seq"
+    )
+    timings = {}
+    for logged in (False, True):
+        engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(engine)
+        with Session(engine) as s:
+            if not logged:
+                for name in TRIGGERS:
+                    s.execute(text(f"DROP TRIGGER {name}"))
+            started = time.perf_counter()
+            s.execute(text(insert), {"last": rows - 1})
+            s.commit()
+            timings[logged] = time.perf_counter() - started
+    with Session(engine) as s:
+        cursor = s.exec(select(func.max(ChangeLog.id))).one()
+        s.execute(text(f'UPDATE "transaction" SET description = description || \' (edited)\' WHERE id % {rows // changed} = 0'))
+        s.execute(text(f'DELETE FROM "transaction" WHERE id % {rows // changed} = 1'))
+        s.commit()
+        started = time.perf_counter()
+        delta = changes(s, cursor, MAX_LIMIT)
+        delta_ms = (time.perf_counter() - started) * 1000
+        delta_bytes = len(fastjson.compress(orjson.dumps(delta), "br")[0])
+        started = time.perf_counter()
+        full_bytes, pages, cursor = 0, 0, 0
+        while True:
+            page = changes(s, cursor, MAX_LIMIT)
+            full_bytes += len(fastjson.compress(orjson.dumps(page), "br")[0])
+            pages += 1
+            cursor = page["cursor"]
+            if not page["more"]:
+                break
+        full_s = time.perf_counter() - started
+    print(f"insert {rows} transactions: {timings[False]:.2f} s without the change log, {timings[True]:.2f} s with it")
+    print(f"delta after {changed} edits and {changed} deletes: {delta_bytes / 1024:.1f} KiB brotli in {delta_ms:.0f} ms")
+    print(f"full snapshot: {full_bytes / 2**20:.1f} MiB brotli in {pages} pages, {full_s:.1f} s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m backend.sync")
+    sub = parser.add_subparsers(dest="command", required=True)
+    b = sub.add_parser("bench", help="change-log write overhead and delta vs snapshot size on synthetic transactions")
+    b.add_argument("--rows", type=int, default=1_000_000)
+    b.add_argument("--changed", type=int, default=1000)
+    args = parser.parse_args(argv)
+    bench(args.rows, args.changed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
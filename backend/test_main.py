@@ -1,11 +1,33 @@
 """Unit tests for HomeBuh API endpoints."""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+import httpx
+import numpy as np
 import pytest
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
-from sqlmodel import Session, create_engine, SQLModel
+from sqlmodel import Session, create_engine, SQLModel, select
 from sqlmodel.pool import StaticPool
-from .db import get_session
+from sqlalchemy import event, text
+
+from . import analytics, balances, budgets, categories, db, export, httpcache, main, metrics, money, rollup, rules, search, transfers
+from .aggregates import aggregate
+from .ai_client import LLMClient, LLMError, ResponseCache
+from .schemas import AccountResponse, BudgetResponse, CategoryResponse, PlannedItemResponse, TransactionResponse
+from .storage import save_upload
+from .summary import DigestCache, build_digest_text, estimate_tokens
+from .db import get_session, get_read_session
 from .main import app
-from .models import Category, Account, Transaction, Budget, PlannedItem
+from .artifacts import ArtifactStore
+from .utils import chart_key, render_charts
+from .models import Category, CategoryRule, Account, Transaction, Budget, PlannedItem, MonthlyRollup, Attachment, ExportWatermark
 
 
 @pytest.fixture(name="session")
@@ -28,6 +50,13 @@ def client_fixture(session: Session):
         return session
 
     app.dependency_overrides[get_session] = get_session_override
+    app.dependency_overrides[get_read_session] = get_session_override
+    main.forecast_cache.clear()
+    main.rates.invalidate()
+    rules.rule_cache.invalidate()
+    httpcache.data_versions.clear()
+    httpcache.response_cache.clear()
+    metrics.clear()
     client = TestClient(app)
     yield client
     app.dependency_overrides.clear()
@@ -41,6 +70,117 @@ class TestHealth:
         assert response.json() == {"status": "ok"}
 
 
+class TestDatabase:
+    def test_sqlite_pragmas(self, tmp_path):
+        """Test that the connect hook enables WAL and relaxed fsync."""
+        eng = create_engine(f"sqlite:///{tmp_path / 'tuned.db'}")
+        event.listen(eng, "connect", db._sqlite_pragmas)
+        with eng.connect() as conn:
+            assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+            assert conn.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+            assert conn.execute(text("PRAGMA cache_size")).scalar() == db.SQLITE_CACHE_SIZE
+
+    def test_migrate_float_money_to_minor_units(self, tmp_path, monkeypatch):
+        """Test that REAL major-unit amounts from older databases become integer minor units."""
+        eng = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+        with eng.begin() as conn:
+            conn.execute(text('CREATE TABLE account (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, balance FLOAT NOT NULL, currency VARCHAR NOT NULL)'))
+            conn.execute(text('CREATE TABLE "transaction" (id INTEGER PRIMARY KEY, amount FLOAT NOT NULL, currency VARCHAR NOT NULL, '
+                              'timestamp DATETIME NOT NULL, description VARCHAR, account_id INTEGER, category_id INTEGER)'))
+            conn.execute(text('CREATE TABLE budget (id INTEGER PRIMARY KEY, year_month VARCHAR NOT NULL, category_id INTEGER, amount FLOAT NOT NULL)'))
+            conn.execute(text("INSERT INTO account VALUES (1, 'Main', 10.29, 'USD'), (2, 'Yen', 1500.0, 'JPY')"))
+            conn.execute(text("INSERT INTO \"transaction\" VALUES (1, -0.1, 'USD', '2025-01-01 00:00:00', 'a', 1, NULL), "
+                              "(2, -0.2, 'USD', '2025-01-02 00:00:00', 'b', 1, NULL), (3, 1.235, 'BHD', '2025-01-03 00:00:00', 'c', NULL, NULL)"))
+            conn.execute(text("INSERT INTO budget VALUES (1, '2025-01', NULL, 99.99)"))
+        monkeypatch.setattr(db, "engine", eng)
+        db.init_db()
+        db.init_db()  # second run is a no-op
+
+        with Session(eng) as s:
+            assert [(a.balance, a.opening_balance) for a in s.exec(select(Account).order_by(Account.id))] == [(1029, 1059), (1500, 1500)]
+            assert [t.amount for t in s.exec(select(Transaction).order_by(Transaction.id))] == [-10, -20, 1235]
+            assert [(b.amount, b.currency) for b in s.exec(select(Budget))] == [(9999, "USD")]
+            rollup.ensure_built(s)
+            totals = {r.currency: r.total for r in s.exec(select(MonthlyRollup))}
+            assert totals == {"USD": -30, "BHD": 1235}
+            s.add(Transaction(amount=-5, currency="USD", timestamp=datetime(2025, 1, 4)))
+            s.commit()
+        with eng.connect() as conn:
+            types = {r[1]: r[2] for r in conn.execute(text('PRAGMA table_info("transaction")'))}
+            assert types["amount"] == "BIGINT"
+            names = {r[1] for r in conn.execute(text('PRAGMA index_list("transaction")'))}
+            assert "ix_transaction_timestamp_id" in names
+
+
+class TestUploads:
+    def test_upload_dedup_and_attachment(self, client: TestClient, session: Session):
+        """Test that identical content is stored once and linked to a transaction."""
+        tx_id = client.post("/api/transactions", json={"amount": -9.99}).json()["id"]
+        content = f"receipt {uuid.uuid4()}".encode() * 1000
+
+        first = client.post(
+            "/api/upload",
+            files={"file": ("receipt.JPG", content, "image/jpeg")},
+            data={"transaction_id": str(tx_id)},
+        )
+        assert first.status_code == 200
+        a = first.json()
+        assert a["sha256"] == hashlib.sha256(content).hexdigest()
+        assert a["size"] == len(content)
+        assert a["url"] == f"/api/uploads/{a['sha256']}.jpg"
+        assert a["transaction_id"] == tx_id
+        assert a["deduplicated"] is False
+
+        second = client.post("/api/upload", files={"file": ("copy.jpg", content, "image/jpeg")}).json()
+        assert second["deduplicated"] is True
+        assert second["name"] == a["name"] == f"{a['sha256']}.jpg"
+        assert "path" not in a
+        assert second["id"] != a["id"]
+
+        linked = session.exec(select(Attachment).where(Attachment.transaction_id == tx_id)).all()
+        assert [x.filename for x in linked] == ["receipt.JPG"]
+        assert client.get(a["url"]).content == content
+
+    def test_upload_unknown_transaction(self, client: TestClient):
+        """Test that linking to a missing transaction is rejected."""
+        response = client.post(
+            "/api/upload",
+            files={"file": ("x.txt", b"x", "text/plain")},
+            data={"transaction_id": "999999"},
+        )
+        assert response.status_code == 404
+
+    def test_upload_streams_without_a_connection(self, client: TestClient, session: Session, monkeypatch):
+        """Test that no database connection is checked out while the file is written."""
+        tx_id = client.post("/api/transactions", json={"amount": -1}).json()["id"]
+        seen = []
+
+        async def save(file, directory):
+            seen.append(session.in_transaction())
+            return await save_upload(file, directory)
+
+        monkeypatch.setattr(main, "save_upload", save)
+        resp = client.post("/api/upload", files={"file": ("r.txt", b"r", "text/plain")}, data={"transaction_id": str(tx_id)})
+        assert resp.status_code == 200
+        assert seen == [False]
+
+    def test_serve_upload_range(self, client: TestClient):
+        """Test byte-range requests on uploaded files."""
+        content = f"0123456789{uuid.uuid4()}".encode()
+        url = client.post("/api/upload", files={"file": ("r.bin", content, "application/octet-stream")}).json()["url"]
+
+        part = client.get(url, headers={"Range": "bytes=2-5"})
+        assert part.status_code == 206
+        assert part.content == b"2345"
+        assert part.headers["content-range"] == f"bytes 2-5/{len(content)}"
+
+        tail = client.get(url, headers={"Range": "bytes=-4"})
+        assert tail.content == content[-4:]
+
+        bad = client.get(url, headers={"Range": f"bytes={len(content) + 10}-"})
+        assert bad.status_code == 416
+
+
 class TestCategories:
     def test_create_category(self, client: TestClient):
         """Test creating a new category."""
@@ -78,6 +218,101 @@ class TestCategories:
         data = response.json()
         assert data["parent_id"] == parent_id
 
+    def _tree(self, client, **params):
+        resp = client.get("/api/categories/tree", params=params)
+        assert resp.status_code == 200
+        return resp.json()
+
+    def test_tree_subtree_totals(self, client: TestClient):
+        """Subtree totals include every descendant; own totals do not."""
+        food = client.post("/api/categories", json={"name": "Food"}).json()["id"]
+        cafe = client.post("/api/categories", json={"name": "Cafe", "parent_id": food}).json()["id"]
+        coffee = client.post("/api/categories", json={"name": "Coffee", "parent_id": cafe}).json()["id"]
+        client.post("/api/categories", json={"name": "Rent"})
+        for cat, amount, ts in [
+            (food, -100, "2025-03-02T10:00:00"),
+            (cafe, -30, "2025-03-05T10:00:00"),
+            (coffee, -5, "2025-03-06T10:00:00"),
+            (coffee, -7, "2025-04-01T10:00:00"),
+        ]:
+            client.post("/api/transactions", json={"amount": amount, "category_id": cat, "timestamp": ts})
+
+        roots = self._tree(client, month_from="2025-03", month_to="2025-03")
+        assert [r["name"] for r in roots] == ["Food", "Rent"]
+        food_node = roots[0]
+        assert food_node["total"] == 100
+        assert food_node["subtree_total"] == 135
+        assert food_node["subtree_count"] == 3
+        cafe_node = food_node["children"][0]
+        assert (cafe_node["total"], cafe_node["subtree_total"]) == (30, 35)
+        assert cafe_node["children"][0]["subtree_total"] == 5
+        assert roots[1]["subtree_total"] == 0
+
+        assert self._tree(client)[0]["subtree_total"] == 142
+
+    def test_tree_across_currencies(self, client: TestClient):
+        """Each month is converted into the reporting currency at its month-end rate."""
+        client.post("/api/fx/rates", files={"file": ("rates.csv", b"date,base,quote,rate\n2025-01-01,EUR,USD,2\n2025-04-01,EUR,USD,3\n", "text/csv")})
+        food = client.post("/api/categories", json={"name": "Food"}).json()["id"]
+        cafe = client.post("/api/categories", json={"name": "Cafe", "parent_id": food}).json()["id"]
+        for cat, amount, currency, ts in [
+            (food, -100, "USD", "2025-03-02T10:00:00"),
+            (cafe, -10, "EUR", "2025-03-05T10:00:00"),
+            (cafe, -10, "EUR", "2025-04-05T10:00:00"),
+        ]:
+            client.post("/api/transactions", json={"amount": amount, "currency": currency, "category_id": cat, "timestamp": ts})
+
+        food_node = self._tree(client)[0]
+        assert food_node["currency"] == "USD"
+        assert (food_node["total"], food_node["subtree_total"], food_node["subtree_count"]) == (100, 150, 3)
+        assert food_node["children"][0]["total"] == 50
+        in_eur = self._tree(client, reporting_currency="EUR", month_to="2025-03")[0]
+        assert (in_eur["currency"], in_eur["subtree_total"]) == ("EUR", 60)
+        assert self._tree(client, currency="EUR")[0]["subtree_total"] == 20
+        assert client.get("/api/categories/tree", params={"reporting_currency": "JPY"}).status_code == 422
+
+    def test_move_category(self, client: TestClient, session: Session):
+        """Moving a category re-parents its whole subtree in the closure table."""
+        a = client.post("/api/categories", json={"name": "A"}).json()["id"]
+        b = client.post("/api/categories", json={"name": "B"}).json()["id"]
+        child = client.post("/api/categories", json={"name": "Child", "parent_id": a}).json()["id"]
+        leaf = client.post("/api/categories", json={"name": "Leaf", "parent_id": child}).json()["id"]
+        client.post("/api/transactions", json={"amount": -10, "category_id": leaf, "timestamp": "2025-01-01T00:00:00"})
+
+        resp = client.patch(f"/api/categories/{child}", json={"parent_id": b, "name": "Moved"})
+        assert resp.status_code == 200
+        assert resp.json()["parent_id"] == b
+        assert resp.json()["name"] == "Moved"
+
+        totals = {n["name"]: n["subtree_total"] for n in self._tree(client)}
+        assert totals == {"A": 0, "B": 10}
+        closure = session.exec(text("SELECT ancestor_id, descendant_id, depth FROM categoryclosure")).all()
+        categories.rebuild(session)
+        rebuilt = session.exec(text("SELECT ancestor_id, descendant_id, depth FROM categoryclosure")).all()
+        assert sorted(closure) == sorted(rebuilt)
+        assert (b, leaf, 2) in rebuilt
+
+        assert client.patch(f"/api/categories/{b}", json={"parent_id": leaf}).status_code == 400
+        assert client.patch(f"/api/categories/{child}", json={"parent_id": None}).status_code == 200
+        assert [n["name"] for n in self._tree(client)] == ["A", "B", "Moved"]
+
+    def test_delete_category_subtree(self, client: TestClient, session: Session):
+        """Deleting removes descendants; their transactions become uncategorized."""
+        parent = client.post("/api/categories", json={"name": "Parent"}).json()["id"]
+        child = client.post("/api/categories", json={"name": "Child", "parent_id": parent}).json()["id"]
+        client.post("/api/transactions", json={"amount": -20, "category_id": child, "timestamp": "2025-01-01T00:00:00"})
+        client.post("/api/budgets", json={"year_month": "2025-01", "category_id": child, "amount": 100})
+
+        resp = client.delete(f"/api/categories/{parent}")
+        assert resp.status_code == 200
+        assert resp.json()["deleted"] == 2
+        assert client.get("/api/categories").json() == []
+        assert client.get("/api/budgets").json() == []
+        assert client.get("/api/transactions").json()[0]["category_id"] is None
+        report = client.post("/api/report", json={"type": "expenses_by_category", "year_month": "2025-01"}).json()
+        assert report["labels"] == ["Uncategorized"] and report["values"] == [20]
+        assert client.delete(f"/api/categories/{parent}").status_code == 404
+
 
 class TestAccounts:
     def test_create_account(self, client: TestClient):
@@ -109,6 +344,51 @@ class TestAccounts:
         assert data["currency"] == "USD"
 
 
+class TestBalances:
+    def test_balance_follows_ledger(self, client: TestClient, session: Session):
+        """Transactions and imports move the account balance; the ledger check finds no drift."""
+        acc = client.post("/api/accounts", json={"name": "Main", "balance": 100}).json()
+        assert acc["opening_balance"] == 100
+        client.post("/api/transactions", json={"amount": -30.5, "account_id": acc["id"]})
+        client.post("/api/transactions", json={"amount": 5, "currency": "EUR", "account_id": acc["id"]})
+        csv_body = "amount,timestamp\n-9.5,2025-01-02\n40,2025-01-03\n"
+        client.post("/api/transactions/bulk", params={"account_id": acc["id"]}, files={"file": ("s.csv", csv_body.encode(), "text/csv")})
+        assert client.get("/api/accounts").json()[0]["balance"] == 100  # 100 - 30.5 - 9.5 + 40; EUR not counted
+        assert balances.verify(session) == [] and balances.verify(session, full=True) == []
+
+        session.exec(text("UPDATE account SET balance = balance + 700"))
+        session.commit()
+        for full in (False, True):
+            (drift,) = balances.verify(session, full=full)
+            assert (drift["stored"], drift["ledger"], drift["drift"]) == (107, 100, 7)
+        assert balances.repair(session) == 1
+        assert balances.verify(session) == []
+
+    def test_balance_as_of_uses_snapshots(self, client: TestClient, session: Session):
+        """As-of balances read the nearest snapshot plus a short scan and survive backdated writes."""
+        acc = client.post("/api/accounts", json={"name": "Main", "balance": 10}).json()["id"]
+        for day in range(90):
+            ts = datetime(2025, 1, 1) + timedelta(days=day)
+            client.post("/api/transactions", json={"amount": 1, "account_id": acc, "timestamp": ts.isoformat()})
+
+        def as_of(ts):
+            return client.get(f"/api/accounts/{acc}/balance", params={"as_of": ts}).json()
+
+        before = as_of("2025-03-15T00:00:00")
+        assert (before["balance"], before["snapshot"], before["scanned"]) == (83, None, 73)
+        assert balances.snapshot(session, upto=datetime(2025, 4, 1)) == 3
+        assert balances.snapshot(session, upto=datetime(2025, 4, 1)) == 0
+        after = as_of("2025-03-15T00:00:00")
+        assert (after["balance"], after["snapshot"], after["scanned"]) == (83, "2025-03-01T00:00:00", 14)
+
+        client.post("/api/transactions", json={"amount": 100, "account_id": acc, "timestamp": "2025-02-10T00:00:00"})
+        assert as_of("2025-03-15T00:00:00")["balance"] == 183
+        assert as_of("2025-02-01T00:00:00")["snapshot"] == "2025-02-01T00:00:00"
+        assert balances.snapshot(session, upto=datetime(2025, 4, 1)) == 2
+        assert as_of("2025-04-01T00:00:00")["balance"] == 200
+        assert client.get("/api/accounts/999/balance").status_code == 404
+
+
 class TestTransactions:
     def test_create_transaction(self, client: TestClient):
         """Test creating a transaction."""
@@ -140,6 +420,517 @@ class TestTransactions:
         assert response.status_code == 200
         assert isinstance(response.json(), list)
 
+    def test_list_transactions_keyset_pagination(self, client: TestClient):
+        """Test paging through transactions with the next-page cursor."""
+        for i in range(5):
+            client.post("/api/transactions", json={"amount": float(i)})
+
+        first = client.get("/api/transactions", params={"limit": 2})
+        assert first.status_code == 200
+        assert [t["amount"] for t in first.json()] == [4.0, 3.0]
+        cursor = first.headers["X-Next-Cursor"]
+
+        second = client.get("/api/transactions", params={"limit": 2, "cursor": cursor})
+        assert [t["amount"] for t in second.json()] == [2.0, 1.0]
+
+        last = client.get("/api/transactions", params={"limit": 2, "cursor": second.headers["X-Next-Cursor"]})
+        assert [t["amount"] for t in last.json()] == [0.0]
+        assert "X-Next-Cursor" not in last.headers
+
+    def test_list_transactions_filters(self, client: TestClient):
+        """Test server-side filtering by account and amount range."""
+        acc_id = client.post("/api/accounts", json={"name": "Acc"}).json()["id"]
+        client.post("/api/transactions", json={"amount": -10.0, "account_id": acc_id})
+        client.post("/api/transactions", json={"amount": -500.0, "account_id": acc_id})
+        client.post("/api/transactions", json={"amount": -20.0})
+
+        response = client.get(
+            "/api/transactions",
+            params={"account_id": acc_id, "min_amount": -100, "max_amount": 0}
+        )
+        assert [t["amount"] for t in response.json()] == [-10.0]
+
+    def test_list_transactions_ndjson(self, client: TestClient):
+        """Test streaming transactions as newline-delimited JSON."""
+        client.post("/api/transactions", json={"amount": 1.0, "description": "a"})
+        client.post("/api/transactions", json={"amount": 2.0, "description": "b"})
+
+        response = client.get("/api/transactions", params={"format": "ndjson"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert [r["description"] for r in rows] == ["b", "a"]
+
+    def test_list_transactions_invalid_cursor(self, client: TestClient):
+        """Test that a malformed cursor is rejected."""
+        response = client.get("/api/transactions", params={"cursor": "garbage"})
+        assert response.status_code == 400
+
+
+class TestListSerialization:
+    def test_fast_path_matches_response_models(self, client: TestClient, session: Session):
+        """Test that the column-tuple JSON path returns what the response models did."""
+        cat = client.post("/api/categories", json={"name": "Food"}).json()["id"]
+        acc = client.post("/api/accounts", json={"name": "Yen", "balance": 1500, "currency": "JPY"}).json()["id"]
+        client.post("/api/transactions", json={"amount": -0.1, "description": "Tea", "category_id": cat})
+        client.post("/api/transactions", json={"amount": -250, "currency": "JPY", "account_id": acc})
+        client.post("/api/budgets", json={"year_month": "2025-01", "category_id": cat, "amount": 99.99})
+        client.post("/api/planned", json={"title": "Rent", "amount": 1200.5, "due_date": "2025-02-01T00:00:00"})
+
+        for path, model, schema in [
+            ("/api/categories", Category, CategoryResponse),
+            ("/api/accounts", Account, AccountResponse),
+            ("/api/transactions", Transaction, TransactionResponse),
+            ("/api/budgets", Budget, BudgetResponse),
+            ("/api/planned", PlannedItem, PlannedItemResponse),
+        ]:
+            rows = session.exec(select(model)).all()
+            if model is Transaction:
+                rows = sorted(rows, key=lambda t: (t.timestamp, t.id), reverse=True)
+            expected = [json.loads(schema(**main.api_view(r)).json()) for r in rows]
+            assert client.get(path).json() == expected, path
+
+    def test_large_lists_are_compressed(self, client: TestClient, session: Session):
+        """Test brotli/gzip negotiation for large bodies and none for small ones."""
+        session.execute(text(
+            "WITH RECURSIVE seq(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM seq WHERE i < 200) "
+            'INSERT INTO "transaction" (amount, currency, timestamp, description) '
+            "SELECT -i, 'USD', '2025-01-01 00:00:00.000000', 'Coffee' FROM seq"
+        ))
+        session.commit()
+
+        br = client.get("/api/transactions", params={"limit": 200}, headers={"Accept-Encoding": "gzip, br"})
+        assert br.headers["content-encoding"] == "br"
+        assert br.headers["vary"] == "Accept-Encoding"
+        assert len(br.json()) == 200
+        gz = client.get("/api/transactions", params={"limit": 200}, headers={"Accept-Encoding": "gzip"})
+        assert gz.headers["content-encoding"] == "gzip"
+        assert gz.json() == br.json()
+        plain = client.get("/api/transactions", params={"limit": 200}, headers={"Accept-Encoding": "identity"})
+        assert "content-encoding" not in plain.headers
+        small = client.get("/api/transactions", params={"limit": 1}, headers={"Accept-Encoding": "br"})
+        assert "content-encoding" not in small.headers
+        assert "X-Next-Cursor" in small.headers
+
+
+class TestHTTPCache:
+    @staticmethod
+    def _count_queries(session: Session) -> list:
+        statements = []
+        event.listen(session.get_bind(), "before_cursor_execute", lambda *args: statements.append(args[2]))
+        return statements
+
+    def test_not_modified_and_cached_without_queries(self, client: TestClient, session: Session):
+        """Test ETag/Last-Modified, 304 on a matching If-None-Match and cache hits, none of which query the DB."""
+        client.post("/api/categories", json={"name": "Food"})
+        first = client.get("/api/categories")
+        etag = first.headers["etag"]
+        assert etag.startswith('W/"')
+        assert first.headers["cache-control"] == "no-cache"
+
+        statements = self._count_queries(session)
+        again = client.get("/api/categories", headers={"If-None-Match": etag})
+        assert again.status_code == 304
+        assert again.headers["etag"] == etag
+        assert client.get("/api/categories", headers={"If-None-Match": 'W/"other", ' + etag}).status_code == 304
+        hit = client.get("/api/categories")
+        assert hit.json() == first.json() and hit.headers["etag"] == etag
+        assert statements == []
+        assert httpcache.response_cache.metrics()["hits"] == 1
+
+    def test_writes_change_the_etag(self, client: TestClient):
+        """Test that writes bump the versions of the tables a list is built from."""
+        acc = client.post("/api/accounts", json={"name": "Cash", "balance": 10}).json()["id"]
+        accounts = client.get("/api/accounts")
+        budgets = client.get("/api/budgets")
+
+        client.post("/api/transactions", json={"amount": -4, "account_id": acc})
+        fresh = client.get("/api/accounts", headers={"If-None-Match": accounts.headers["etag"]})
+        assert fresh.status_code == 200
+        assert fresh.json()[0]["balance"] == 6.0
+        assert fresh.headers["etag"] != accounts.headers["etag"]
+        assert client.get("/api/budgets", headers={"If-None-Match": budgets.headers["etag"]}).status_code == 304
+
+        other = client.post("/api/accounts", json={"name": "Card"}).json()["id"]
+        listed = client.get("/api/accounts")
+        assert client.post("/api/transfer", json={"from_account_id": acc, "to_account_id": other, "amount": 1}).status_code == 200
+        assert client.get("/api/accounts", headers={"If-None-Match": listed.headers["etag"]}).status_code == 200
+
+    def test_cache_keys(self, client: TestClient, session: Session):
+        """Test that query strings and encodings are cached apart and streamed bodies not at all."""
+        session.execute(text(
+            "WITH RECURSIVE seq(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM seq WHERE i < 100) "
+            'INSERT INTO "transaction" (amount, currency, timestamp, description) '
+            "SELECT -i, 'USD', '2025-01-01 00:00:00.000000', 'Coffee' FROM seq"
+        ))
+        session.commit()
+
+        page = client.get("/api/transactions", params={"limit": 10})
+        assert page.headers["etag"] != client.get("/api/transactions", params={"limit": 20}).headers["etag"]
+        br = client.get("/api/transactions", params={"limit": 100}, headers={"Accept-Encoding": "br"})
+        plain = client.get("/api/transactions", params={"limit": 100}, headers={"Accept-Encoding": "identity"})
+        assert br.headers["content-encoding"] == "br" and "content-encoding" not in plain.headers
+        cached = client.get("/api/transactions", params={"limit": 10})
+        assert cached.headers["x-next-cursor"] == page.headers["x-next-cursor"]
+        assert httpcache.response_cache.metrics()["hits"] == 1
+        assert "etag" not in client.get("/api/transactions", params={"format": "ndjson"}).headers
+
+
+class TestBulkImport:
+    def test_bulk_import_csv(self, client: TestClient, session: Session):
+        """Test CSV import with a bad row reported and skipped."""
+        acc_id = client.post("/api/accounts", json={"name": "Bank"}).json()["id"]
+        csv_data = (
+            "date,amount,description,currency\n"
+            "2025-12-01,-12.50,Coffee,\n"
+            "2025-12-02,not-a-number,Broken,USD\n"
+            "2025-12-03,-40,Groceries,EUR\n"
+        )
+        response = client.post(
+            "/api/transactions/bulk",
+            params={"account_id": acc_id, "batch_size": 1},
+            files={"file": ("statement.csv", csv_data, "text/csv")},
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["inserted"] == 2
+        assert [e["line"] for e in data["errors"]] == [3]
+        assert data["rows_per_second"] >= 0
+
+        txs = session.exec(select(Transaction).order_by(Transaction.timestamp)).all()
+        assert [(t.amount, t.currency, t.account_id) for t in txs] == [(-1250, "USD", acc_id), (-4000, "EUR", acc_id)]
+        assert txs[0].timestamp == datetime(2025, 12, 1)
+        totals = {r.currency: r.total for r in session.exec(select(MonthlyRollup)).all()}
+        assert totals == {"USD": -1250, "EUR": -4000}
+
+    def test_bulk_import_ndjson(self, client: TestClient):
+        """Test NDJSON import selected by the format parameter."""
+        body = '{"amount": 5, "description": "a"}\n\n{"amount": -1}\n{broken\n'
+        response = client.post(
+            "/api/transactions/bulk",
+            params={"format": "ndjson"},
+            files={"file": ("upload.txt", body, "application/octet-stream")},
+        )
+        data = response.json()
+        assert data["inserted"] == 2
+        assert [e["line"] for e in data["errors"]] == [4]
+
+    def test_bulk_import_ofx(self, client: TestClient, session: Session):
+        """Test OFX statement import."""
+        ofx = (
+            "OFXHEADER:100\n<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><CURDEF>EUR\n"
+            "<BANKTRANLIST>\n"
+            "<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20251203120000[-5:EST]<TRNAMT>-7.20<NAME>UBER TRIP</STMTTRN>\n"
+            "<STMTTRN>\n<TRNTYPE>CREDIT\n<DTPOSTED>20251205\n<TRNAMT>1500.00\n<NAME>ACME\n<MEMO>Salary\n</STMTTRN>\n"
+            "</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>\n"
+        )
+        response = client.post("/api/transactions/bulk", files={"file": ("bank.ofx", ofx, "application/x-ofx")})
+        assert response.json()["inserted"] == 2
+        txs = session.exec(select(Transaction).order_by(Transaction.timestamp)).all()
+        assert [(t.amount, t.currency, t.description) for t in txs] == [
+            (-720, "EUR", "UBER TRIP"),
+            (150000, "EUR", "ACME Salary"),
+        ]
+        assert txs[0].timestamp == datetime(2025, 12, 3, 12)
+
+    def test_bulk_import_unknown_format(self, client: TestClient):
+        """Test that an undetectable format is rejected."""
+        response = client.post("/api/transactions/bulk", files={"file": ("data.bin", b"x", "application/octet-stream")})
+        assert response.status_code == 400
+
+
+class TestExport:
+    def test_export_csv_joins_names(self, client: TestClient, session: Session, monkeypatch):
+        """Test the streamed CSV: names joined in, money in major units, re-importable."""
+        monkeypatch.setattr(export, "EXPORT_CHUNK", 2)
+        food = client.post("/api/categories", json={"name": "Food"}).json()["id"]
+        acc = client.post("/api/accounts", json={"name": "Yen", "currency": "JPY"}).json()["id"]
+        client.post("/api/transactions", json={"amount": -12.5, "description": "Tea, green", "category_id": food,
+                                               "timestamp": "2025-01-02T10:00:00"})
+        client.post("/api/transactions", json={"amount": -300, "currency": "JPY", "account_id": acc,
+                                               "timestamp": "2025-01-03T00:00:00"})
+        client.post("/api/transactions", json={"amount": 7, "timestamp": "2025-01-04T00:00:00"})
+
+        response = client.get("/api/export")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+        assert response.headers["x-export-watermark"] == "3"
+        assert response.text.splitlines() == [
+            "id,timestamp,amount,currency,description,category_id,category,account_id,account",
+            f'1,2025-01-02T10:00:00,-12.50,USD,"Tea, green",{food},Food,,',
+            f"2,2025-01-03T00:00:00,-300,JPY,,,,{acc},Yen",
+            "3,2025-01-04T00:00:00,7.00,USD,,,,,",
+        ]
+
+        imported = client.post("/api/transactions/bulk", files={"file": ("export.csv", response.text, "text/csv")})
+        assert imported.json()["inserted"] == 3
+
+    def test_incremental_export_with_watermark(self, client: TestClient):
+        """Test that a named watermark resumes after the last exported id."""
+        client.post("/api/transactions", json={"amount": -1})
+        client.post("/api/transactions", json={"amount": -2})
+
+        first = client.get("/api/export", params={"watermark": "warehouse"})
+        assert first.headers["x-export-since"] == "0"
+        assert len(first.text.splitlines()) == 3
+        client.post("/api/transactions", json={"amount": -3})
+
+        second = client.get("/api/export", params={"watermark": "warehouse"})
+        assert second.headers["x-export-since"] == "2"
+        assert [line.split(",")[2] for line in second.text.splitlines()[1:]] == ["-3.00"]
+        empty = client.get("/api/export", params={"watermark": "warehouse"})
+        assert empty.text.splitlines() == [",".join(export.COLUMNS)]
+        # Other names and explicit `since` are independent of it.
+        assert len(client.get("/api/export", params={"watermark": "backup"}).text.splitlines()) == 4
+        assert len(client.get("/api/export", params={"since": 1}).text.splitlines()) == 3
+
+    def test_stream_reads_without_the_writer(self, session: Session, monkeypatch):
+        """Test that rows stream from the reader and the writer connects only to save the watermark."""
+        monkeypatch.setattr(export, "EXPORT_CHUNK", 1)
+        session.add_all([Transaction(amount=-100 * i, timestamp=datetime(2025, 1, i)) for i in (1, 2, 3)])
+        session.commit()
+        with Session(session.get_bind()) as writer:
+            since, upper = export.bounds(session, None, "nightly")
+            parts = export.stream(session, "csv", since, upper, "nightly", writer=writer)
+            for _ in range(3):
+                next(parts)
+                assert not writer.in_transaction()
+            list(parts)  # end of the stream: the watermark is saved
+            assert not writer.in_transaction()
+            assert writer.get(ExportWatermark, "nightly").last_id == 3
+
+    def test_export_parquet_without_pyarrow(self, client: TestClient, monkeypatch):
+        """Test that Parquet without pyarrow installed is a clear 415, and other formats a 400."""
+        monkeypatch.setattr(export, "pa", None)
+        response = client.get("/api/export", params={"format": "parquet"})
+        assert response.status_code == 415
+        assert "pyarrow" in response.json()["detail"]
+        assert client.get("/api/export", params={"format": "xlsx"}).status_code == 400
+
+    def test_export_parquet(self, client: TestClient, monkeypatch):
+        """Test the Parquet export (needs pyarrow from requirements-optional.txt)."""
+        pytest.importorskip("pyarrow")
+        client.post("/api/transactions", json={"amount": -0.005, "currency": "BHD"})
+        client.post("/api/transactions", json={"amount": 12.34})
+        monkeypatch.setattr(export, "EXPORT_CHUNK", 1)
+        response = client.get("/api/export", params={"format": "parquet"})
+        table = export.pq.read_table(export.pa.BufferReader(response.content))
+        assert table.column("amount").to_pylist() == [Decimal("-0.005"), Decimal("12.340")]
+        assert table.num_rows == 2
+
+
+class TestSync:
+    def test_snapshot_then_deltas(self, client: TestClient, session: Session):
+        """Test a full snapshot from cursor 0, then only rows changed or deleted since."""
+        food = client.post("/api/categories", json={"name": "Food"}).json()["id"]
+        acc = client.post("/api/accounts", json={"name": "Cash", "balance": 100}).json()["id"]
+        tx = client.post("/api/transactions", json={"amount": -2.5, "account_id": acc, "category_id": food}).json()
+        snapshot = client.get("/api/sync").json()
+        assert snapshot["more"] is False and snapshot["reset"] is False
+        changes = snapshot["changes"]
+        assert [c["name"] for c in changes["category"]["upserts"]] == ["Food"]
+        assert changes["account"]["upserts"][0]["balance"] == 97.5
+        assert changes["transaction"]["upserts"] == [client.get("/api/transactions").json()[0]]
+        assert client.get("/api/sync", params={"since": snapshot["cursor"]}).json()["changes"] == {}
+
+        client.post("/api/transactions", json={"amount": -1, "account_id": acc})
+        client.delete(f"/api/categories/{food}")
+        delta = client.get("/api/sync", params={"since": snapshot["cursor"]}).json()
+        assert delta["changes"]["category"] == {"upserts": [], "deletes": [food]}
+        assert {r["id"]: r["category_id"] for r in delta["changes"]["transaction"]["upserts"]} == {tx["id"]: None, tx["id"] + 1: None}
+        assert delta["changes"]["account"]["upserts"][0]["balance"] == 96.5
+        assert delta["cursor"] > snapshot["cursor"]
+
+    def test_pages_and_raw_writes(self, client: TestClient, session: Session):
+        """Test paging with `more`, and that writes bypassing the API are logged too."""
+        session.execute(text(
+            "WITH RECURSIVE seq(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM seq WHERE i < 25) "
+            'INSERT INTO "transaction" (amount, currency, timestamp) '
+            "SELECT -i, 'USD', '2025-01-01 00:00:00.000000' FROM seq"
+        ))
+        session.commit()
+        seen, cursor, pages = set(), 0, 0
+        while True:
+            page = client.get("/api/sync", params={"since": cursor, "limit": 10}).json()
+            seen.update(r["id"] for r in page["changes"]["transaction"]["upserts"])
+            cursor, pages = page["cursor"], pages + 1
+            if not page["more"]:
+                break
+        assert pages == 3 and seen == set(range(1, 26))
+
+        session.execute(text('DELETE FROM "transaction" WHERE id = 3'))
+        session.commit()
+        assert client.get("/api/sync", params={"since": cursor}).json()["changes"] == {
+            "transaction": {"upserts": [], "deletes": [3]},
+        }
+
+    def test_cursor_from_another_database_resets(self, client: TestClient):
+        """Test that a cursor beyond the log asks the client to start over."""
+        client.post("/api/categories", json={"name": "Food"})
+        page = client.get("/api/sync", params={"since": 999}).json()
+        assert page["reset"] is True
+        assert [c["name"] for c in page["changes"]["category"]["upserts"]] == ["Food"]
+
+    def test_idempotent_transaction_create(self, client: TestClient, session: Session):
+        """Test that a replayed queued write with the same Idempotency-Key is posted once."""
+        headers = {"Idempotency-Key": "outbox-1"}
+        first = client.post("/api/transactions", json={"amount": -3}, headers=headers)
+        again = client.post("/api/transactions", json={"amount": -3}, headers=headers)
+        assert again.headers["idempotent-replayed"] == "true"
+        assert again.json() == first.json()
+        assert len(session.exec(select(Transaction)).all()) == 1
+        assert client.post("/api/transactions", json={"amount": -4}, headers=headers).status_code == 422
+
+
+class TestSearch:
+    def test_search_ranked_prefix_and_phrase(self, client: TestClient):
+        """Test ranked, prefix and phrase queries with highlighted snippets."""
+        for desc in ["Uber trip home", "Uber Eats dinner", "Whole Foods Market", "Foods and whole grains", "Кофе Starbucks"]:
+            client.post("/api/transactions", json={"amount": -10.0, "description": desc})
+
+        response = client.get("/api/transactions/search", params={"q": "uber"})
+        assert response.status_code == 200
+        assert "search;dur=" in response.headers["Server-Timing"]
+        hits = response.json()
+        assert sorted(h["description"] for h in hits) == ["Uber Eats dinner", "Uber trip home"]
+        assert hits[0]["snippet"].startswith("[Uber]")
+        assert hits[0]["amount"] == -10.0
+
+        phrase = client.get("/api/transactions/search", params={"q": '"whole foods"'}).json()
+        assert [h["description"] for h in phrase] == ["Whole Foods Market"]
+        words = client.get("/api/transactions/search", params={"q": "whole foods"}).json()
+        assert len(words) == 2
+        assert [h["description"] for h in client.get("/api/transactions/search", params={"q": "star*"}).json()] == ["Кофе Starbucks"]
+        assert [h["description"] for h in client.get("/api/transactions/search", params={"q": "кофе"}).json()] == ["Кофе Starbucks"]
+        assert len(client.get("/api/transactions/search", params={"q": "eats OR market"}).json()) == 2
+        assert client.get("/api/transactions/search", params={"q": '" "'}).status_code == 400
+
+    def test_search_pages_past_the_rank_window(self, client: TestClient, monkeypatch):
+        """Matches older than the newest RANK_WINDOW are ranked in the next window, not lost."""
+        monkeypatch.setattr(search, "RANK_WINDOW", 3)
+        ids = [
+            client.post("/api/transactions", json={"amount": -1.0, "description": desc}).json()["id"]
+            for desc in ["Parking parking parking", "Parking", "Parking garage", "Parking lot", "Parking meter"]
+        ]
+
+        def found(**params):
+            return [h["id"] for h in client.get("/api/transactions/search", params={"q": "parking", **params}).json()]
+
+        everything = found()
+        assert sorted(everything) == sorted(ids)
+        assert set(everything[:3]) == set(ids[2:])  # the newest window first
+        assert everything[3] == ids[0]  # best match of the older window
+        pages = found(limit=2) + found(limit=2, offset=2) + found(limit=2, offset=4)
+        assert pages == everything
+        assert found(offset=5) == []
+
+    def test_search_filters_and_index_maintenance(self, client: TestClient, session: Session):
+        """Test filters, attachment names and that edits and deletes reach the index."""
+        acc_id = client.post("/api/accounts", json={"name": "Card"}).json()["id"]
+        old = client.post("/api/transactions", json={"amount": -5.0, "description": "Taxi ride", "timestamp": "2023-01-05T10:00:00"}).json()
+        new = client.post("/api/transactions", json={"amount": -7.0, "description": "Taxi ride", "account_id": acc_id, "timestamp": "2024-01-05T10:00:00"}).json()
+
+        def found(**params):
+            return [h["id"] for h in client.get("/api/transactions/search", params={"q": "taxi", **params}).json()]
+
+        assert found(account_id=acc_id) == [new["id"]]
+        assert found(date_from="2023-01-01T00:00:00", date_to="2024-01-01T00:00:00") == [old["id"]]
+
+        session.add(Attachment(filename="receipt_aeroexpress.pdf", path="x", transaction_id=old["id"]))
+        session.commit()
+        hits = client.get("/api/transactions/search", params={"q": "aeroexpress"}).json()
+        assert [h["id"] for h in hits] == [old["id"]]
+
+        tx = session.get(Transaction, new["id"])
+        tx.description = "Metro card"
+        session.commit()
+        assert found() == [old["id"]]
+        session.delete(session.get(Transaction, old["id"]))
+        session.commit()
+        assert found() == []
+        assert search.rebuild(session) == 1
+
+    def test_search_fallback_matches_wildcards_literally(self, client: TestClient, monkeypatch):
+        """Without the FTS index, %, _ and \\ in the query are plain characters, not LIKE wildcards."""
+        monkeypatch.setattr(search, "has_index", lambda conn: False)
+        for desc in ["Tip 50%", "Coffee 500", "gift_card", "giftcard", "C:\\temp"]:
+            client.post("/api/transactions", json={"amount": -1.0, "description": desc})
+
+        def found(q):
+            return sorted(h["description"] for h in client.get("/api/transactions/search", params={"q": q}).json())
+
+        assert found("50%") == ["Tip 50%"]
+        assert found("gift_") == ["gift_card"]
+        assert found("%") == ["Tip 50%"]
+        assert found("c:\\") == ["C:\\temp"]
+        assert found("coffee") == ["Coffee 500"]
+
+
+class TestRules:
+    def test_matcher_priority_and_amounts(self):
+        """Test that the combined matcher picks the best rule, including overlapping and amount-limited ones."""
+        matcher = rules.Matcher([
+            CategoryRule(id=1, category_id=10, pattern="uber", priority=100),
+            CategoryRule(id=2, category_id=20, pattern="Uber Eats", priority=50),
+            CategoryRule(id=3, category_id=30, pattern="eats", priority=10, max_amount=-10000),
+            CategoryRule(id=4, category_id=40, pattern=r"^pos\s+\d+", is_regex=True, priority=100),
+            CategoryRule(id=5, category_id=50, min_amount=100000, priority=200),
+            CategoryRule(id=6, category_id=60, pattern="ber", priority=100, currency="EUR", max_amount=0),
+        ])
+        assert matcher.match("UBER TRIP", -1500) == 10
+        assert matcher.match("uber eats order", -1500) == 20
+        assert matcher.match("uber eats catering", -20000) == 30
+        assert matcher.match("POS 1234 Market", -100) == 40
+        assert matcher.match("Salary", 250000) == 50
+        assert matcher.match("Salary", 250000, "EUR") is None
+        assert matcher.match("berlin cafe", -100, "EUR") == 60
+        assert matcher.match("Uber trip", -100, "EUR") == 10
+        assert matcher.match(None, -100) is None
+
+    def test_rules_in_import_and_backfill(self, client: TestClient, session: Session):
+        """Test categorizing during bulk import and by the backfill job, with the rollup kept exact."""
+        taxi = client.post("/api/categories", json={"name": "Taxi"}).json()["id"]
+        food = client.post("/api/categories", json={"name": "Food"}).json()["id"]
+        earlier = client.post("/api/transactions", json={"amount": -12.5, "description": "YANDEX*TAXI 42"}).json()
+        client.post("/api/transactions", json={"amount": -3.0, "description": "Bakery", "category_id": food})
+
+        assert client.post("/api/rules", json={"category_id": taxi, "pattern": "taxi"}).status_code == 200
+        assert client.post("/api/rules", json={"category_id": food, "pattern": "(grocer|super)market", "is_regex": True}).status_code == 200
+        assert client.post("/api/rules", json={"category_id": food, "pattern": "(", "is_regex": True}).status_code == 400
+        assert client.post("/api/rules", json={"category_id": food}).status_code == 400
+        assert len(client.get("/api/rules").json()) == 2
+
+        csv_data = "date,amount,description\n2025-03-01,-8.40,Taxi ride\n2025-03-02,-30.00,SUPERMARKET 7\n2025-03-03,-5.00,Cinema\n"
+        imported = client.post("/api/transactions/bulk", files={"file": ("s.csv", csv_data, "text/csv")}).json()
+        assert (imported["inserted"], imported["categorized"]) == (3, 2)
+
+        result = client.post("/api/rules/apply").json()
+        assert (result["scanned"], result["categorized"]) == (2, 1)
+        assert session.get(Transaction, earlier["id"]).category_id == taxi
+        by_category = {(r.category_id, r.year_month): (r.total, r.count, r.min_amount) for r in session.exec(select(MonthlyRollup))}
+        rollup.rebuild(session)
+        assert by_category == {(r.category_id, r.year_month): (r.total, r.count, r.min_amount) for r in session.exec(select(MonthlyRollup))}
+
+        client.delete(f"/api/categories/{taxi}")
+        assert [r["category_id"] for r in client.get("/api/rules").json()] == [food]
+
+    def test_patterns_that_cannot_be_combined(self, client: TestClient, monkeypatch):
+        """Test that a pattern valid alone but not inside the combined regex is rejected and imports keep working."""
+        taxi = client.post("/api/categories", json={"name": "Taxi"}).json()["id"]
+        assert client.post("/api/rules", json={"category_id": taxi, "pattern": "(?i)uber", "is_regex": True}).status_code == 400
+        assert client.post("/api/rules", json={"category_id": taxi, "pattern": "(?i:uber)", "is_regex": True}).status_code == 200
+        with pytest.raises(HTTPException) as exc:
+            rules.check_combined([CategoryRule(id=1, category_id=taxi, pattern="(?s)taxi", is_regex=True)])
+        assert exc.value.status_code == 422
+
+        # A check that slips past validate() still stops the rule before it is saved.
+        monkeypatch.setattr(rules, "validate", lambda pattern, is_regex: None)
+        assert client.post("/api/rules", json={"category_id": taxi, "pattern": "(?x)cab", "is_regex": True}).status_code == 422
+        csv_data = "date,amount,description\n2025-03-01,-8.40,UBER TRIP\n"
+        imported = client.post("/api/transactions/bulk", files={"file": ("s.csv", csv_data, "text/csv")})
+        assert imported.status_code == 200 and imported.json()["categorized"] == 1
+        assert client.post("/api/rules/apply").status_code == 200
+
 
 class TestBudgets:
     def test_create_budget(self, client: TestClient):
@@ -167,6 +958,82 @@ class TestBudgets:
         assert response.status_code == 200
         assert isinstance(response.json(), list)
 
+    def test_budget_status(self, client: TestClient):
+        """Actual spending includes subcategories; an uncategorized budget covers the whole month."""
+        food = client.post("/api/categories", json={"name": "Food"}).json()["id"]
+        cafe = client.post("/api/categories", json={"name": "Cafe", "parent_id": food}).json()["id"]
+        rent = client.post("/api/categories", json={"name": "Rent"}).json()["id"]
+        for cat, amount, ts in [
+            (food, -200, "2025-02-03T10:00:00"),
+            (cafe, -50, "2025-02-10T10:00:00"),
+            (rent, -900, "2025-02-01T10:00:00"),
+            (cafe, -40, "2025-03-01T10:00:00"),
+            (None, 1000, "2025-02-05T10:00:00"),
+        ]:
+            client.post("/api/transactions", json={"amount": amount, "category_id": cat, "timestamp": ts})
+        for cat, amount in [(food, 300), (cafe, 40), (None, 1500)]:
+            client.post("/api/budgets", json={"year_month": "2025-02", "category_id": cat, "amount": amount})
+
+        resp = client.get("/api/budgets/2025-02/status")
+        assert resp.status_code == 200
+        data = resp.json()
+        assert (data["days_in_month"], data["days_elapsed"]) == (28, 28)
+        items = {i["category"]: i for i in data["items"]}
+        assert list(items) == ["Cafe", "Food", "Total"]
+        assert items["Food"]["actual"] == 250
+        assert items["Food"]["remaining"] == 50
+        assert items["Food"]["over_budget"] is False
+        assert items["Cafe"]["actual"] == 50
+        assert items["Cafe"]["over_budget"] is True
+        assert items["Cafe"]["percent_used"] == 125
+        assert items["Total"]["actual"] == 1150
+        assert items["Total"]["daily_burn"] == round(1150 / 28, 2)
+
+    def test_budget_status_reads_the_rollup_once(self, client: TestClient, session: Session):
+        """Spending for every budget, the overall one included, comes from a single rollup query."""
+        parent = None
+        for i in range(5):
+            parent = client.post("/api/categories", json={"name": f"C{i}", "parent_id": parent}).json()["id"]
+            client.post("/api/transactions", json={"amount": -10, "category_id": parent, "timestamp": "2025-02-03T10:00:00"})
+            client.post("/api/budgets", json={"year_month": "2025-02", "category_id": parent, "amount": 100})
+        client.post("/api/budgets", json={"year_month": "2025-02", "amount": 100})
+
+        statements = []
+        event.listen(session.get_bind(), "before_cursor_execute", lambda *args: statements.append(args[2]))
+        data = budgets.budget_status(session, "2025-02")
+        assert [i["actual"] for i in data["items"]] == [50, 40, 30, 20, 10, 50]
+        assert len([q for q in statements if "monthlyrollup" in q.lower()]) == 1
+
+    def test_budget_status_across_currencies(self, client: TestClient):
+        """Budgets and spending in other currencies are converted at the month-end rate."""
+        client.post("/api/fx/rates", files={"file": ("rates.csv", b"date,base,quote,rate\n2025-01-01,EUR,USD,2\n2025-03-01,EUR,USD,3\n", "text/csv")})
+        food = client.post("/api/categories", json={"name": "Food"}).json()["id"]
+        for amount, currency in [(-100, "USD"), (-30, "EUR")]:
+            client.post("/api/transactions", json={
+                "amount": amount, "currency": currency, "category_id": food, "timestamp": "2025-02-03T10:00:00",
+            })
+        client.post("/api/budgets", json={"year_month": "2025-02", "category_id": food, "amount": 100, "currency": "EUR"})
+        client.post("/api/budgets", json={"year_month": "2025-02", "category_id": food, "amount": 50})
+
+        data = client.get("/api/budgets/2025-02/status").json()
+        assert data["currency"] == "USD"
+        item = data["items"][0]
+        assert (item["budget"], item["actual"], item["remaining"]) == (250, 160, 90)
+        in_eur = client.get("/api/budgets/2025-02/status", params={"reporting_currency": "EUR"}).json()
+        assert (in_eur["currency"], in_eur["items"][0]["actual"]) == ("EUR", 80)
+        only_usd = client.get("/api/budgets/2025-02/status", params={"currency": "USD"}).json()
+        assert only_usd["items"][0]["actual"] == 100
+        assert client.get("/api/budgets/2025-02/status", params={"reporting_currency": "JPY"}).status_code == 422
+
+    def test_budget_status_future_month(self, client: TestClient):
+        """No days elapsed yet: nothing spent, nothing projected."""
+        client.post("/api/budgets", json={"year_month": "2999-01", "amount": 100})
+        data = client.get("/api/budgets/2999-01/status").json()
+        assert data["days_elapsed"] == 0
+        assert data["items"][0]["remaining"] == 100
+        assert data["items"][0]["projected"] == 0
+        assert client.get("/api/budgets/2025-13/status").status_code == 400
+
 
 class TestPlannedItems:
     def test_create_planned_item(self, client: TestClient):
@@ -194,6 +1061,71 @@ class TestPlannedItems:
         assert response.status_code == 200
         assert isinstance(response.json(), list)
 
+    def test_forecast_timeline(self, client: TestClient):
+        """Balance starts at Account.balance and moves on each (recurring) due date."""
+        today = datetime.utcnow().date()
+        acc = client.post("/api/accounts", json={"name": "Main", "balance": 1000}).json()["id"]
+        due = lambda days: datetime.combine(today + timedelta(days=days), datetime.min.time()).isoformat()
+        client.post("/api/planned", json={"title": "Rent", "amount": 300, "account_id": acc, "due_date": due(1), "recurrence": "monthly"})
+        client.post("/api/planned", json={"title": "Bonus", "amount": 500, "type": "income", "account_id": acc, "due_date": due(10)})
+        client.post("/api/planned", json={"title": "Gift", "amount": 50, "due_date": due(2)})
+
+        resp = client.get("/api/forecast", params={"months": 2})
+        assert resp.status_code == 200
+        data = resp.json()
+        series = data["accounts"][0]
+        points = {p["date"]: p["balance"] for p in series["points"]}
+        assert series["start_balance"] == 1000
+        assert points[today.isoformat()] == 1000
+        assert points[(today + timedelta(days=1)).isoformat()] == 700
+        assert points[(today + timedelta(days=10)).isoformat()] == 1200
+        assert series["points"][-1]["balance"] == 900
+        assert series["min_balance"] == 700
+        # the planned item without an account only shows in the total
+        assert data["total"]["points"][-1]["balance"] == 850
+        assert client.post("/api/planned", json={"title": "x", "amount": 1, "recurrence": "daily"}).status_code == 422
+
+    def test_forecast_invalidates_only_affected_days(self, client: TestClient):
+        """A one-off item recomputes its own day; a transfer only reloads balances."""
+        today = datetime.utcnow().date()
+        a = client.post("/api/accounts", json={"name": "A", "balance": 100}).json()["id"]
+        b = client.post("/api/accounts", json={"name": "B", "balance": 0}).json()["id"]
+        cache = main.forecast_cache
+        client.get("/api/forecast")
+        recomputed = cache.recomputed_days
+        assert recomputed > 80
+        client.get("/api/forecast")
+        assert cache.recomputed_days == recomputed
+
+        due = datetime.combine(today + timedelta(days=5), datetime.min.time()).isoformat()
+        client.post("/api/planned", json={"title": "Fee", "amount": 10, "account_id": a, "due_date": due})
+        client.post("/api/transfer", json={"from_account_id": a, "to_account_id": b, "amount": 40})
+        data = client.get("/api/forecast").json()
+        assert cache.recomputed_days == recomputed + 1
+        a_series = data["accounts"][0]
+        assert a_series["start_balance"] == 60
+        assert a_series["points"][-1]["balance"] == 50
+
+
+    def test_forecast_across_currencies(self, client: TestClient):
+        """Planned amounts are converted to their account's currency, the total to the reporting currency."""
+        today = datetime.utcnow().date()
+        client.post("/api/fx/rates", files={"file": ("rates.csv", b"date,base,quote,rate\n2020-01-01,EUR,USD,2\n", "text/csv")})
+        eur = client.post("/api/accounts", json={"name": "Euro", "balance": 100, "currency": "EUR"}).json()["id"]
+        client.post("/api/accounts", json={"name": "Dollar", "balance": 50})
+        due = datetime.combine(today + timedelta(days=3), datetime.min.time()).isoformat()
+        client.post("/api/planned", json={"title": "Hotel", "amount": 20, "currency": "USD", "account_id": eur, "due_date": due})
+        client.post("/api/planned", json={"title": "Tip", "amount": 5, "currency": "EUR", "due_date": due})
+
+        data = client.get("/api/forecast", params={"months": 1}).json()
+        euro = next(a for a in data["accounts"] if a["name"] == "Euro")
+        assert euro["points"][-1]["balance"] == 90  # 20 USD = 10 EUR
+        total = data["total"]
+        assert (total["currency"], total["start_balance"], total["points"][-1]["balance"]) == ("USD", 250, 220)
+        in_eur = client.get("/api/forecast", params={"months": 1, "reporting_currency": "EUR"}).json()["total"]
+        assert (in_eur["currency"], in_eur["points"][-1]["balance"]) == ("EUR", 110)
+        assert client.get("/api/forecast", params={"reporting_currency": "JPY"}).status_code == 422
+
 
 class TestTransfer:
     def test_successful_transfer(self, client: TestClient):
@@ -265,6 +1197,588 @@ class TestTransfer:
         # Should be rejected by Pydantic validation (gt=0)
         assert response.status_code == 422
 
+    def test_transfer_idempotency_key(self, client: TestClient):
+        """A retry with the same Idempotency-Key replays the first response instead of posting again."""
+        src = client.post("/api/accounts", json={"name": "S", "balance": 100}).json()["id"]
+        dst = client.post("/api/accounts", json={"name": "D", "balance": 0}).json()["id"]
+        body = {"from_account_id": src, "to_account_id": dst, "amount": 30}
+        headers = {"Idempotency-Key": "retry-1"}
+        first = client.post("/api/transfer", json=body, headers=headers)
+        again = client.post("/api/transfer", json=body, headers=headers)
+        assert again.status_code == 200
+        assert again.headers["Idempotent-Replayed"] == "true"
+        assert again.json() == first.json()
+        balances = {a["name"]: a["balance"] for a in client.get("/api/accounts").json()}
+        assert balances == {"S": 70, "D": 30}
+        reused = client.post("/api/transfer", json={**body, "amount": 31}, headers=headers)
+        assert reused.status_code == 422
+        assert client.post("/api/transfer", json=body, headers={"Idempotency-Key": "retry-2"}).status_code == 200
+
+    def test_parallel_transfers_conserve_balance(self, tmp_path):
+        """Concurrent transfers on separate connections never overdraw or lose money."""
+        # The CLI's default concurrency: with deferred transactions this hit "database is locked".
+        stats = transfers.stress(f"sqlite:///{tmp_path / 'stress.db'}", transfers=1000, workers=16, accounts=5)
+        assert stats["errors"] == 0
+        assert stats["ok"] > 0 and stats["rejected"] > 0
+        assert stats["total_after"] == stats["total_before"]
+        assert stats["min_balance"] >= 0
+        assert stats["mismatched_accounts"] == 0
+
+
+class TestMoney:
+    def test_decimal_amounts_round_trip(self, client: TestClient, session: Session):
+        """Amounts are exact in storage and sums; exponents follow the currency."""
+        for amount in ("0.1", "0.2"):
+            client.post("/api/transactions", json={"amount": amount, "timestamp": "2025-01-05T00:00:00"})
+        yen = client.post("/api/transactions", json={"amount": 1500, "currency": "JPY", "timestamp": "2025-01-05T00:00:00"}).json()
+        dinar = client.post("/api/transactions", json={"amount": "1.234", "currency": "BHD", "timestamp": "2025-01-05T00:00:00"}).json()
+        assert (yen["amount"], dinar["amount"]) == (1500, 1.234)
+        stored = {t.currency: t.amount for t in session.exec(select(Transaction).where(Transaction.currency != "USD"))}
+        assert stored == {"JPY": 1500, "BHD": 1234}
+
+        data = client.post("/api/report", json={"type": "totals_by_month", "currency": "USD"}).json()
+        assert data["values"] == [0.3]
+        cheap = client.get("/api/transactions", params={"max_amount": "0.15", "min_amount": "0.1"}).json()
+        assert [t["amount"] for t in cheap] == [0.1]
+
+    def test_out_of_range_amounts(self, client: TestClient):
+        """Amounts too large for storage or with too many decimals are rejected, per row in imports."""
+        for amount in ("1e17", "1e30", "-1e12", "0.0001", "NaN"):
+            assert client.post("/api/transactions", json={"amount": amount}).status_code == 422, amount
+        assert client.post("/api/accounts", json={"name": "Huge", "balance": "1e15"}).status_code == 422
+        assert client.post("/api/budgets", json={"year_month": "2025-01", "amount": "1e30"}).status_code == 422
+        largest = client.post("/api/transactions", json={"amount": "999999999999.99"})
+        assert largest.status_code == 200 and largest.json()["amount"] == 999999999999.99
+        with pytest.raises(OverflowError):
+            money.to_minor("1e30")
+
+        csv_data = "date,amount,description\n2025-03-01,1e30,Typo\n2025-03-02,-5.00,Cinema\n"
+        imported = client.post("/api/transactions/bulk", files={"file": ("s.csv", csv_data, "text/csv")})
+        assert imported.status_code == 200
+        assert imported.json()["inserted"] == 1
+        assert [e["line"] for e in imported.json()["errors"]] == [2]
+
+    def test_transfer_exact_balance(self, client: TestClient):
+        """0.7 - 0.4 leaves exactly 0.3, enough for a 0.3 transfer (floats would refuse it)."""
+        src = client.post("/api/accounts", json={"name": "S", "balance": "0.7"}).json()["id"]
+        dst = client.post("/api/accounts", json={"name": "D", "balance": 0}).json()["id"]
+        for amount in (0.4, 0.3):
+            resp = client.post("/api/transfer", json={"from_account_id": src, "to_account_id": dst, "amount": amount})
+            assert resp.status_code == 200
+        balances = {a["name"]: a["balance"] for a in client.get("/api/accounts").json()}
+        assert balances == {"S": 0, "D": 0.7}
+        assert client.post("/api/transfer", json={"from_account_id": src, "to_account_id": dst, "amount": 0.01}).status_code == 400
+
+    def test_sum_exact_over_1m_rows(self, session: Session):
+        """Integer SUMs over 1M synthetic transactions match the exact decimal total."""
+        n = 1_000_000
+        # Deterministic amounts in [-2500.00, 1000.00], 1000 rows per day, generated in SQL.
+        session.execute(text(
+            "WITH RECURSIVE seq(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM seq WHERE i < :last) "
+            'INSERT INTO "transaction" (amount, currency, timestamp) '
+            "SELECT (i * 7919) % 350001 - 250000, 'USD', datetime('2020-01-01', '+' || (i / 1000) || ' days') FROM seq"
+        ), {"last": n - 1})
+        session.commit()
+        rollup.rebuild(session)
+
+        cents = [(i * 7919) % 350001 - 250000 for i in range(n)]
+        monthly = aggregate(session, group_by="month", kind="totals")
+        assert sum(b.count for b in monthly) == n
+        assert sum(b.total for b in monthly) == Decimal(sum(cents)).scaleb(-2)
+        expenses = aggregate(session, group_by="month", kind="expenses")
+        assert sum(b.total for b in expenses) == Decimal(-sum(c for c in cents if c < 0)).scaleb(-2)
+
+
+class TestFx:
+    RATES = "date,base,quote,rate\n2025-01-01,EUR,USD,1.10\n2025-02-01,EUR,USD,1.05\n2025-01-01,USD,JPY,150\n"
+
+    def _load(self, client: TestClient, body: str = RATES):
+        return client.post("/api/fx/rates", files={"file": ("rates.csv", body.encode(), "text/csv")})
+
+    def test_rate_lookup(self, client: TestClient):
+        """The latest rate on or before a day wins; inverse and pivot pairs are derived."""
+        assert self._load(client).json() == {"loaded": 3}
+
+        def rate(base, quote, day):
+            resp = client.get("/api/fx/rate", params={"base": base, "quote": quote, "date": day})
+            return resp.json()["rate"] if resp.status_code == 200 else resp.status_code
+
+        assert rate("EUR", "USD", "2025-01-31") == 1.1
+        assert rate("EUR", "USD", "2025-02-01") == 1.05
+        assert rate("USD", "EUR", "2025-01-15") == pytest.approx(1 / 1.1)
+        assert rate("EUR", "JPY", "2025-01-15") == pytest.approx(165)
+        assert rate("EUR", "USD", "2024-12-31") == 404
+        # Reloading a day updates it in place.
+        assert self._load(client, "date,base,quote,rate\n2025-02-01,EUR,USD,1.07\n").json() == {"loaded": 1}
+        assert rate("EUR", "USD", "2025-03-01") == 1.07
+        assert self._load(client, "date,base,quote,rate\n2025-02-01,EUR,USD,abc\n").status_code == 400
+
+    def test_report_in_reporting_currency(self, client: TestClient, session: Session):
+        """Each currency and month is converted at the month-end rate."""
+        self._load(client)
+        session.add(Transaction(amount=-1000, currency="USD", timestamp=datetime(2025, 1, 5)))
+        session.add(Transaction(amount=-2000, currency="EUR", timestamp=datetime(2025, 1, 20)))
+        session.add(Transaction(amount=-1000, currency="EUR", timestamp=datetime(2025, 2, 3)))
+        session.add(Transaction(amount=-300, currency="JPY", timestamp=datetime(2025, 2, 3)))
+        session.commit()
+        rollup.rebuild(session)
+
+        data = client.post("/api/report", json={"type": "expenses_by_month", "reporting_currency": "USD"}).json()
+        assert data["currency"] == "USD"
+        assert dict(zip(data["labels"], data["values"])) == {"2025-01": 32.0, "2025-02": 12.5}
+        daily = client.post("/api/report", json={"type": "expenses_by_day", "reporting_currency": "usd"}).json()
+        assert daily["values"] == [10.0, 22.0, 12.5]
+        resp = client.post("/api/report", json={"type": "expenses_by_month", "reporting_currency": "GBP"})
+        assert resp.status_code == 422
+
+    def test_transfer_across_currencies(self, client: TestClient):
+        """Each side of a transfer is booked in its own account's currency."""
+        self._load(client)
+        eur = client.post("/api/accounts", json={"name": "E", "balance": 100, "currency": "EUR"}).json()["id"]
+        usd = client.post("/api/accounts", json={"name": "U", "balance": 0, "currency": "USD"}).json()["id"]
+        gbp = client.post("/api/accounts", json={"name": "G", "balance": 0, "currency": "GBP"}).json()["id"]
+        data = client.post("/api/transfer", json={"from_account_id": eur, "to_account_id": usd, "amount": 10}).json()
+        assert (data["from_tx"]["currency"], data["from_tx"]["amount"]) == ("EUR", -10)
+        assert (data["to_tx"]["currency"], data["to_tx"]["amount"]) == ("USD", 10.5)
+        balances = {a["name"]: a["balance"] for a in client.get("/api/accounts").json()}
+        assert balances == {"E": 90, "U": 10.5, "G": 0}
+        resp = client.post("/api/transfer", json={"from_account_id": eur, "to_account_id": gbp, "amount": 10})
+        assert resp.status_code == 422
+
+
+class TestReport:
+    def test_report_expenses_by_category(self, client: TestClient, session: Session):
+        """Test that report type and year_month are honored by the SQL aggregation."""
+        food = client.post("/api/categories", json={"name": "Food"}).json()["id"]
+        session.add(Transaction(amount=-3000, category_id=food, timestamp=datetime(2025, 12, 3)))
+        session.add(Transaction(amount=-2000, category_id=food, timestamp=datetime(2025, 12, 9)))
+        session.add(Transaction(amount=-500, timestamp=datetime(2025, 12, 10)))
+        session.add(Transaction(amount=100000, category_id=food, timestamp=datetime(2025, 12, 1)))
+        session.add(Transaction(amount=-9900, category_id=food, timestamp=datetime(2025, 11, 30)))
+        session.commit()
+        rollup.rebuild(session)
+
+        response = client.post(
+            "/api/report",
+            json={"type": "expenses_by_category", "year_month": "2025-12"}
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert dict(zip(data["labels"], data["values"])) == {"Food": 50.0, "Uncategorized": 5.0}
+
+    def test_report_by_month(self, client: TestClient, session: Session):
+        """Test grouping totals by month."""
+        session.add(Transaction(amount=1000, timestamp=datetime(2025, 11, 2)))
+        session.add(Transaction(amount=1500, timestamp=datetime(2025, 12, 2)))
+        session.add(Transaction(amount=-500, timestamp=datetime(2025, 12, 20)))
+        session.commit()
+        rollup.rebuild(session)
+
+        data = client.post("/api/report", json={"type": "totals_by_month"}).json()
+        assert data["labels"] == ["2025-11", "2025-12"]
+        assert data["values"] == [10.0, 10.0]
+
+    def test_report_by_day(self, client: TestClient, session: Session):
+        """Test per-day grouping, which is computed from Transaction directly."""
+        session.add(Transaction(amount=-300, timestamp=datetime(2025, 12, 1, 9)))
+        session.add(Transaction(amount=-400, timestamp=datetime(2025, 12, 1, 18)))
+        session.add(Transaction(amount=-500, timestamp=datetime(2025, 12, 2)))
+        session.commit()
+
+        data = client.post("/api/report", json={"type": "expenses_by_day", "year_month": "2025-12"}).json()
+        assert data["labels"] == ["2025-12-01", "2025-12-02"]
+        assert data["values"] == [7.0, 5.0]
+
+    def test_report_unknown_type(self, client: TestClient):
+        """Test that an unsupported report type is rejected."""
+        response = client.post("/api/report", json={"type": "everything_by_planet"})
+        assert response.status_code == 400
+
+
+class TestAnalytics:
+    def test_trend_daily_with_rolling_mean(self, client: TestClient, session: Session):
+        """Test daily totals with gaps, the moving average and per-day percentiles."""
+        session.add(Transaction(amount=-1000, timestamp=datetime(2025, 3, 1, 9)))
+        session.add(Transaction(amount=-3000, timestamp=datetime(2025, 3, 1, 18)))
+        session.add(Transaction(amount=-500, timestamp=datetime(2025, 3, 3)))
+        session.add(Transaction(amount=7000, timestamp=datetime(2025, 3, 2)))
+        session.commit()
+
+        response = client.get("/api/analytics/trend", params={"window": 2})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["labels"] == ["2025-03-01", "2025-03-02", "2025-03-03"]
+        assert data["values"] == [40.0, 0.0, 5.0]
+        assert data["counts"] == [2, 0, 1]
+        assert data["rolling"] == [40.0, 20.0, 2.5]
+        assert data["p50"] == [20.0, None, 5.0]
+        assert data["p90"] == [28.0, None, 5.0]
+        assert data["chart"] is None
+
+    def test_trend_weekly_and_monthly(self, client: TestClient, session: Session):
+        """Test week (Monday) and month bins and the income filter."""
+        session.add(Transaction(amount=200, timestamp=datetime(2025, 3, 2)))  # Sunday
+        session.add(Transaction(amount=300, timestamp=datetime(2025, 3, 3)))  # Monday
+        session.add(Transaction(amount=-999, timestamp=datetime(2025, 3, 3)))
+        session.add(Transaction(amount=400, timestamp=datetime(2025, 4, 1)))
+        session.commit()
+
+        weekly = client.get("/api/analytics/trend", params={"freq": "week", "kind": "income"}).json()
+        assert weekly["labels"][:2] == ["2025-02-24", "2025-03-03"]
+        assert weekly["values"][:2] == [2.0, 3.0]
+        assert weekly["values"][-1] == 4.0
+        monthly = client.get("/api/analytics/trend", params={"freq": "month", "kind": "income", "window": 1}).json()
+        assert monthly["labels"] == ["2025-03", "2025-04"]
+        assert monthly["values"] == monthly["rolling"] == [5.0, 4.0]
+
+    def test_trend_chart_and_errors(self, client: TestClient, session: Session):
+        """Test the rendered line chart and rejected parameters."""
+        for day in range(1, 29):
+            session.add(Transaction(amount=-100 * day, timestamp=datetime(2025, 2, day)))
+        session.commit()
+
+        data = client.get("/api/analytics/trend", params={"chart": True, "window": 7}).json()
+        assert data["chart"].startswith("/api/uploads_report/chart_")
+        assert client.get(data["chart"]).status_code == 200
+        assert client.get("/api/analytics/trend", params={"freq": "hour"}).status_code == 400
+        assert client.get("/api/analytics/trend", params={"window": 0}).status_code == 422
+        empty = client.get("/api/analytics/trend", params={"date_from": "2030-01-01T00:00:00"}).json()
+        assert empty["labels"] == [] and empty["chart"] is None
+
+    def test_year_over_year(self, client: TestClient, session: Session):
+        """Test per-category totals against the previous year, cut at the same day of year."""
+        food = client.post("/api/categories", json={"name": "Food"}).json()["id"]
+        rent = client.post("/api/categories", json={"name": "Rent"}).json()["id"]
+        session.add(Transaction(amount=-5000, category_id=food, timestamp=datetime(2024, 2, 1)))
+        session.add(Transaction(amount=-4000, category_id=food, timestamp=datetime(2023, 2, 1)))
+        session.add(Transaction(amount=-9000, category_id=rent, timestamp=datetime(2024, 12, 31)))
+        session.add(Transaction(amount=-700, timestamp=datetime(2023, 6, 1)))
+        session.add(Transaction(amount=-100, timestamp=datetime(2022, 6, 1)))
+        session.commit()
+
+        data = client.get("/api/analytics/yoy", params={"year": 2024}).json()
+        assert data["through"] == "2024-12-31"
+        assert data["items"] == [
+            {"category_id": rent, "name": "Rent", "current": 90.0, "previous": 0.0, "change_pct": None},
+            {"category_id": food, "name": "Food", "current": 50.0, "previous": 40.0, "change_pct": 25.0},
+            {"category_id": None, "name": None, "current": 0.0, "previous": 7.0, "change_pct": -100.0},
+        ]
+
+
+    def test_year_over_year_leap_day_cutoff(self):
+        """Test that both years are cut at the same calendar day, Feb 29 included."""
+        def cols(*days):
+            n = len(days)
+            return analytics.Columns(
+                np.array(days, dtype="datetime64[D]"), np.full(n, 1000, np.int64),
+                np.full(n, analytics.NONE_ID, np.int64), np.full(n, analytics.NONE_ID, np.int64),
+            )
+
+        (item,) = analytics.year_over_year(cols("2024-02-29", "2023-02-28", "2023-03-01"), 2024, date(2024, 2, 29))
+        assert (item["current"], item["previous"]) == (1.0, 1.0)
+        (item,) = analytics.year_over_year(cols("2025-03-01", "2024-03-01", "2024-03-02"), 2025, date(2025, 3, 1))
+        assert (item["current"], item["previous"]) == (1.0, 1.0)
+        assert analytics.default_through(2024, date(2025, 6, 1)) == date(2024, 12, 31)
+        assert analytics.default_through(2025, date(2025, 6, 1)) == date(2025, 6, 1)
+
+    def test_trend_and_yoy_across_currencies(self, client: TestClient, session: Session):
+        """Test that other currencies are converted at each month's end rate."""
+        client.post("/api/fx/rates", files={"file": ("rates.csv", b"date,base,quote,rate\n2024-01-01,EUR,USD,2\n2025-04-01,EUR,USD,3\n", "text/csv")})
+        session.add(Transaction(amount=-1000, currency="USD", timestamp=datetime(2025, 3, 5)))
+        session.add(Transaction(amount=-1000, currency="EUR", timestamp=datetime(2025, 3, 6)))
+        session.add(Transaction(amount=-1000, currency="EUR", timestamp=datetime(2025, 4, 6)))
+        session.add(Transaction(amount=-500, currency="EUR", timestamp=datetime(2024, 3, 6)))
+        session.commit()
+
+        monthly = client.get("/api/analytics/trend", params={"freq": "month", "window": 1, "date_from": "2025-01-01T00:00:00"}).json()
+        assert monthly["currency"] == "USD"
+        assert monthly["values"] == [30.0, 30.0]
+        in_eur = client.get("/api/analytics/trend", params={
+            "freq": "month", "window": 1, "date_from": "2025-01-01T00:00:00", "reporting_currency": "EUR",
+        }).json()
+        assert in_eur["values"] == [15.0, 10.0]
+        assert client.get("/api/analytics/trend", params={
+            "freq": "month", "window": 1, "date_from": "2025-01-01T00:00:00", "currency": "EUR",
+        }).json()["values"] == [10.0, 10.0]
+        assert client.get("/api/analytics/trend", params={"reporting_currency": "JPY"}).status_code == 422
+
+        yoy = client.get("/api/analytics/yoy", params={"year": 2025, "reporting_currency": "EUR"}).json()
+        assert yoy["currency"] == "EUR"
+        assert yoy["items"][0]["previous"] == 5.0
+
+
+class TestRollup:
+    def test_rollup_follows_writes(self, client: TestClient, session: Session):
+        """Test that transaction and transfer writes update the monthly rollup."""
+        acc1 = client.post("/api/accounts", json={"name": "A1", "balance": 500}).json()["id"]
+        acc2 = client.post("/api/accounts", json={"name": "A2", "balance": 0}).json()["id"]
+        client.post("/api/transactions", json={"amount": -40.0, "account_id": acc1})
+        client.post("/api/transactions", json={"amount": -10.0, "account_id": acc1})
+        client.post("/api/transfer", json={"from_account_id": acc1, "to_account_id": acc2, "amount": 25.0})
+
+        rows = {r.account_id: r for r in session.exec(select(MonthlyRollup)).all()}
+        assert rows[acc1].total == -7500
+        assert rows[acc1].count == 3
+        assert rows[acc1].min_amount == -4000
+        assert rows[acc1].max_amount == -1000
+        assert rows[acc1].expense_total == 7500
+        assert rows[acc2].total == 2500
+        assert rows[acc2].income_count == 1
+
+    def test_rebuild_matches_incremental(self, client: TestClient, session: Session):
+        """Test that a full rebuild reproduces the incrementally maintained rows."""
+        cat = client.post("/api/categories", json={"name": "Cat"}).json()["id"]
+        for amount in (-5.0, 12.5, -7.25):
+            client.post("/api/transactions", json={"amount": amount, "category_id": cat})
+        client.post("/api/transactions", json={"amount": -1.0, "currency": "EUR"})
+
+        def snapshot():
+            return sorted((
+                (r.year_month, r.category_id, r.account_id, r.currency, r.total, r.count,
+                 r.min_amount, r.max_amount, r.expense_total, r.income_total)
+                for r in session.exec(select(MonthlyRollup)).all()
+            ), key=repr)
+
+        incremental = snapshot()
+        assert rollup.rebuild(session) == 2
+        session.expire_all()
+        assert snapshot() == incremental
+
+
+class TestCharts:
+    def test_render_charts_parallel_and_cached(self, tmp_path):
+        """Test that identical chart specs map to one cached file."""
+        specs = [
+            {"type": "bar", "labels": ["a", "b"], "values": [1, 2], "title": "Bar"},
+            {"type": "pie", "labels": ["a", "b"], "values": [3, 4], "title": "Pie"},
+            {"type": "radar", "labels": [], "values": []},
+        ]
+        store = ArtifactStore(tmp_path)
+        first = render_charts(specs, store)
+        paths = [p for _, p in first]
+        assert paths[0].exists() and paths[1].exists()
+        assert paths[2] is None
+        mtime = paths[0].stat().st_mtime_ns
+
+        again = render_charts(specs[:1], store)
+        assert again[0][1] == paths[0]
+        assert paths[0].stat().st_mtime_ns == mtime
+        assert store.metrics()["hits"] == 1
+
+    def test_chart_key_depends_on_inputs(self):
+        """Test that the cache key covers type, labels, values, title and size."""
+        base = chart_key("bar", ["a"], [1], "t")
+        assert base == chart_key("bar", ["a"], [1.0], "t")
+        assert base != chart_key("line", ["a"], [1], "t")
+        assert base != chart_key("bar", ["a"], [2], "t")
+        assert base != chart_key("bar", ["a"], [1], "other")
+        assert base != chart_key("bar", ["a"], [1], "t", size=(4, 4))
+
+    def test_serve_report_etag(self, client: TestClient):
+        """Test immutable caching headers and 304 on a matching If-None-Match."""
+        client.post("/api/transactions", json={"amount": -5.0})
+        url = client.post("/api/report", json={}).json()["chart"]
+
+        response = client.get(url)
+        assert response.status_code == 200
+        assert "immutable" in response.headers["cache-control"]
+        etag = response.headers["etag"]
+
+        cached = client.get(url, headers={"If-None-Match": etag})
+        assert cached.status_code == 304
+
+
+class TestArtifactStore:
+    def _write(self, store, name, size):
+        store.path(name).write_bytes(b"x" * size)
+        return store.add(name)
+
+    def test_lru_eviction_under_byte_budget(self, tmp_path):
+        """Test that least recently used artifacts are evicted past the budget."""
+        store = ArtifactStore(tmp_path, max_bytes=250, ttl_seconds=None)
+        self._write(store, "a.png", 100)
+        self._write(store, "b.png", 100)
+        assert store.get("a.png") is not None  # a is now most recently used
+        self._write(store, "c.png", 100)
+
+        assert not (tmp_path / "b.png").exists()
+        assert store.get("b.png") is None
+        assert store.get("a.png") is not None
+        m = store.metrics()
+        assert m["bytes_stored"] == 200
+        assert m["evictions"] == 1
+        assert m["hits"] == 2 and m["misses"] == 1
+
+    def test_ttl_expiry(self, tmp_path):
+        """Test that artifacts idle longer than the TTL are dropped on lookup."""
+        store = ArtifactStore(tmp_path, ttl_seconds=0)
+        self._write(store, "old.png", 10)
+        time.sleep(0.01)
+        assert store.get("old.png") is None
+        assert not (tmp_path / "old.png").exists()
+
+    def test_scan_existing_files(self, tmp_path):
+        """Test that files already on disk are indexed and budgeted at start."""
+        for name in ("1.png", "2.png", "3.png"):
+            (tmp_path / name).write_bytes(b"x" * 100)
+        store = ArtifactStore(tmp_path, max_bytes=200, ttl_seconds=None)
+        assert store.metrics()["artifacts"] == 2
+        assert store.metrics()["bytes_stored"] == 200
+
+    def test_reports_metrics_endpoint(self, client: TestClient):
+        """Test the artifact metrics endpoint."""
+        data = client.get("/api/reports/metrics").json()
+        assert {"hit_rate", "bytes_stored", "evictions"} <= set(data)
+
+
+def _stub_llm(responses, **kwargs):
+    """LLMClient backed by an in-process stub server returning `responses` in order."""
+    calls = []
+
+    def handler(request: httpx.Request):
+        calls.append(json.loads(request.content))
+        status, body = responses[min(len(calls), len(responses)) - 1]
+        return httpx.Response(status, json=body)
+
+    client = LLMClient(api_key="test", base_url="http://stub/v1", backoff=0, transport=httpx.MockTransport(handler), **kwargs)
+    return client, calls
+
+
+def _completion(content):
+    return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+
+class TestSummary:
+    def _seed(self, client, session):
+        food = client.post("/api/categories", json={"name": "Food"}).json()["id"]
+        rent = client.post("/api/categories", json={"name": "Rent"}).json()["id"]
+        client.post("/api/budgets", json={"year_month": "2025-12", "category_id": food, "amount": 300})
+        for ts, amount, cat, desc in [
+            (datetime(2025, 12, 2), -4500, food, "Uber Eats"),
+            (datetime(2025, 12, 9), -3000, food, "uber eats "),
+            (datetime(2025, 12, 1), -90000, rent, "Landlord"),
+            (datetime(2025, 11, 3), -5000, food, "Market"),
+            (datetime(2025, 12, 15), 200000, None, "Salary"),
+        ]:
+            session.add(Transaction(amount=amount, category_id=cat, description=desc, timestamp=ts))
+        session.commit()
+        rollup.rebuild(session)
+
+    def test_digest_contents(self, client: TestClient, session: Session):
+        """Test that the digest carries budgets, monthly totals and merchants."""
+        self._seed(client, session)
+        text = build_digest_text(session, today=date(2025, 12, 20))
+        assert "Food [USD]: budget 300, spent 75, left 225" in text
+        assert "2025-12 Rent [USD]: spent 900" in text
+        assert "2025-11 Food [USD]: spent 50" in text
+        assert "2025-12 Uncategorized [USD]: earned 2000" in text
+        assert "uber eats [USD]: 2 payments, 75" in text
+
+    def test_digest_budgets_match_budget_status(self, client: TestClient, session: Session):
+        """Test that digest budget lines roll up subcategories and show an overall budget as Total."""
+        self._seed(client, session)
+        food = session.exec(select(Category).where(Category.name == "Food")).one().id
+        cafe = client.post("/api/categories", json={"name": "Cafe", "parent_id": food}).json()["id"]
+        client.post("/api/budgets", json={"year_month": "2025-12", "amount": 2000})
+        session.add(Transaction(amount=-2500, category_id=cafe, description="Latte", timestamp=datetime(2025, 12, 10)))
+        session.commit()
+        rollup.rebuild(session)
+
+        text = build_digest_text(session, today=date(2025, 12, 20))
+        assert "Food [USD]: budget 300, spent 100, left 200" in text
+        assert "Total [USD]: budget 2000, spent 1000, left 1000" in text
+        assert "Uncategorized: budget" not in text
+
+    def test_digest_across_currencies(self, client: TestClient, session: Session):
+        """Test that budgets are converted into the reporting currency and merchants are listed per currency."""
+        self._seed(client, session)
+        client.post("/api/fx/rates", files={"file": ("rates.csv", b"date,base,quote,rate\n2020-01-01,EUR,USD,2\n", "text/csv")})
+        food = session.exec(select(Category).where(Category.name == "Food")).one().id
+        session.add(Transaction(amount=-1000, currency="EUR", category_id=food, description="Uber Eats", timestamp=datetime(2025, 12, 12)))
+        session.commit()
+        rollup.rebuild(session)
+
+        text = build_digest_text(session, today=date(2025, 12, 20))
+        assert "Food [USD]: budget 300, spent 95, left 205" in text
+        assert "uber eats [USD]: 2 payments, 75" in text
+        assert "uber eats [EUR]: 1 payments, 10" in text
+
+    def test_digest_token_budget(self, client: TestClient, session: Session):
+        """Test that the digest is trimmed to the token budget."""
+        self._seed(client, session)
+        text = build_digest_text(session, today=date(2025, 12, 20), token_budget=40)
+        assert estimate_tokens(text) <= 48
+        assert "more lines omitted" in text
+
+    def test_digest_cached_per_data_version(self, client: TestClient, session: Session):
+        """Test that the digest is reused until the data changes."""
+        self._seed(client, session)
+        cache = DigestCache()
+        first = cache.get_or_build(session, today=date(2025, 12, 20))
+        second = cache.get_or_build(session, today=date(2025, 12, 20))
+        assert not first.cached and second.cached
+        assert second.text == first.text
+
+        client.post("/api/transactions", json={"amount": -1.0, "timestamp": "2025-12-21T10:00:00"})
+        third = cache.get_or_build(session, today=date(2025, 12, 20))
+        assert not third.cached
+
+    def test_digest_sees_updates_in_place(self, client: TestClient, session: Session):
+        """Test that rule backfills and category renames, which add no rows, invalidate the digest."""
+        cache = DigestCache()
+        client.post("/api/transactions", json={"amount": -10, "description": "Cafe", "timestamp": "2025-12-02T10:00:00"})
+        assert "Uncategorized [USD]: spent 10" in cache.get_or_build(session, today=date(2025, 12, 20)).text
+        food = client.post("/api/categories", json={"name": "Food"}).json()["id"]
+        client.post("/api/rules", json={"category_id": food, "pattern": "cafe"})
+        before = cache.get_or_build(session, today=date(2025, 12, 20))
+
+        client.post("/api/rules/apply")
+        applied = cache.get_or_build(session, today=date(2025, 12, 20))
+        assert not applied.cached and "Food [USD]: spent 10" in applied.text
+        client.patch(f"/api/categories/{food}", json={"name": "Eating out"})
+        renamed = cache.get_or_build(session, today=date(2025, 12, 20))
+        assert not renamed.cached and "Eating out [USD]: spent 10" in renamed.text
+        assert before.text != applied.text
+
+        # Writes outside the API (CLI tools, other workers) reach the digest through the change log.
+        session.execute(text("UPDATE category SET name = 'Dining' WHERE id = :id"), {"id": food})
+        session.commit()
+        assert "Dining [USD]: spent 10" in cache.get_or_build(session, today=date(2025, 12, 20)).text
+
+
+class TestAIClient:
+    def test_retries_transient_errors(self):
+        """Test that 5xx responses are retried with backoff."""
+        client, calls = _stub_llm([(503, {}), (200, _completion("hello"))])
+        assert asyncio.run(client.chat([{"role": "user", "content": "hi"}])) == "hello"
+        assert len(calls) == 2
+
+    def test_gives_up_on_client_errors(self):
+        """Test that a 4xx response is not retried."""
+        client, calls = _stub_llm([(401, {"error": "bad key"})])
+        with pytest.raises(LLMError) as exc:
+            asyncio.run(client.chat([{"role": "user", "content": "hi"}]))
+        assert exc.value.status_code == 401
+        assert len(calls) == 1
+
+    def test_response_cache(self, tmp_path):
+        """Test that repeated prompts are served from the memory and disk caches."""
+        messages = [{"role": "user", "content": "same prompt"}]
+        client, calls = _stub_llm([(200, _completion("cached"))], cache=ResponseCache(directory=str(tmp_path)))
+
+        async def run():
+            first = await client.chat(messages)
+            second = await client.chat(messages)
+            other = await client.chat(messages, temperature=0.9)
+            return first, second, other
+
+        assert asyncio.run(run()) == ("cached", "cached", "cached")
+        assert len(calls) == 2  # the temperature change is a different key
+
+        fresh, fresh_calls = _stub_llm([(500, {})], cache=ResponseCache(directory=str(tmp_path)))
+        assert asyncio.run(fresh.chat(messages)) == "cached"
+        assert fresh_calls == []
+
 
 class TestAIChat:
     def test_ai_chat_without_openai_key(self, client: TestClient):
@@ -286,3 +1800,113 @@ class TestAIChat:
             json={"prompt": ""}
         )
         assert response.status_code == 400
+
+    def test_ai_chat_with_stub_server(self, client: TestClient, monkeypatch):
+        """Test the OpenAI branch end to end against a stub server."""
+        reply = json.dumps({
+            "text": "Spending summary",
+            "charts": [
+                {"type": "bar", "labels": ["Food"], "values": [10], "title": "By category"},
+                {"type": "unknown", "labels": [], "values": []},
+            ],
+        })
+        stub, calls = _stub_llm([(200, _completion(f"```json\n{reply}\n```"))])
+        monkeypatch.setenv("OPENAI_API_KEY", "test")
+        monkeypatch.setattr(main, "llm", stub)
+
+        response = client.post("/api/ai/chat", json={"prompt": "Show spending"})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["text"] == "Spending summary"
+        assert [c["title"] for c in data["charts"]] == ["By category"]
+        assert calls[0]["messages"][-1] == {"role": "user", "content": "Show spending"}
+        assert "Data summary:" in calls[0]["messages"][0]["content"]
+        assert int(response.headers["X-Prompt-Tokens"]) > 0
+        assert "llm;dur=" in response.headers["Server-Timing"]
+
+    def test_ai_chat_releases_the_reader_before_the_llm(self, client: TestClient, session: Session, monkeypatch):
+        """Test that no database connection is held while waiting for the model."""
+        seen = []
+
+        class Stub:
+            async def chat(self, messages, **kwargs):
+                seen.append(session.in_transaction())
+                return json.dumps({"text": "ok", "charts": []})
+
+        monkeypatch.setenv("OPENAI_API_KEY", "test")
+        monkeypatch.setattr(main, "llm", Stub())
+        client.post("/api/transactions", json={"amount": -5, "description": "Coffee"})
+        assert client.post("/api/ai/chat", json={"prompt": "Show spending"}).status_code == 200
+        assert seen == [False]
+
+    def test_ai_chat_upstream_error(self, client: TestClient, monkeypatch):
+        """Test that an upstream API error maps to 502."""
+        stub, _ = _stub_llm([(401, {})])
+        monkeypatch.setenv("OPENAI_API_KEY", "test")
+        monkeypatch.setattr(main, "llm", stub)
+        response = client.post("/api/ai/chat", json={"prompt": "Show spending"})
+        assert response.status_code == 502
+
+
+class TestMetrics:
+    def test_route_histograms_and_db_spans(self, client: TestClient):
+        """Test latency series per route template, DB spans in Server-Timing and the Prometheus output."""
+        acc = client.post("/api/accounts", json={"name": "Cash", "balance": 10}).json()["id"]
+        listed = client.get("/api/accounts")
+        assert 'db;dur=' in listed.headers["server-timing"]
+        client.get(f"/api/accounts/{acc}/balance")
+        client.get(f"/api/accounts/{acc + 1}/balance")
+        client.get("/api/no-such-route")
+
+        response = client.get("/api/metrics")
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        text = response.text
+        route = 'method="GET",route="/api/accounts/{account_id}/balance"'
+        assert f'homebuh_request_duration_seconds_count{{{route},status="200"}} 1' in text
+        assert f'homebuh_request_duration_seconds_count{{{route},status="404"}} 1' in text
+        assert 'route="unmatched",status="404"' in text
+        assert f'homebuh_request_duration_seconds_bucket{{{route},status="200",le="+Inf"}} 1' in text
+        assert 'homebuh_span_duration_seconds_count{span="db"}' in text
+        assert "homebuh_response_cache_bytes " in text
+
+    def test_llm_and_chart_spans(self, client: TestClient, monkeypatch):
+        """Test that OpenAI calls and chart renders are timed, next to the handler's own Server-Timing."""
+        # A title never used before, so the chart is rendered rather than found in the report store.
+        chart = {"type": "bar", "labels": ["Food"], "values": [3], "title": f"Spans {uuid.uuid4().hex}"}
+        reply = json.dumps({"text": "ok", "charts": [chart]})
+        stub, _ = _stub_llm([(200, _completion(reply))])
+        monkeypatch.setenv("OPENAI_API_KEY", "test")
+        monkeypatch.setattr(main, "llm", stub)
+
+        response = client.post("/api/ai/chat", json={"prompt": "Show spending"})
+        assert response.status_code == 200
+        timing = response.headers["server-timing"]
+        assert timing.startswith("digest;dur=") and timing.count("llm;dur=") == 1
+        assert 'chart;dur=' in timing and 'db;dur=' in timing
+        spans = {k[0]: v for k, v in metrics.span_seconds.snapshot().items()}
+        assert sum(spans["llm"][0]) == 1 and sum(spans["chart"][0]) == 1
+
+    def test_profile(self, client: TestClient, monkeypatch):
+        """Test the opt-in sampling profiler's collapsed stacks and its one-at-a-time lock."""
+        assert client.get("/api/debug/profile", params={"seconds": 0.1}).status_code == 404
+        monkeypatch.setattr(metrics, "PROFILING", True)
+
+        stop = time.monotonic() + 0.5
+
+        def busy_loop():
+            while time.monotonic() < stop:
+                sum(range(1000))
+
+        worker = threading.Thread(target=busy_loop, name="busy worker")
+        worker.start()
+        response = client.get("/api/debug/profile", params={"seconds": 0.2})
+        worker.join()
+        assert response.status_code == 200
+        assert response.headers["content-disposition"].endswith('.folded"')
+        lines = response.text.splitlines()
+        busy = [line for line in lines if line.startswith("busy_worker;")]
+        assert busy and "busy_loop (test_main.py:" in busy[0]
+        assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+        with metrics._profiling:
+            assert client.get("/api/debug/profile", params={"seconds": 0.1}).status_code == 409
@@ -0,0 +1,221 @@
+"""Transfers between accounts.
+
+`post` moves money with conditional UPDATEs (`balance = balance - :debit
+WHERE balance >= :debit`) instead of reading, checking and writing back the
+balance in Python, so concurrent transfers can neither overdraw an account
+nor lose each other's updates, whether they run in one process or many.
+On SQLite the transaction starts with BEGIN IMMEDIATE, so the write lock
+is taken (waiting up to busy_timeout) before the account reads; a deferred
+transaction that reads first and then upgrades to a write can fail with
+"database is locked" when another connection commits in between. The lock
+spans the two reads, the two balance updates, the two ledger rows and the
+rollup. Accounts are updated in id order so two opposite transfers cannot
+deadlock on Postgres.
+
+    python -m backend.transfers stress [--transfers 5000] [--workers 16] [--accounts 10]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import event, func, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from . import balances, rollup
+from .fx import MissingRate, rates
+from .models import Account, Transaction
+from .money import to_major, to_minor
+
+
+def post(
+    s: Session,
+    from_account_id: int,
+    to_account_id: int,
+    amount: Decimal,
+    currency: Optional[str] = None,
+    description: Optional[str] = None,
+) -> Tuple[Transaction, Transaction]:
+    """Book a transfer and flush it. Does not commit; on an error the session is rolled back.
+
+    `amount` is in `currency` (the source account's by default); each side
+    is booked in its own account's currency.
+    """
+    if amount <= 0:
+        raise HTTPException(status_code=400, detail="amount must be positive")
+    _begin_write(s)
+    src = s.get(Account, from_account_id)
+    dst = s.get(Account, to_account_id)
+    if not src or not dst:
+        raise HTTPException(status_code=404, detail="account not found")
+    if src.id == dst.id:
+        raise HTTPException(status_code=400, detail="source and destination must differ")
+    currency = (currency or src.currency).upper()
+    today = datetime.utcnow().date()
+    try:
+        debit = to_minor(rates.convert(s, amount, currency, src.currency, today), src.currency)
+        credit = to_minor(rates.convert(s, amount, currency, dst.currency, today), dst.currency)
+    except MissingRate as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    a = Account
+    opts = {"synchronize_session": False}
+    debit_stmt = update(a).where(a.id == src.id, a.balance >= debit).values(balance=a.balance - debit).execution_options(**opts)
+    credit_stmt = update(a).where(a.id == dst.id).values(balance=a.balance + credit).execution_options(**opts)
+    if src.id < dst.id:
+        debited = s.exec(debit_stmt).rowcount
+        if debited:
+            s.exec(credit_stmt)
+    else:
+        s.exec(credit_stmt)
+        debited = s.exec(debit_stmt).rowcount
+    if not debited:
+        s.rollback()
+        raise HTTPException(status_code=400, detail="insufficient funds")
+
+    tx1 = Transaction(amount=-debit, currency=src.currency, account_id=src.id,
+                      description=description or f"Transfer to account {dst.name}")
+    tx2 = Transaction(amount=credit, currency=dst.currency, account_id=dst.id,
+                      description=description or f"Transfer from account {src.name}")
+    s.add(tx1)
+    s.add(tx2)
+    rollup.apply_many(s, [tx1, tx2])
+    balances.invalidate_snapshots(s, {src.id: tx1.timestamp, dst.id: tx2.timestamp})
+    s.flush()
+    # The UPDATEs bypassed the identity map; don't serve stale balances from it.
+    s.expire(src)
+    s.expire(dst)
+    return tx1, tx2
+
+
+def _begin_write(s: Session):
+    """Start the session's transaction as a write on SQLite (BEGIN IMMEDIATE), unless one is open.
+
+    SQLite's own busy handler backs off to 100 ms sleeps, so under many
+    writers a waiter that started early keeps losing the lock to newer
+    ones and can run out its busy_timeout. Instead the lock is polled with
+    short random sleeps, which gives every waiter the same chance, for up
+    to the connection's busy_timeout.
+    """
+    conn = s.connection()
+    if conn.dialect.name != "sqlite" or conn.connection.dbapi_connection.in_transaction:
+        return
+    timeout_ms = conn.exec_driver_sql("PRAGMA busy_timeout").scalar()
+    conn.exec_driver_sql("PRAGMA busy_timeout = 0")
+    try:
+        deadline = time.monotonic() + timeout_ms / 1000
+        while True:
+            try:
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+                return
+            except OperationalError as e:
+                if "locked" not in str(e.orig) or time.monotonic() >= deadline:
+                    raise
+            time.sleep(random.uniform(0.005, 0.02))
+    finally:
+        conn.exec_driver_sql(f"PRAGMA busy_timeout = {int(timeout_ms)}")
+
+
+def stress(url: Optional[str] = None, transfers: int = 5000, workers: int = 16, accounts: int = 10, seed: int = 3) -> dict:
+    """Fire `transfers` random transfers from `workers` threads, each with its own connection.
+
+    Every worker writes through its own connection, as separate server
+    processes would. Checks that the total balance is conserved, that no
+    balance went negative and that every balance matches its ledger.
+    Database errors (e.g. "database is locked") are counted in `errors`.
+    """
+    from .db import _sqlite_pragmas
+
+    tmpdir = None
+    if url is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        url = f"sqlite:///{os.path.join(tmpdir.name, 'stress.db')}"
+    eng = create_engine(url, connect_args={"check_same_thread": False}, poolclass=QueuePool, pool_size=workers, max_overflow=0)
+    if url.startswith("sqlite"):
+        event.listen(eng, "connect", _sqlite_pragmas)
+    SQLModel.metadata.create_all(eng)
+
+    rnd = random.Random(seed)
+    with Session(eng) as s:
+        ids = []
+        for i in range(accounts):
+            acc = Account(name=f"stress-{i}", balance=to_minor(1000), opening_balance=to_minor(1000))
+            s.add(acc)
+            s.flush()
+            ids.append(acc.id)
+        s.commit()
+        before = s.exec(select(func.sum(Account.balance)).where(Account.id.in_(ids))).one()
+    jobs = []
+    for _ in range(transfers):
+        src, dst = rnd.sample(ids, 2)
+        jobs.append((src, dst, Decimal(rnd.randint(1, 40000)).scaleb(-2)))
+
+    def run(job):
+        with Session(eng) as s:
+            try:
+                post(s, *job)
+                s.commit()
+                return "ok"
+            except HTTPException:
+                return "rejected"
+            except OperationalError:
+                s.rollback()
+                return "errors"
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = Counter(pool.map(run, jobs))
+    seconds = time.perf_counter() - started
+
+    with Session(eng) as s:
+        after, lowest = s.exec(select(func.sum(Account.balance), func.min(Account.balance)).where(Account.id.in_(ids))).one()
+        ledger = dict(s.exec(
+            select(Transaction.account_id, func.sum(Transaction.amount)).where(Transaction.account_id.in_(ids)).group_by(Transaction.account_id)
+        ).all())
+        mismatched = sum(
+            1 for acc_id, balance in s.exec(select(Account.id, Account.balance).where(Account.id.in_(ids)))
+            if balance != to_minor(1000) + ledger.get(acc_id, 0)
+        )
+    eng.dispose()
+    if tmpdir is not None:
+        tmpdir.cleanup()
+    ok, rejected, errors = results["ok"], results["rejected"], results["errors"]
+    stats = {
+        "transfers": transfers, "ok": ok, "rejected": rejected, "errors": errors, "seconds": round(seconds, 3),
+        "per_second": round(transfers / seconds, 1), "total_before": to_major(before), "total_after": to_major(after),
+        "min_balance": to_major(lowest), "mismatched_accounts": mismatched,
+    }
+    print(
+        f"{transfers} transfers on {workers} workers: {ok} ok, {rejected} rejected, {errors} database errors, "
+        f"{stats['per_second']} transfers/s | total {stats['total_before']} -> {stats['total_after']}, "
+        f"min balance {stats['min_balance']}, ledger mismatches {mismatched}"
+    )
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m backend.transfers")
+    sub = parser.add_subparsers(dest="command", required=True)
+    st = sub.add_parser("stress", help="parallel random transfers on a scratch database; checks balances are conserved")
+    st.add_argument("--transfers", type=int, default=5000)
+    st.add_argument("--workers", type=int, default=16)
+    st.add_argument("--accounts", type=int, default=10)
+    st.add_argument("--url", help="database URL to run against (default: a temporary SQLite file)")
+    args = parser.parse_args(argv)
+    stats = stress(args.url, args.transfers, args.workers, args.accounts)
+    conserved = stats["total_before"] == stats["total_after"] and not stats["mismatched_accounts"]
+    return 0 if conserved and stats["min_balance"] >= 0 and not stats["errors"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,36 +1,186 @@
 from pathlib import Path
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
-from typing import List
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
 
-def generate_bar_chart(labels: List[str], values: List[float], out_path: Path):
-    fig, ax = plt.subplots(figsize=(8,4))
-    ax.bar(labels, values, color="#4c78a8")
-    ax.set_xticklabels(labels, rotation=30, ha="right")
-    ax.set_ylabel("Amount")
-    fig.tight_layout()
+from .metrics import span
+
+if TYPE_CHECKING:
+    from .artifacts import ArtifactStore
+
+DPI = 150
+DEFAULT_SIZES = {"bar": (8, 4), "line": (8, 4), "pie": (6, 6)}
+MAX_TICKS = 24  # x-axis labels on a line chart
+MARKER_MAX_POINTS = 60
+# 0 renders in the calling thread (no worker processes).
+CHART_WORKERS = int(os.getenv("HOMEBUH_CHART_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+
+def _save(fig, out_path: Path):
+    # Write to a temp name and rename so a concurrently served file is never partial.
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    fig.savefig(out_path, dpi=150)
+    tmp = out_path.with_name(f".{out_path.name}.{os.getpid()}.tmp")
+    fig.savefig(tmp, dpi=DPI, format="png")
     plt.close(fig)
+    os.replace(tmp, out_path)
     return out_path
 
-def generate_line_chart(labels: List[str], values: List[float], out_path: Path):
-    fig, ax = plt.subplots(figsize=(8,4))
-    ax.plot(labels, values, marker='o', color="#4c78a8")
+def generate_bar_chart(labels: List[str], values: List[float], out_path: Path, title: Optional[str] = None, size=None):
+    fig, ax = plt.subplots(figsize=size or DEFAULT_SIZES["bar"])
+    ax.bar(labels, values, color="#4c78a8")
+    ax.set_xticks(range(len(labels)))
     ax.set_xticklabels(labels, rotation=30, ha="right")
     ax.set_ylabel("Amount")
+    if title:
+        ax.set_title(title)
     fig.tight_layout()
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    fig.savefig(out_path, dpi=150)
-    plt.close(fig)
-    return out_path
+    return _save(fig, out_path)
+
+def generate_line_chart(labels: List[str], values: List[float], out_path: Path, title: Optional[str] = None, size=None):
+    fig, ax = plt.subplots(figsize=size or DEFAULT_SIZES["line"])
+    # Markers and one tick per point only while they stay legible; a daily
+    # series over a year would otherwise draw 365 overlapping labels.
+    ax.plot(labels, values, marker='o' if len(labels) <= MARKER_MAX_POINTS else None, color="#4c78a8")
+    step = max(1, -(-len(labels) // MAX_TICKS))
+    ax.set_xticks(range(0, len(labels), step))
+    ax.set_xticklabels(labels[::step], rotation=30, ha="right")
+    ax.set_ylabel("Amount")
+    if title:
+        ax.set_title(title)
+    fig.tight_layout()
+    return _save(fig, out_path)
 
-def generate_pie_chart(labels: List[str], values: List[float], out_path: Path):
-    fig, ax = plt.subplots(figsize=(6,6))
+def generate_pie_chart(labels: List[str], values: List[float], out_path: Path, title: Optional[str] = None, size=None):
+    fig, ax = plt.subplots(figsize=size or DEFAULT_SIZES["pie"])
     ax.pie(values, labels=labels, autopct='%1.1f%%', colors=plt.cm.tab20.colors)
+    if title:
+        ax.set_title(title)
     fig.tight_layout()
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    fig.savefig(out_path, dpi=150)
-    plt.close(fig)
+    return _save(fig, out_path)
+
+RENDERERS = {"bar": generate_bar_chart, "line": generate_line_chart, "pie": generate_pie_chart}
+
+
+def chart_key(ctype: str, labels: Sequence, values: Sequence, title: Optional[str] = "", size=None) -> str:
+    """Content hash identifying a rendered chart; identical inputs give identical files."""
+    spec = {
+        "type": ctype,
+        "labels": [str(l) for l in labels],
+        "values": [float(v) for v in values],
+        "title": title or "",
+        "size": list(size or DEFAULT_SIZES.get(ctype, ())),
+        "dpi": DPI,
+    }
+    blob = json.dumps(spec, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(blob.encode()).hexdigest()[:32]
+
+
+def chart_filename(key: str) -> str:
+    return f"chart_{key}.png"
+
+
+def _render(ctype: str, labels, values, out_path: str, title, size):
+    RENDERERS[ctype](list(labels), list(values), Path(out_path), title=title, size=size)
     return out_path
+
+
+def _warm_worker():
+    # Runs once per worker process so the first render doesn't pay for font cache setup.
+    fig, _ = plt.subplots()
+    plt.close(fig)
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_inflight: Dict[str, Future] = {}
+
+
+def _get_pool() -> Optional[ProcessPoolExecutor]:
+    global _pool
+    if CHART_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=CHART_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_worker,
+            )
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def _submit(key: str, ctype: str, labels, values, out_path: Path, title, size) -> Future:
+    """Start a render unless the same chart is already being rendered."""
+    with _pool_lock:
+        fut = _inflight.get(key)
+        if fut is not None:
+            return fut
+    pool = _get_pool()
+    if pool is None:
+        fut = Future()
+        try:
+            fut.set_result(_render(ctype, labels, values, str(out_path), title, size))
+        except Exception as e:
+            fut.set_exception(e)
+        return fut
+    fut = pool.submit(_render, ctype, list(labels), list(values), str(out_path), title, size)
+    with _pool_lock:
+        _inflight[key] = fut
+    fut.add_done_callback(lambda _f: _inflight.pop(key, None))
+    return fut
+
+
+def render_charts(specs: List[dict], store: "ArtifactStore", timeout: float = 60) -> List[Tuple[dict, Optional[Path]]]:
+    """Render chart specs ({"type","labels","values","title"[,"size"]}) in parallel.
+
+    Files are named by content hash and kept in `store`, so a chart that was
+    rendered before is returned without touching matplotlib. Returns
+    (spec, path) pairs; path is None for unsupported types or failed renders.
+    """
+    pending = []
+    for spec in specs:
+        ctype = spec.get("type")
+        if ctype not in RENDERERS:
+            pending.append((spec, None, None))
+            continue
+        labels, values = spec.get("labels", []), spec.get("values", [])
+        title, size = spec.get("title"), spec.get("size")
+        try:
+            key = chart_key(ctype, labels, values, title, size)
+        except (TypeError, ValueError):
+            pending.append((spec, None, None))
+            continue
+        name = chart_filename(key)
+        path = store.get(name)
+        if path is not None:
+            pending.append((spec, path, None))
+        else:
+            path = store.path(name)
+            pending.append((spec, path, _submit(key, ctype, labels, values, path, title, size)))
+
+    results = []
+    for spec, path, fut in pending:
+        if fut is not None:
+            try:
+                with span("chart"):  # renders overlap, so this is time spent waiting
+                    fut.result(timeout=timeout)
+                path = store.add(path.name)
+            except Exception:
+                path = None
+        results.append((spec, path))
+    return results
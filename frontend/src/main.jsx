@@ -7,3 +7,15 @@ createRoot(document.getElementById('root')).render(
     <App />
   </React.StrictMode>
 )
+
+if ('serviceWorker' in navigator) {
+  // In dev Vite serves the worker from src/; the build emits it at the root (see vite.config.js).
+  const url = import.meta.env.DEV ? '/src/service-worker.js' : '/service-worker.js'
+  // The backend the pages talk to; the worker only handles requests to it.
+  const api = import.meta.env.VITE_API_ORIGIN || 'http://localhost:8000'
+  navigator.serviceWorker.register(`${url}?api=${encodeURIComponent(api)}`, { scope: '/' }).catch(e => console.error('Service worker failed:', e))
+  // Replay writes queued offline as soon as the connection is back.
+  window.addEventListener('online', () => {
+    navigator.serviceWorker.ready.then(reg => reg.active && reg.active.postMessage({ type: 'flush' }))
+  })
+}
@@ -1,7 +1,274 @@
-self.addEventListener('install', event => {
-  self.skipWaiting();
-});
+// Offline-first service worker.
+//
+// Keeps a replica of the synced tables in IndexedDB, updated from the
+// backend's change log with GET /api/sync?since=<cursor>: after the first
+// snapshot only rows changed or deleted since the stored cursor are
+// transferred. List reads are answered from the replica and refreshed in
+// the background. Writes to endpoints that honour Idempotency-Key (see
+// QUEUEABLE) made while offline go to an outbox and are replayed in order,
+// in batches, each with its own key so a replay interrupted halfway does
+// not post twice. Other writes need the network.
+//
+// The page passes the backend's origin in the script URL (?api=, see
+// main.jsx); without it the worker assumes the page's own origin.
+
+const API = new URL(self.location).searchParams.get('api') || self.location.origin
+const DB_NAME = 'homebuh'
+const DB_VERSION = 1
+const TABLES = ['category', 'account', 'transaction', 'budget', 'planneditem', 'categoryrule']
+const SYNC_PAGE = 2000
+const REPLAY_BATCH = 20
+// POST endpoints whose replays are deduplicated by Idempotency-Key.
+const QUEUEABLE = ['/api/transactions', '/api/transfer']
+
+// List endpoint -> replica table, and how the endpoint orders its rows.
+const LISTS = {
+  '/api/categories': { table: 'category', order: (a, b) => a.id - b.id },
+  '/api/accounts': { table: 'account', order: (a, b) => a.id - b.id },
+  '/api/budgets': { table: 'budget', order: (a, b) => a.id - b.id },
+  '/api/planned': { table: 'planneditem', order: (a, b) => a.id - b.id },
+  '/api/rules': { table: 'categoryrule', order: (a, b) => a.priority - b.priority || a.id - b.id },
+  '/api/transactions': {
+    table: 'transaction',
+    order: (a, b) => (a.timestamp < b.timestamp ? 1 : a.timestamp > b.timestamp ? -1 : b.id - a.id)
+  }
+}
+
+// ---- IndexedDB ----
+
+let dbPromise = null
+
+function openDb() {
+  if (!dbPromise) {
+    dbPromise = new Promise((resolve, reject) => {
+      const req = indexedDB.open(DB_NAME, DB_VERSION)
+      req.onupgradeneeded = () => {
+        const db = req.result
+        for (const t of TABLES) db.createObjectStore(t, { keyPath: 'id' })
+        db.createObjectStore('meta')
+        db.createObjectStore('outbox', { keyPath: 'seq', autoIncrement: true })
+      }
+      req.onsuccess = () => resolve(req.result)
+      req.onerror = () => reject(req.error)
+    })
+  }
+  return dbPromise
+}
+
+function done(request) {
+  return new Promise((resolve, reject) => {
+    request.onsuccess = () => resolve(request.result)
+    request.onerror = () => reject(request.error)
+  })
+}
+
+// Runs fn(stores) in one transaction and resolves when it has committed.
+async function withStores(names, mode, fn) {
+  const db = await openDb()
+  const tx = db.transaction(names, mode)
+  // Listen before fn runs: a read-only transaction may complete as soon as its requests do.
+  const committed = new Promise((resolve, reject) => {
+    tx.oncomplete = resolve
+    tx.onerror = () => reject(tx.error)
+    tx.onabort = () => reject(tx.error)
+  })
+  const stores = Object.fromEntries(names.map(n => [n, tx.objectStore(n)]))
+  const result = await fn(stores)
+  await committed
+  return result
+}
+
+// ---- Delta sync ----
+
+let syncing = null
+
+async function pullPage(cursor) {
+  const r = await fetch(`${API}/api/sync?since=${cursor}&limit=${SYNC_PAGE}`)
+  if (!r.ok) throw new Error(`sync failed: ${r.status}`)
+  const page = await r.json()
+  await withStores([...TABLES, 'meta'], 'readwrite', stores => {
+    if (page.reset) {
+      for (const t of TABLES) stores[t].clear()
+    }
+    for (const [table, change] of Object.entries(page.changes)) {
+      const store = stores[table]
+      if (!store) continue
+      for (const row of change.upserts) store.put(row)
+      for (const id of change.deletes) store.delete(id)
+    }
+    stores.meta.put(page.cursor, 'cursor')
+  })
+  return page
+}
+
+// Brings the replica up to date; concurrent callers share one run.
+function sync() {
+  if (!syncing) {
+    syncing = (async () => {
+      let cursor = (await withStores(['meta'], 'readonly', s => done(s.meta.get('cursor')))) || 0
+      for (;;) {
+        const page = await pullPage(cursor)
+        cursor = page.cursor
+        if (!page.more) break
+      }
+    })().finally(() => { syncing = null })
+  }
+  return syncing
+}
+
+async function replicaReady() {
+  const cursor = await withStores(['meta'], 'readonly', s => done(s.meta.get('cursor')))
+  return cursor !== undefined
+}
+
+async function fromReplica(url, { table, order }) {
+  let rows = await withStores([table], 'readonly', s => done(s[table].getAll()))
+  rows.sort(order)
+  if (table === 'transaction') {
+    for (const key of ['account_id', 'category_id']) {
+      const value = url.searchParams.get(key)
+      if (value !== null) rows = rows.filter(r => String(r[key]) === value)
+    }
+    rows = rows.slice(0, Number(url.searchParams.get('limit')) || 100)
+  }
+  return new Response(JSON.stringify(rows), {
+    headers: { 'Content-Type': 'application/json', 'X-HomeBuh-Source': 'replica' }
+  })
+}
+
+// ---- Outbox ----
+
+let flushing = null
+
+async function enqueue(request) {
+  const entry = {
+    id: crypto.randomUUID(),
+    method: request.method,
+    url: request.url,
+    contentType: request.headers.get('Content-Type'),
+    body: await request.text(),
+    queuedAt: new Date().toISOString()
+  }
+  await withStores(['outbox'], 'readwrite', s => s.outbox.add(entry))
+  if (self.registration.sync) {
+    self.registration.sync.register('outbox').catch(() => {})
+  }
+  return new Response(JSON.stringify({ queued: true, id: entry.id }), {
+    status: 202,
+    headers: { 'Content-Type': 'application/json' }
+  })
+}
+
+async function outboxSize() {
+  return withStores(['outbox'], 'readonly', s => done(s.outbox.count()))
+}
+
+async function notify(message) {
+  for (const client of await self.clients.matchAll()) client.postMessage(message)
+}
+
+// Replays queued writes oldest first, REPLAY_BATCH at a time. Stops at the
+// first network error or 5xx and leaves the rest for the next attempt.
+async function replay() {
+  for (;;) {
+    const batch = await withStores(['outbox'], 'readonly', s => done(s.outbox.getAll(null, REPLAY_BATCH)))
+    if (!batch.length) return
+    const sent = []
+    let stopped = false
+    for (const entry of batch) {
+      let r
+      try {
+        r = await fetch(entry.url, {
+          method: entry.method,
+          headers: { 'Content-Type': entry.contentType || 'application/json', 'Idempotency-Key': entry.id },
+          body: entry.body || undefined
+        })
+      } catch (e) {
+        stopped = true
+        break
+      }
+      if (r.status >= 500) {
+        stopped = true
+        break
+      }
+      if (!r.ok) notify({ type: 'outbox-rejected', entry, status: r.status, detail: await r.text() })
+      sent.push(entry.seq)
+    }
+    if (sent.length) {
+      await withStores(['outbox'], 'readwrite', s => { for (const seq of sent) s.outbox.delete(seq) })
+      notify({ type: 'outbox-replayed', count: sent.length })
+    }
+    if (stopped) throw new Error('outbox replay interrupted')
+  }
+}
+
+function flush() {
+  if (!flushing) {
+    flushing = replay().then(sync).finally(() => { flushing = null })
+  }
+  return flushing
+}
+
+// ---- Events ----
+
+async function handleList(event, url, list) {
+  // Serve what is there now and catch up in the background; until the
+  // first snapshot has landed, go to the server.
+  event.waitUntil(sync().catch(() => {}))
+  return (await replicaReady()) ? fromReplica(url, list) : fetch(event.request)
+}
+
+async function handleWrite(event, queueable) {
+  const request = event.request
+  if ((await outboxSize()) > 0) {
+    // Keep writes in order behind the ones already waiting.
+    if (queueable) {
+      const queued = await enqueue(request)
+      event.waitUntil(flush().catch(() => {}))
+      return queued
+    }
+    await flush().catch(() => {})
+  }
+  try {
+    const r = await fetch(request.clone())
+    // So a list read right after the write already sees it.
+    if (r.ok) await sync().catch(() => {})
+    return r
+  } catch (e) {
+    // Without a key a replay could apply the write twice, so the page sees the failure.
+    if (!queueable) throw e
+    return enqueue(request)
+  }
+}
+
+self.addEventListener('install', () => {
+  self.skipWaiting()
+})
+
+self.addEventListener('activate', event => {
+  event.waitUntil(self.clients.claim().then(() => flush().catch(() => {})))
+})
 
 self.addEventListener('fetch', event => {
-  // basic offline fallback could be extended
-});
+  const url = new URL(event.request.url)
+  if (url.origin !== API || !url.pathname.startsWith('/api/')) return
+  const method = event.request.method
+  if (method === 'GET') {
+    const list = LISTS[url.pathname]
+    // Paged, filtered or streamed reads need the server.
+    const plain = [...url.searchParams.keys()].every(k => ['limit', 'account_id', 'category_id'].includes(k))
+    if (list && plain) event.respondWith(handleList(event, url, list))
+    return
+  }
+  const json = (event.request.headers.get('Content-Type') || '').startsWith('application/json')
+  const queueable = method === 'POST' && QUEUEABLE.includes(url.pathname)
+  if (json) event.respondWith(handleWrite(event, queueable))
+})
+
+self.addEventListener('sync', event => {
+  if (event.tag === 'outbox') event.waitUntil(flush())
+})
+
+self.addEventListener('message', event => {
+  if (event.data && event.data.type === 'flush') event.waitUntil(flush().catch(() => {}))
+})
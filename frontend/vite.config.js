@@ -0,0 +1,19 @@
+import { defineConfig } from 'vite'
+import react from '@vitejs/plugin-react'
+
+export default defineConfig({
+  plugins: [react()],
+  server: {
+    // Lets /src/service-worker.js control the whole app in dev.
+    headers: { 'Service-Worker-Allowed': '/' }
+  },
+  build: {
+    rollupOptions: {
+      input: { main: 'index.html', 'service-worker': 'src/service-worker.js' },
+      output: {
+        // The worker needs a stable URL to be registered and updated.
+        entryFileNames: chunk => (chunk.name === 'service-worker' ? 'service-worker.js' : 'assets/[name]-[hash].js')
+      }
+    }
+  }
+})